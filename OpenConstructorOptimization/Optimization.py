@@ -14,24 +14,12 @@ import cv2  # OpenCV library
 import glob  # Finds all the pathnames
 import sys
 import os  # Using operating system dependent functionality
-from tqdm import tqdm  # Show a smart progress meter
-import matplotlib.pyplot as plt  # Library to do plots 2D
-import matplotlib.animation as animation  # Animate plots
-from matplotlib import gridspec  # Make subplott
-from mpl_toolkits.mplot3d import Axes3D  # Library to do plots 3D
-from scipy.sparse import lil_matrix  # Lib Sparse bundle adjustment
 from scipy.optimize import least_squares  # Lib optimization
 import cv2.aruco as aruco  # Aruco Markers
 import pickle
 import networkx as nx
-from numpy.linalg import inv
 from itertools import combinations
 
-from transformations import random_quaternion
-from transformations import quaternion_slerp
-from transformations import quaternion_from_matrix
-from transformations import quaternion_matrix
-
 from os.path import basename
 import subprocess
 
@@ -40,6 +28,28 @@ import subprocess
 #-------------------------------------------------------------------------------
 from myClasses import *
 from costFunctions import *
+from bundleAdjustment import schurLevenbergMarquardt
+from initialGuess import sceneGraph
+from initialGuess import initialGuess
+from initialGuess import detectionCosts
+from initialGuess import centralNode
+from componentSolve import splitComponents
+from componentSolve import solveComponents
+from componentSolve import printComponents
+from componentSolve import anchorBounds
+from profiling import StageProfiler
+from arucoDetection import detectArucos
+from arucoDetection import learnMarkerIds
+from arucoDetection import loadDetectorProfile
+from detectionCache import DetectionCache
+from detectionCache import detectionCacheFilename
+from imageSources import isVideo
+from imageSources import videoFrames
+from archiveSources import isArchived
+from archiveSources import listFiles
+from archiveSources import openText
+from archiveSources import copyFiles
+from archiveSources import extractedPath
 
 #-------------------------------------------------------------------------------
 #--- HEADER
@@ -75,6 +85,15 @@ def bash(cmd):
         p.wait()
 
 
+def saveProfile(profiler, args):
+    """Prints and saves the profiling report, if asked with -profile or -cprofile
+    """
+    if args['profile'] or args['cprofile']:
+        profiler.printReport()
+        profiler.save(args['profile'] or 'profile.json')
+        print "Profiling report saved to " + (args['profile'] or 'profile.json')
+
+
 #-------------------------------------------------------------------------------
 #--- MAIN
 #-------------------------------------------------------------------------------
@@ -88,7 +107,7 @@ if __name__ == "__main__":
 
     # ap.add_argument('--version', action='version', version='%(prog)s 2.0')
     ap.add_argument('dir', metavar='Directory',
-                    type=str, help='Directory of the dataset to optimize')
+                    type=str, help='Directory of the dataset to optimize (or a video, or a directory inside a tar/zip archive)')
 
     ap.add_argument('option1', choices=[
                     'center', 'corners'], help="Chose if is the centers or the corners of Arucos to do the otimization.")
@@ -110,21 +129,104 @@ if __name__ == "__main__":
 
     ap.add_argument("-ms", metavar="marksize",
                     help="size of the aruco markers (m)", required=False)
+    ap.add_argument("-residuals", choices=['distance', 'coordinates'], default='distance',
+                    help="Residuals of the optimization: distance in pixels of each detection or the (du, dv) of each point", required=False)
+    ap.add_argument("-jac", choices=['analytic', 'numeric'], default='analytic',
+                    help="Jacobian of the cost function computed in closed form or by finite differences", required=False)
+    ap.add_argument("-checkJac", action='store_true',
+                    help="Compare the analytic jacobian with finite differences before the optimization", required=False)
+    ap.add_argument("-solver", choices=['trf', 'schur'], default='trf',
+                    help="Solver: scipy least_squares (trf) or Levenberg-Marquardt with the Schur complement of the arucos", required=False)
+    ap.add_argument("-linearSolver", choices=['cholesky', 'cg'], default='cholesky',
+                    help="Linear solver of the reduced camera system of the schur solver", required=False)
+    ap.add_argument("-edgeWeights", choices=['quality', 'unit'], default='quality',
+                    help="Weights of the edges of the graph used for the initial guess: cost of each detection from its area, viewing angle and reprojection error, or 1", required=False)
+    ap.add_argument("-maxPaths", type=int, default=100,
+                    help="Largest number of shortest paths to the map averaged for the initial guess of each camera and aruco", required=False)
+    ap.add_argument("-mapNode", metavar="NODE",
+                    help="Node of the graph that is the frame of the map (default: A0, or auto if A0 is not detected), e.g. C3, or auto: the aruco or camera with the cheapest paths to all the others (only arucos with fromfile)", required=False)
+    ap.add_argument("-components", action='store_true',
+                    help="If the graph is not connected, calibrate each connected component on its own (in parallel, with -workers processes)", required=False)
+    ap.add_argument("-frames", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                    help="Frames of the video to use (default: all)", required=False)
+    ap.add_argument("-stride", type=int, default=1,
+                    help="Use one frame of the video every STRIDE frames", required=False)
+    ap.add_argument("-headless", action='store_true',
+                    help="Batch mode: no drawing (matplotlib is not imported) and the images are decoded to gray and dropped after the detection", required=False)
+    ap.add_argument("-preview", type=int, choices=[1, 2, 4, 8], default=1,
+                    help="Decode the images drawn with -d and -do at 1/2, 1/4 or 1/8 of their size (JPEG images are decoded at reduced resolution)", required=False)
+    ap.add_argument("-workers", type=int,
+                    help="Number of processes of the aruco detection (default: all the cores)", required=False)
+    ap.add_argument("-detectionScale", type=float, default=1.0,
+                    help="Detect the arucos in the images downscaled by this factor (e.g. 0.5) and refine their corners in the full images", required=False)
+    ap.add_argument("-track", type=int, default=0, metavar="N",
+                    help="Images are a sequence: track the arucos from image to image and search the whole image every N images (default: 0, search every image)", required=False)
+    ap.add_argument("-arucoIds", type=int, nargs='+', metavar="ID",
+                    help="Ids of the arucos of the dataset, the others are not detected", required=False)
+    ap.add_argument("-learnIds", type=int, metavar="N",
+                    help="Detect only the arucos found in N images spread over the dataset", required=False)
+    ap.add_argument("-noDetectorProfile", action='store_true',
+                    help="Use the default parameters of the aruco detector, not the ones tuned for the dataset by tuneDetector.py", required=False)
+    ap.add_argument("-noCache", action='store_true',
+                    help="Do not use (or save) the cache of the aruco detections of the dataset", required=False)
+    ap.add_argument("-profile", metavar="report",
+                    help="Save the time, calls and peak memory of each stage to this JSON file", required=False)
+    ap.add_argument("-cprofile", metavar="directory",
+                    help="Save a cProfile of each stage (<stage>.prof) to this directory", required=False)
 
     args = vars(ap.parse_args())
 
+    if args['solver'] == 'schur' and args['jac'] == 'numeric':
+        ap.error("the schur solver requires the analytic jacobian")
+
+    if isVideo(args['dir']) and (args['option3'] == 'fromfile' or args['saveResults'] or
+                                 args['processDataset']):
+        ap.error("a video has no extrinsics of OpenConstructor (fromfile, -saveResults, -processDataset)")
+
+    if args['maxPaths'] < 1:
+        ap.error("-maxPaths must be at least 1")
+
+    if args['mapNode'] not in (None, 'auto') and args['mapNode'][0:1] not in ('A', 'C'):
+        ap.error("-mapNode must be auto, an aruco (A<id>) or a camera (C<k>)")
+
+    if args['components'] and (args['no'] or args['d'] or args['do'] or args['saveResults'] or
+                               args['jac'] == 'numeric'):
+        ap.error("-components solves the components with the analytic jacobian, without drawing (-no, -d, -do, -saveResults, -jac numeric)")
+
+    if args['stride'] < 1:
+        ap.error("-stride must be at least 1")
+
+    if args['arucoIds'] and args['learnIds']:
+        ap.error("-arucoIds and -learnIds can not be used together")
+
+    if not 0 < args['detectionScale'] <= 1:
+        ap.error("-detectionScale must be in ]0, 1]")
+
+    if args['headless'] and (args['d'] or args['do']):
+        ap.error("-headless can not draw (-d, -do)")
+
+    if not args['headless']:
+        import matplotlib.pyplot as plt  # Library to do plots 2D
+        import matplotlib.animation as animation  # Animate plots
+        from matplotlib import gridspec  # Make subplott
+        from mpl_toolkits.mplot3d import Axes3D  # Library to do plots 3D
+
     if args['ms']:
         marksize = float(args['ms'])
     else:
         marksize = 0.082
 
+    profiler = StageProfiler(enabled=bool(args['profile'] or args['cprofile']),
+                             cprofile_dir=args['cprofile'])
+
     #---------------------------------------
     #--- Intitialization
     #---------------------------------------
 
     Directory = args['dir']
 
-    newDirectory = os.path.dirname(Directory) + "/dataset_optimized"
+    # The results of a dataset inside an archive are saved next to the archive
+    newDirectory = os.path.dirname(extractedPath(Directory)) + "/dataset_optimized"
 
     if args['option3'] == 'fromfile' or marksize == 0.1:  # or True:
 
@@ -133,14 +235,16 @@ if __name__ == "__main__":
             if not os.path.exists(newDirectory):
                 os.makedirs(newDirectory)
 
-            bash('cp ' + Directory + '/* ' + newDirectory + '/')
+            if isArchived(Directory):
+                copyFiles(listFiles(os.path.join(Directory, '*')), newDirectory)
+            else:
+                bash('cp ' + Directory + '/* ' + newDirectory + '/')
 
             print "----------------------------\nNew path was created\n----------------------------"
             # -------
 
         # Read all images (each image correspond to a camera)
-        filenames = sorted(
-            glob.glob((os.path.join(Directory, '*.jpg'))))
+        filenames = listFiles(os.path.join(Directory, '*.jpg'))
 
         # Read data calibration camera (Dictionary elements -> "mtx", "dist")
         parameters = []
@@ -162,8 +266,7 @@ if __name__ == "__main__":
         dist[:] = parameters[9:14]
 
         # Read data extrinsic calibration camera (OpenConstructor)
-        textfilenames = sorted(
-            glob.glob((os.path.join(Directory, '00*.txt'))))
+        textfilenames = listFiles(os.path.join(Directory, '00*.txt'))
 
         for w, cltx in enumerate(textfilenames):
             nt = len(cltx)
@@ -171,8 +274,7 @@ if __name__ == "__main__":
                 del textfilenames[w]
     else:
         # Read all images (each image correspond to a camera)
-        filenames = sorted(
-            glob.glob((os.path.join(Directory, '*.png'))))
+        filenames = listFiles(os.path.join(Directory, '*.png'))
 
         # Read data calibration camera (Dictionary elements -> "mtx", "dist")
         d = np.load("CameraParameters/cameraParameters.npy")
@@ -184,27 +286,75 @@ if __name__ == "__main__":
         intrinsics[:, :3] = mtx
         dist = d.item().get('dist')
 
+    # Frames of a video, read from the video without extracting them
+    if isVideo(Directory):
+        first, last = args['frames'] if args['frames'] else (0, None)
+        filenames = videoFrames(Directory, first, last, args['stride'])
+        print("Using " + str(len(filenames)) + " frames of the video " + Directory)
+
     # Define aruco dictionary
-    aruco_dict = aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL)
-    parameters = aruco.DetectorParameters_create()
+    aruco_dict = aruco.DICT_ARUCO_ORIGINAL
 
     s = [stru() for i in range(len(filenames))]
 
-    # Detect Aruco Markers
-    detections = []
-
-    k = 0
-    # for filename in filenames[12:16]:
-    for filename in filenames:
-
-        # load image
-        raw = cv2.imread(filename)
+    # Parameters of the aruco detector tuned for the dataset (tuneDetector.py)
+    detector_parameters = None
+    if not args['noDetectorProfile']:
+        detector_parameters = loadDetectorProfile(Directory)
+        if detector_parameters is not None:
+            print("Detector parameters of the dataset: " + str(detector_parameters))
+
+    # Detections of previous runs, saved next to the images
+    cache = None
+    if not args['noCache']:
+        cache = DetectionCache(detectionCacheFilename(Directory))
+
+    # Detect Aruco Markers, each image in a worker of a pool of processes
+    with profiler.stage('detection'):
+        # Dictionary restricted to the arucos of the dataset
+        if args['arucoIds']:
+            aruco_dict = (aruco_dict, tuple(sorted(set(args['arucoIds']))))
+        elif args['learnIds']:
+            aruco_dict = learnMarkerIds(filenames, aruco_dict, marksize, mtx, dist,
+                                        args['learnIds'], parameters=detector_parameters,
+                                        workers=args['workers'],
+                                        cache=cache, grayscale=args['headless'],
+                                        scale=args['detectionScale'])
+            if isinstance(aruco_dict, tuple):
+                print("Detecting only the arucos " + str(list(aruco_dict[1])))
+
+        images = detectArucos(filenames, aruco_dict, marksize, mtx, dist,
+                              parameters=detector_parameters, workers=args['workers'], keep_images=args['d'] or args['do'],
+                              cache=cache, grayscale=args['headless'],
+                              scale=args['detectionScale'], track=args['track'],
+                              preview=args['preview'])
+
+    if cache is not None:
+        print("Detection cache: " + str(cache.hits) + " images cached, " +
+              str(cache.misses) + " detected")
+        if cache.misses > 0:
+            try:
+                cache.save()
+            except (IOError, OSError) as e:
+                print("Could not save the detection cache: " + str(e))
+
+    detections = DetectionTable()
+
+    # The drawn images can be smaller than the images of the detection
+    preview = float(args['preview'])
+    preview_mtx = mtx.copy()
+    preview_mtx[0:2, :] /= preview
+
+    for k, image in enumerate(images):
+
+        # Time of each step in the workers
+        for name, wall, cpu in image.timings:
+            profiler.record(name, wall, cpu)
+
+        raw = image.raw
         s[k].raw = raw
-        gray = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
-
-        # lists of ids and the corners beloning to each id
-        corners, ids, _ = aruco.detectMarkers(
-            gray, aruco_dict, parameters=parameters)
+        corners = image.corners
+        ids = image.ids
 
         font = cv2.FONT_HERSHEY_SIMPLEX  # font for displaying text
 
@@ -213,37 +363,25 @@ if __name__ == "__main__":
                 # print "----------------------------"
                 # print("> Camera " + str(k))
 
-                # Estimate pose of each marker
-                rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(
-                    corners, marksize, mtx, dist)
-
-                for rvec, tvec, idd, corner in zip(rvecs, tvecs, ids, corners):
-
-                    # if float(idd) > 3:  # skip all arucos id > 3
-                    #     continue
-                    # valid_ids = range(0, 54, 7)
-                    # if float(idd) not in valid_ids:  # skip all arucos id > 3
-                    #     continue
+                rvecs, tvecs = image.rvecs, image.tvecs
 
-                    detection = MyDetection(
-                        rvec[0], tvec[0], 'C' + str(k), 'A' + str(idd[0]), corner)
+                detections.add(k, ids, corners, rvecs, tvecs, k)
 
-                    # print(detection)
-                    # print(detection.printValues())
-                    detections.append(detection)
-
-                    if args['d'] or args['do']:
-                        aruco.drawAxis(raw, mtx, dist, rvec,
+                if args['d'] or args['do']:
+                    for rvec, tvec, idd, corner in zip(rvecs, tvecs, ids, corners):
+                        aruco.drawAxis(raw, preview_mtx, dist, rvec,
                                        tvec, 0.05)  # Draw Axis
-                        cv2.putText(raw, "Id:" + str(idd[0]), (corner[0][0, 0],
-                                                               corner[0][0, 1]), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
+                        cv2.putText(raw, "Id:" + str(idd[0]), (int(corner[0][0, 0] / preview),
+                                                               int(corner[0][0, 1] / preview)), font, 1, (0, 255, 0), 2, cv2.LINE_AA)
 
-                raw = aruco.drawDetectedMarkers(raw, corners)
+                    raw = aruco.drawDetectedMarkers(
+                        raw, [corner / preview for corner in corners])
 
         if args['d'] or args['do']:
             # drawing sttuff
-            size_square = 15
+            size_square = 15 / preview
             for corner in corners:
+                corner = corner / preview
                 if args['option1'] == 'corners':
                     for ij in range(len(corner[0])):
                         x1 = int(corner[0][ij][0]-size_square)
@@ -262,9 +400,10 @@ if __name__ == "__main__":
                     x2 = int(xcm+size_square)
                     y2 = int(ycm+size_square)
                     cv2.rectangle(raw, (x1, y1), (x2, y2), (0, 0, 255), 2)
-        k = k+1
 
-    width, height, _ = raw.shape
+    detections.build()
+
+    width, height = images[-1].shape[0:2]
 
     #---------------------------------------
     #--- Get camera transformations by OpenConstructor.
@@ -278,7 +417,7 @@ if __name__ == "__main__":
 
         for j, namefile in enumerate(textfilenames):
             Tot = np.zeros((4, 4))
-            txtfile = open(namefile)
+            txtfile = openText(namefile)
             for i, line in enumerate(txtfile):
                 if 0 < i < 5:
                     paramVect = []
@@ -297,34 +436,38 @@ if __name__ == "__main__":
             print "T = \n" + str(Tt)
             print "\n--------------------------------------------------------"
 
+    # Points of the aruco used in the optimization (corners or center)
+    l = marksize
+    if args['option1'] == 'corners':
+        Pc = np.array([[-l/2, l/2, 0], [l/2, l/2, 0],
+                       [l/2, -l/2, 0], [-l/2, -l/2, 0]])
+    else:
+        Pc = np.array([[0, 0, 0]])
+
     #---------------------------------------
     #--- Initial guess for parameters (create x0).
     #---------------------------------------
 
     # Start the Aruco nodes graph and insert nodes (the images)
-    GA = nx.Graph()
-
-    GA.add_edge('Map', 'C0', weight=1)
-
-    if args['option3'] == 'fromfile':
-        for i in range(1, len(filenames)):
-            GA.add_edge('Map', 'C'+str(i), weight=1)
-
-    for detection in detections:
-        GA.add_edge(detection.aruco, detection.camera, weight=1)
+    with profiler.stage('graph_build'):
+        costs = None
+        if args['edgeWeights'] == 'quality':
+            costs = detectionCosts(detections, intrinsics, dist, marksize)
+        if args['option3'] == 'fromfile':
+            GA = sceneGraph(detections, len(filenames), costs)
+        else:
+            GA = sceneGraph(detections, costs=costs)
 
     if args['d'] or args['do']:
-        # Draw graph
+        # Draw graph (the layout is only needed to draw)
         fig2 = plt.figure()
 
-    pos = nx.random_layout(GA)
-    pos = nx.spring_layout(GA)
-    # pos = nx.kamada_kawai_layout(GA)
+        pos = nx.spring_layout(GA)
+        # pos = nx.kamada_kawai_layout(GA)
 
-    colors = range(4)
-    edges, weights = zip(*nx.get_edge_attributes(GA, 'weight').items())
+        colors = range(4)
+        edges, weights = zip(*nx.get_edge_attributes(GA, 'weight').items())
 
-    if args['d'] or args['do']:
         # edge_labels = nx.draw_networkx_edge_labels(GA, pos)
 
         nx.draw(GA, pos, node_color='#A0CBE2', edgelist=edges, edge_color=weights, width=6, edge_cmap=plt.cm.Greys_r,
@@ -338,127 +481,48 @@ if __name__ == "__main__":
     print('-> GA is connected ' + str(nx.is_connected(GA)))
     print "----------------------------"
 
-    if not nx.is_connected(GA):
-        exit()
+    # With fromfile the cameras keep the transforms of OpenConstructor, so only an
+    # aruco can be the map
+    map_cameras = args['option3'] == 'fromaruco'
 
-    map_node = 'A0'  # to be defined by hand
-
-    while not map_node in GA.nodes:
-        # raise ValueError('Must define a map that exists in the graph. Should be one of ' + str(GA.nodes))
+    if args['mapNode'] not in (None, 'auto') and not args['mapNode'] in GA.nodes:
         print 'Must define a map that exists in the graph. \nShould be one of ' + \
             str(GA.nodes)
-        name = raw_input("Insert a valid map node: ")
-        map_node = str(name)
-        print "\n"
-
-    print "-> Map node is " + map_node
-    print "-----------------------\n"
-
-    # cycle all nodes in graph
-    for node in tqdm(GA.nodes):
-
-        # print "--------------------------------------------------------"
-        # print('Solving for ' + node + "...")
-
-        # path = nx.shortest_path(GA, node, map_node)
-        # print(path)
-
-        paths_shortest = list(nx.all_shortest_paths(GA, node, map_node))
-        shortest_path_lenght = len(paths_shortest[0])
-        paths = paths_shortest
-
-        # if len(paths_shortest) < 4:  # if small number of shortes paths compute some more
-        #     paths_simple = list(nx.all_simple_paths(
-        #         GA, node, map_node, cutoff=shortest_path_lenght+2))
-        #     paths.extend(paths_simple)
-
-        #     paths = [list(x) for x in set(tuple(x) for x in paths)]
-
-        if paths == []:
-            paths = [[node]]
-
-        # print(paths)
-
-        transformations_for_path = []
-
-        for path in paths:
-            T = np.array([[1, 0, 0, 0], [0, 1, 0, 0], [
-                          0, 0, 1, 0], [0, 0, 0, 1]], dtype=np.float)
-
-            for i in range(1, len(path)):
-                start = path[i-1]
-                end = path[i]
-                start_end = [start, end]
-
-                if start == 'Map':
-                    if args['option3'] == 'fromaruco':
-                        Ti = inv(np.identity(4))
-                    else:
-                        camera = [camera for camera in X.cameras if camera.id ==
-                                  end[1:]][0]
-                        Ti = inv(camera.getT())
-
-                elif end == 'Map':
-                    if args['option3'] == 'fromaruco':
-                        Ti = np.identity(4)
-                    else:
-                        camera = [camera for camera in X.cameras if camera.id ==
-                                  start[1:]][0]
-                        Ti = camera.getT()
-
-                else:
-                    if start[0] == 'C':  # start is an aruco type node
-                        is_camera = True
-                    else:
-                        is_camera = False
-
-                    det = [
-                        x for x in detections if x.aruco in start_end and x.camera in start_end][0]
-
-                    # print(det)
-
-                    Ti = det.getT()
-
-                    if is_camera:  # Validated! When going from aruco to camera must invert the tranformation given by the aruco detection
-                        # print('Will invert...')
-                        Ti = inv(Ti)
-
-                T = np.matmul(Ti, T)
-
-                # print("Ti = \n" + str(Ti))
-                # print("T = \n" + str(T))
-
-            q = quaternion_from_matrix(T, isprecise=False)
-            t = (tuple(T[0:3, 3]), tuple(q))
-            # print t
-            # exit()
-            transformations_for_path.append(t)
+        exit()
 
-        qm = averageTransforms(transformations_for_path)
-        # print qm
+    # A0 by default, the most central node (None here) with auto or when A0 was not
+    # detected
+    if args['mapNode'] == 'auto':
+        map_node = None
+    elif args['mapNode'] is None:
+        map_node = 'A0' if 'A0' in GA.nodes else None
+    else:
+        map_node = args['mapNode']
 
-        T = quaternion_matrix(qm[1])
-        T[0, 3] = qm[0][0]
-        T[1, 3] = qm[0][1]
-        T[2, 3] = qm[0][2]
-        # print T
-        # exit()
+    if not nx.is_connected(GA):
+        if not args['components']:
+            print("The graph is not connected, calibrate each connected component with -components")
+            exit()
+
+        # Each connected component is calibrated on its own, in parallel
+        components = splitComponents(GA, detections, map_node, map_cameras)
+        print("Calibrating the " + str(len(components)) + " connected components of the graph")
+        with profiler.stage('components'):
+            results = solveComponents(components, dist, intrinsics, Pc, args, args['workers'])
+        printComponents(components, results)
+
+        saveProfile(profiler, args)
+        exit()
 
-        # print("Transformation from " + node +
-        #       " to " + map_node + " is: \n" + str(T))
+    if map_node is None:
+        map_node = centralNode(GA, map_cameras)
 
-        if node[0] == 'C' and args['option3'] == 'fromaruco':  # node is a camera
-            camera = MyCamera(T=T, id=node[1:])
-            X.cameras.append(camera)
-        elif node == 'Map':
-            vvv = 0
-            # camera = MyCamera(T=T, id='Map')
-            # X.cameras.append(camera)
-        else:
-            aruco = MyAruco(T=T, id=node[1:])
-            X.arucos.append(aruco)
+    print "-> Map node is " + map_node
+    print "-----------------------\n"
 
-    X.arucos.sort(key=lambda x: float(x.id), reverse=False)
+    # Transforms of all cameras and arucos to the map node
+    with profiler.stage('initial_guess'):
+        initialGuess(GA, map_node, detections, X, args, max_paths=args['maxPaths'])
 
     # Get vector x0
     X.toVector(args)
@@ -479,36 +543,19 @@ if __name__ == "__main__":
     #---------------------------------------
     #--- Draw Initial guess.
     #---------------------------------------
-    l = marksize
-    if args['option1'] == 'corners':
-        Pc = np.array([[-l/2, l/2, 0], [l/2, l/2, 0],
-                       [l/2, -l/2, 0], [-l/2, -l/2, 0]])
-    else:
-        Pc = np.array([[0, 0, 0]])
-
     handles = []
 
     if args['d'] or args['do']:
-        size_square = 13
-        for detection in detections:
-            camera = [camera for camera in X.cameras if camera.id ==
-                      detection.camera[1:]][0]  # fetch the camera for this detection
-
-            aruco = [aruco for aruco in X.arucos if aruco.id ==
-                     detection.aruco[1:]][0]  # fetch the aruco for this detection
-
-            Ta = aruco.getT()
-            Tc = camera.getT()
-            T = np.matmul(inv(Tc), Ta)
-
-            xypix = points2imageFromT(T, intrinsics, Pc, dist)
+        size_square = 13 / preview
+        xypixs = projectDetections(X, detections, intrinsics, Pc, dist)
 
-            k = int(camera.id)
+        for k, xypix in zip(detections.cameras, xypixs):
+            xypix = xypix / preview
 
             # Draw intial projections
             if args['option1'] == 'corners':
                 for i in range(4):
-                    if 0 < xypix[i][0] < height and 0 < xypix[i][1] < width:
+                    if 0 < xypix[i][0] < height / preview and 0 < xypix[i][1] < width / preview:
                         # cv2.circle(s[k].raw, (int(xypix[i][0]), int(xypix[i][1])),
                         #            5, (255, 128, 0), -1)
                         x1 = int(xypix[i][0]-size_square)
@@ -518,7 +565,7 @@ if __name__ == "__main__":
                         cv2.rectangle(s[k].raw, (x1, y1),
                                       (x2, y2), (255, 128, 0), -1)
             else:
-                if 0 < xypix[0][0] < height and 0 < xypix[0][1] < width:
+                if 0 < xypix[0][0] < height / preview and 0 < xypix[0][1] < width / preview:
                     x1 = int(xypix[0][0]-size_square)
                     y1 = int(xypix[0][1]-size_square)
                     x2 = int(xypix[0][0]+size_square)
@@ -599,10 +646,11 @@ if __name__ == "__main__":
     #---------------------------------------
 
     costFunction.counter = 0
+    jacobianFunction.counter = 0
 
     # call objective function with initial guess (just for testing)
-    initial_residuals = costFunction(
-        x0, dist, intrinsics, X, Pc, detections, args, handles, None, s)
+    initial_residuals = detectionErrors(costFunction(
+        x0, dist, intrinsics, X, Pc, detections, args, handles, None, s), args)
 
     handle_fun = None
     if args['d'] or args['do']:
@@ -637,9 +685,8 @@ if __name__ == "__main__":
         squad = []
         number_of_detections = len(detections)
         x1 = range(number_of_detections)
-        for detection in detections:
-            xstring = detection.camera + '/' + detection.aruco
-            squad.append(xstring)
+        for i in range(number_of_detections):
+            squad.append(detections.name(i))
         # # print x1
         # # print squad
         axcost.set_xticks(x1)
@@ -655,33 +702,10 @@ if __name__ == "__main__":
         #--- Create the sparse matrix
         #---------------------------------------
 
-        M = len(detections)
-        N = len(x0)
+        with profiler.stage('sparsity'):
+            A = sparsityMatrix(X, detections, Pc, args)
 
-        A = lil_matrix((M, N), dtype=int)
-
-        id_detection = 0
-
-        for detection in detections:
-
-            camera = [camera for camera in X.cameras if camera.id ==
-                      detection.camera[1:]][0]
-
-            idxs_camera = X.idxsFromCamera(camera.id, args)
-
-            aruco = [aruco for aruco in X.arucos if aruco.id ==
-                     detection.aruco[1:]][0]
-
-            idxs_aruco = X.idxsFromAruco(aruco.id, args)
-
-            idxs = np.append(idxs_camera, idxs_aruco)
-
-            A[id_detection, idxs] = 1
-
-            id_detection = id_detection + 1
-
-        print('A shape = ' + str(A.shape))
-        print('A =\n' + str(A.toarray()))
+        print('A shape = ' + str(A.shape) + ', ' + str(A.nnz) + ' non zeros')
 
         #---------------------------------------
         #--- Set the bounds for the parameters
@@ -692,29 +716,13 @@ if __name__ == "__main__":
         # camera_params = params[:n_cameras * 9].reshape((n_cameras, 9))
         # points_3d = params[n_cameras * 9:].reshape((n_points, 3))
 
-        Bmin = []
-        Bmax = []
-        for i in range(0, len(X.cameras)):
-            for i in range(0, 6):
-                Bmin.append(-np.inf)
-                Bmax.append(np.inf)
-
-        delta = 0.0000001
-        for i in range(len(X.cameras) * 6, len(X.cameras) * 6 + len(X.arucos)*6):
-            if i > len(X.cameras) * 6 and i <= len(X.cameras) * 6 + 6:
-                Bmin.append(x0[i] - delta)
-                Bmax.append(x0[i] + delta)
-            else:
-                Bmin.append(-np.inf)
-                Bmax.append(np.inf)
-
-        # for i in range(len(x0)-4, len(x0)):
-            # Bmin.append(-np.inf)
-            # Bmax.append(np.inf)
+        if args['option2'] == 'all':
+            nvalues = 6
+        else:
+            nvalues = 3
 
-        bounds = (Bmin, Bmax)
-        # print len(Bmin)
-        # print len(Bmax)
+        # The parameters of the map node are fixed
+        bounds = anchorBounds(X, map_node, x0, args)
 
         # print len(x0)
         # print len(bounds)
@@ -732,26 +740,60 @@ if __name__ == "__main__":
 
         # exit(0)
 
-        # --- Without sparsity matrix
+        fun_args = (dist, intrinsics, X, Pc, detections,
+                    args, handles, handle_fun, s)
+
+        if args['checkJac']:
+            jac_error, jac_max = checkJacobian(x0, fun_args)
+            print("Analytic jacobian max error = " + str(jac_error) +
+                  " (max finite differences value = " + str(jac_max) + ")")
+
+        if args['jac'] == 'analytic':
+            jac = jacobianFunction
+            cost_function = costFunction
+        else:
+            jac = '2-point'
+            # Each column group of the finite differences only recomputes its detections
+            incremental = IncrementalCostFunction()
+            cost_function = incremental
+
+        # Each evaluation is counted and timed by the profiler
+        cost_function = profiler.wrap('residuals', cost_function)
+        if callable(jac):
+            jac = profiler.wrap('jacobian', jac)
+
         t0 = time.time()
 
         # Method
-        res = least_squares(costFunction, x0, verbose=2, jac_sparsity=A, x_scale='jac', ftol=1e-4,
-                            xtol=1e-4, bounds=bounds, method='trf', args=(dist, intrinsics, X, Pc, detections, args, handles, handle_fun, s))
+        with profiler.stage('solve'):
+            if args['solver'] == 'schur':
+                res = schurLevenbergMarquardt(cost_function, jac, x0, len(X.cameras), 6, nvalues, bounds=bounds,
+                                              ftol=1e-4, xtol=1e-4, linear_solver=args['linearSolver'],
+                                              verbose=2, args=fun_args)
+            else:
+                res = least_squares(cost_function, x0, verbose=2, jac=jac, jac_sparsity=A, x_scale='jac', ftol=1e-4,
+                                    xtol=1e-4, bounds=bounds, method='trf', args=fun_args)
 
         # print(res.x)
         t1 = time.time()
 
         print("\nOptimization took {0:.0f} seconds".format(t1 - t0))
+        if args['jac'] == 'analytic':
+            print("Cost function evaluations = " + str(costFunction.counter) +
+                  ", jacobian evaluations = " + str(jacobianFunction.counter))
+        else:
+            print("Cost function evaluations = " + str(incremental.counter) + " (" +
+                  str(incremental.full_evaluations) + " full, " + str(incremental.recomputed) +
+                  " detections recomputed in the others)")
 
-        X.fromVector(list(res.x), args)
+        X.fromVector(res.x, args)
 
         #---------------------------------------
         #--- Present the results
         #---------------------------------------
 
-        solution_residuals = costFunction(
-            res.x, dist, intrinsics, X, Pc, detections, args, handles, None, s)
+        solution_residuals = detectionErrors(costFunction(
+            res.x, dist, intrinsics, X, Pc, detections, args, handles, None, s), args)
 
         print("\nOPTIMIZATON FINISHED")
         print("Initial (x0) average error = " +
@@ -763,29 +805,30 @@ if __name__ == "__main__":
         #--- Save results
         #---------------------------------------
         if args['saveResults']:
-            print "saving results..."
+            with profiler.stage('save_results'):
+                print "saving results..."
 
-            textfilenames = sorted(
-                glob.glob((os.path.join(newDirectory, '00*.txt'))))
-            for w, cltx in enumerate(textfilenames):
-                nt = len(cltx)
-                if cltx[nt-6] == "-" or cltx[nt-7] == "-" or cltx[nt-8] == "-":
-                    del textfilenames[w]
+                textfilenames = sorted(
+                    glob.glob((os.path.join(newDirectory, '00*.txt'))))
+                for w, cltx in enumerate(textfilenames):
+                    nt = len(cltx)
+                    if cltx[nt-6] == "-" or cltx[nt-7] == "-" or cltx[nt-8] == "-":
+                        del textfilenames[w]
 
-            for j, namefile in enumerate(textfilenames):
+                for j, namefile in enumerate(textfilenames):
 
-                camera = [camera for camera in X.cameras if camera.id ==
-                          str(j)][0]
-                T = camera.getT()
-                Tp = T.transpose()
+                    camera = [camera for camera in X.cameras if camera.id ==
+                              str(j)][0]
+                    T = camera.getT()
+                    Tp = T.transpose()
 
-                lines = open(namefile).read().splitlines()
-                for i in range(4):
-                    lines[i+1] = str(Tp[i][0]) + ' ' + str(Tp[i][1]) + ' ' + \
-                        str(Tp[i][2]) + ' ' + str(Tp[i][3])
+                    lines = open(namefile).read().splitlines()
+                    for i in range(4):
+                        lines[i+1] = str(Tp[i][0]) + ' ' + str(Tp[i][1]) + ' ' + \
+                            str(Tp[i][2]) + ' ' + str(Tp[i][3])
 
-                open(namefile, 'w').write('\n'.join(lines))
-                print "Save T optimized for camera " + str(j) + "..."
+                    open(namefile, 'w').write('\n'.join(lines))
+                    print "Save T optimized for camera " + str(j) + "..."
 
         #---------------------------------------
         #--- Draw final results
@@ -796,31 +839,21 @@ if __name__ == "__main__":
             handle_fun.set_ydata(solution_residuals)
             plt.waitforbuttonpress(0.1)
 
-            for detection in detections:
-                camera = [camera for camera in X.cameras if camera.id ==
-                          detection.camera[1:]][0]
-
-                aruco = [aruco for aruco in X.arucos if aruco.id ==
-                         detection.aruco[1:]][0]
-
-                Ta = aruco.getT()
-                Tc = camera.getT()
-                T = np.matmul(inv(Tc), Ta)
-
-                xypix = points2imageFromT(T, intrinsics, Pc, dist)
+            xypixs = projectDetections(X, detections, intrinsics, Pc, dist)
 
-                k = int(camera.id)
+            for k, xypix in zip(detections.cameras, xypixs):
+                xypix = xypix / preview
 
                 # Draw intial projections
                 if args['option1'] == 'corners':
                     for i in range(4):
-                        if 0 < xypix[i][0] < height and 0 < xypix[i][1] < width:
+                        if 0 < xypix[i][0] < height / preview and 0 < xypix[i][1] < width / preview:
                             cv2.circle(s[k].raw, (int(xypix[i][0]), int(xypix[i][1])),
-                                       10, (0, 255, 255), -1)
+                                       int(10 / preview), (0, 255, 255), -1)
                 else:
-                    if 0 < xypix[0][0] < height and 0 < xypix[0][1] < width:
+                    if 0 < xypix[0][0] < height / preview and 0 < xypix[0][1] < width / preview:
                         cv2.circle(s[k].raw, (int(xypix[0][0]), int(xypix[0][1])),
-                                   10, (0, 255, 255), -1)
+                                   int(10 / preview), (0, 255, 255), -1)
                 cv2.imshow('camera'+str(k), s[k].raw)
 
             X.setPlot3D(Pc)
@@ -843,4 +876,10 @@ if __name__ == "__main__":
         #---------------------------------------
 
         if args['processDataset'] and args['saveResults']:
-            bash('./processDataset.py ' + Directory)
+            with profiler.stage('process_dataset'):
+                bash('./processDataset.py ' + Directory)
+
+    #---------------------------------------
+    #--- Profiling report
+    #---------------------------------------
+    saveProfile(profiler, args)
@@ -0,0 +1,199 @@
+# Reading of the files of a dataset stored in a tar or zip archive, without extracting it
+#
+# A file inside an archive is named as if the archive were a directory:
+# <archive>/<member>, e.g. Aruco_Board_1.tar.gz/Aruco_Board_1/dataset/00000000.jpg, so
+# that the scripts list and read the files of a dataset in the same way from a
+# directory or from an archive. Members are read to memory (images are decoded from
+# the buffer), only tools that need a path (openmesh, the ply scripts) get a temporary
+# copy of the member.
+#
+# Random access is cheap in zip and uncompressed tar archives. In a compressed tar
+# (.tar.gz, .tar.bz2, .tar.xz) the stream is decompressed again from the start each
+# time a member before the last one read is requested, so zip or .tar are better for
+# datasets read in parallel or in an order different from the archive.
+#
+# Nothing is written into an archive: results go to the path the file would have if
+# the archive were extracted in its directory (see extractedPath).
+import os
+import io
+import glob
+import fnmatch
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+from contextlib import contextmanager
+
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+
+# Archives open in this process, path -> Archive
+_archives = {}
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def isArchive(filename):
+    return os.path.isfile(filename) and filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def splitArchive(name):
+    """(archive, member) of the name of a file inside an archive, (name, None) otherwise
+        The archive itself gives (archive, '').
+    """
+    parts = os.path.normpath(name).split(os.sep)
+    for i in range(1, len(parts) + 1):
+        path = os.sep.join(parts[0:i]) or os.sep
+        if path.lower().endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path):
+            return path, '/'.join(parts[i:])
+    return name, None
+
+
+def isArchived(name):
+    """True if name is an archive or a file (or directory) inside an archive
+    """
+    return splitArchive(name)[1] is not None
+
+
+class Archive:
+    """Index of the members of a tar or zip archive and random access to their content
+        A lock serializes the reads, which share the file of the archive.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        if zipfile.is_zipfile(filename):
+            self.zip = zipfile.ZipFile(filename)
+            self.tar = None
+            self.members = dict((info.filename.rstrip('/'), info) for info in self.zip.infolist()
+                                if not info.filename.endswith('/'))
+        else:
+            self.zip = None
+            self.tar = tarfile.open(filename, 'r:*')
+            self.members = dict((os.path.normpath(info.name), info)
+                                for info in self.tar.getmembers() if info.isfile())
+
+    def names(self):
+        return sorted(self.members.keys())
+
+    def read(self, member):
+        """Content (bytes) of a member
+        """
+        if member not in self.members:
+            raise IOError("No file " + member + " in the archive " + self.filename)
+        with self.lock:
+            if self.zip is not None:
+                return self.zip.read(self.members[member])
+            f = self.tar.extractfile(self.members[member])
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+
+def openArchive(filename):
+    """Archive of filename, opened once per process (processes of a pool forked from
+        the main process do not share its open archives)
+    """
+    archive = _archives.get(filename)
+    if archive is None or archive.pid != os.getpid():
+        archive = Archive(filename)
+        _archives[filename] = archive
+    return archive
+
+
+def listFiles(pattern):
+    """Sorted names of the files matching pattern, as glob, also inside archives
+        Inside an archive, only the last component of the pattern can have wildcards.
+    """
+    path, member = splitArchive(pattern)
+    if member is None:
+        return sorted(glob.glob(pattern))
+
+    directory, basename = os.path.split(member)
+    names = []
+    for name in openArchive(path).names():
+        if os.path.dirname(name) == directory and fnmatch.fnmatch(os.path.basename(name), basename):
+            names.append(os.path.join(path, name))
+    return names
+
+
+def readBytes(name):
+    """Content of a file, or of a file inside an archive
+    """
+    path, member = splitArchive(name)
+    if member is None:
+        with open(name, 'rb') as f:
+            return f.read()
+    return openArchive(path).read(member)
+
+
+def openText(name):
+    """Text file, or file inside an archive, open for reading (iterates over its lines)
+    """
+    path, member = splitArchive(name)
+    if member is None:
+        return open(name)
+    data = openArchive(path).read(member)
+    return io.BytesIO(data) if str is bytes else io.StringIO(data.decode('utf-8'))
+
+
+@contextmanager
+def localCopy(name):
+    """Path of a file that can be opened by name: the file itself, or a temporary copy
+        of a file inside an archive (removed at the end of the with block)
+    """
+    path, member = splitArchive(name)
+    if member is None:
+        yield name
+        return
+
+    handle, filename = tempfile.mkstemp(suffix=os.path.splitext(member)[1])
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(openArchive(path).read(member))
+        yield filename
+    finally:
+        os.remove(filename)
+
+
+def extractedPath(name):
+    """Path that a file inside an archive would have if the archive were extracted in
+        its directory, the name itself for files outside archives
+    """
+    path, member = splitArchive(name)
+    if member is None:
+        return name
+    return os.path.join(os.path.dirname(path), *member.split('/'))
+
+
+def sidecarFilename(name, suffix):
+    """File next to the archive of a file (or directory) inside it:
+        <archive without extension>_<path of the member>_<suffix>
+    """
+    path, member = splitArchive(name)
+    stem = path[0:len(path) - max(len(e) for e in ARCHIVE_EXTENSIONS
+                                  if path.lower().endswith(e))]
+    return stem + ''.join('_' + part for part in member.split('/') if part) + '_' + suffix
+
+
+def copyFiles(names, destination):
+    """Copies files, or files inside archives, to the directory destination
+    """
+    for name in names:
+        target = os.path.join(destination, os.path.basename(name))
+        if isArchived(name):
+            with open(target, 'wb') as f:
+                f.write(readBytes(name))
+        else:
+            shutil.copy(name, target)
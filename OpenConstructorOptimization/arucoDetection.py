@@ -0,0 +1,537 @@
+# Detection of the arucos in the images, in parallel
+#
+# Each image is read, converted to gray, its arucos detected and their poses
+# estimated by a worker of a process pool. The results come back in the order of the
+# filenames, so the camera k is always the image k, as in the serial detection.
+#
+# With a scale below 1, the arucos are detected in a downscaled copy of the image
+# (much faster, the cost of the detection grows with the number of pixels) and their
+# corners are then refined with cornerSubPix in the full resolution image, only in a
+# small window around each corner. Rejected candidates are decoded again in a crop
+# of the full resolution image.
+#
+# With tracking, the images are a sequence (the OpenConstructor datasets) and each
+# worker gets a run of consecutive images. The arucos of an image are only searched
+# in the regions where they are predicted from the previous images, and the whole
+# image is searched again every few images or when an aruco is lost.
+#
+# The dictionary can be restricted to the ids of the arucos that are expected (given,
+# or learned from a sample of the images), which makes the identification of the
+# candidates cheaper and drops the arucos of other ids (false detections).
+#
+# When a worker detects several images in a row, the next images are read and
+# decoded by a background thread (OpenCV releases the GIL) while the arucos of
+# the current image are detected. The queue of decoded images is bounded, so the
+# memory does not grow with the number of images.
+import os
+import json
+import time
+import threading
+import multiprocessing
+import numpy as np
+import cv2
+import cv2.aruco as aruco  # Aruco Markers
+
+from imageSources import ImageReader
+from imageSources import readImage
+from imageSources import splitFrame
+from archiveSources import isArchived
+from archiveSources import sidecarFilename
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    processTime = time.process_time
+except AttributeError:  # python 2, time.clock is the processor time on unix
+    processTime = time.clock
+
+# Detector parameters tuned for a dataset, saved in its directory by tuneDetector.py
+DETECTOR_PROFILE = 'detector_parameters.json'
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+class ImageDetections:
+    """Arucos detected in one image
+        corners, ids, rvecs and tvecs as given by aruco.detectMarkers and
+        aruco.estimatePoseSingleMarkers (ids is None if there are no arucos), shape of
+        the image, the image itself (raw, if kept) and the wall / cpu time of each step.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.corners = []
+        self.ids = None
+        self.rvecs = None
+        self.tvecs = None
+        self.raw = None
+        self.shape = None
+        self.timings = []
+
+
+def detectorParameters(values=None):
+    """aruco.DetectorParameters with the given values (a dictionary) changed
+        DetectorParameters can not be pickled, so the workers get the dictionary.
+    """
+    parameters = aruco.DetectorParameters_create()
+    if values:
+        for name, value in values.items():
+            setattr(parameters, name, value)
+    return parameters
+
+
+def detectorProfileFilename(directory):
+    """Profile of the detector of a dataset: in its directory or next to its video or
+        archive
+    """
+    if isArchived(directory):
+        return sidecarFilename(directory, DETECTOR_PROFILE)
+    if os.path.isfile(directory):
+        return os.path.splitext(directory)[0] + '_' + DETECTOR_PROFILE
+    return os.path.join(directory, DETECTOR_PROFILE)
+
+
+def loadDetectorProfile(directory):
+    """Values of the DetectorParameters tuned for the dataset (see tuneDetector.py)
+        Returns None if the dataset has no profile.
+    """
+    filename = detectorProfileFilename(directory)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        parameters = json.load(f)['parameters']
+    return dict((str(name), value) for name, value in parameters.items())
+
+
+def arucoDictionary(dictionary):
+    """aruco.Dictionary used in the detection and the ids of its arucos (None if all)
+        dictionary is the id of a predefined dictionary or a pair (id, marker ids)
+        for the predefined dictionary restricted to those ids. Dictionaries can not be
+        pickled, so the workers get the id.
+    """
+    if isinstance(dictionary, tuple):
+        dictionary, marker_ids = dictionary
+        base = aruco.Dictionary_get(dictionary)
+        restricted = aruco.Dictionary_create(1, base.markerSize)
+        restricted.bytesList = base.bytesList[list(marker_ids)]
+        restricted.markerSize = base.markerSize
+        restricted.maxCorrectionBits = base.maxCorrectionBits
+        return restricted, np.array(marker_ids, dtype=np.int32)
+    return aruco.Dictionary_get(dictionary), None
+
+
+def detectMarkers(gray, dictionary, parameters):
+    """aruco.detectMarkers with the pair of arucoDictionary
+        The ids found with a restricted dictionary are mapped back to the marker ids.
+    """
+    dictionary, marker_ids = dictionary
+    corners, ids, rejected = aruco.detectMarkers(gray, dictionary, parameters=parameters)
+    if ids is not None and marker_ids is not None:
+        ids = marker_ids[ids]
+    return corners, ids, rejected
+
+
+def prefetchImages(filenames, grayscale=False, size=4):
+    """Yields (image, wall, cpu) for each filename, decoded in a background thread
+        The thread decodes the next images while the caller processes the current
+        one, keeping at most size decoded images waiting. wall is the time spent
+        decoding the image and cpu the processor time of the process meanwhile. An
+        error reading an image is raised to the caller when it gets to that image.
+    """
+    decoded = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def decode():
+        reader = ImageReader(grayscale)
+        try:
+            for filename in filenames:
+                if stop.is_set():
+                    return
+                wall, cpu = time.time(), processTime()
+                raw = reader.read(filename)
+                decoded.put((raw, time.time() - wall, processTime() - cpu))
+        except Exception as e:
+            # passed to the caller, which would otherwise wait for the image forever
+            decoded.put(e)
+        finally:
+            reader.close()
+
+    thread = threading.Thread(target=decode)
+    thread.daemon = True
+    thread.start()
+    try:
+        for _ in filenames:
+            loaded = decoded.get()
+            if isinstance(loaded, Exception):
+                raise loaded
+            yield loaded
+    finally:
+        # the consumer stopped early, unblock the thread
+        stop.set()
+        while thread.is_alive():
+            try:
+                decoded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def refineCorners(gray, corners, scale=1.0):
+    """Corners detected in the image downscaled by scale, refined in the full image
+        The corners are mapped to the full resolution and moved by cornerSubPix to the
+        nearest corner inside a window of the size of a pixel of the downscaled image
+        (at least), bounded by the size of the aruco.
+    """
+    if len(corners) == 0:
+        return list(corners)
+
+    # center of the pixel i of the downscaled image is (i + 0.5) / scale - 0.5
+    points = (np.concatenate(corners).reshape((-1, 2)).astype(np.float32) + 0.5) / scale - 0.5
+
+    # the window can not be larger than a quarter of the smallest side of the arucos
+    sides = np.linalg.norm(points.reshape((-1, 4, 2)) -
+                           np.roll(points.reshape((-1, 4, 2)), 1, axis=1), axis=2)
+    window = int(max(2, min(np.ceil(2.0 / scale), np.min(sides) / 4)))
+
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    points = points.reshape((-1, 1, 2))
+    cv2.cornerSubPix(gray, points, (window, window), (-1, -1), criteria)
+    return [corner.reshape((1, 4, 2)) for corner in points.reshape((-1, 4, 2))]
+
+
+def detectMultiScale(gray, dictionary, parameters, scale):
+    """Detects the arucos in the gray image downscaled by scale, refined in the full image
+        Arucos found in the downscaled image have their corners refined at full
+        resolution. The candidates that were rejected (usually small arucos whose bits
+        can not be read at low resolution) are detected again in a crop of the full
+        image around them. Returns corners and ids, as aruco.detectMarkers.
+    """
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    corners, ids, rejected = detectMarkers(small, dictionary, parameters)
+
+    corners = refineCorners(gray, corners if ids is not None else [], scale)
+    ids = [] if ids is None else ids.ravel().tolist()
+
+    boxes = [(c[0].min(axis=0), c[0].max(axis=0)) for c in corners]
+    for candidate in rejected:
+        points = (candidate.reshape((4, 2)) + 0.5) / scale - 0.5
+        center = points.mean(axis=0)
+        if any(np.all(center >= a) and np.all(center <= b) for a, b in boxes):
+            continue
+
+        # crop around the candidate, with a margin for the threshold windows
+        margin = 0.25 * (points.max(axis=0) - points.min(axis=0)) + 2.0 / scale
+        x0, y0 = np.maximum(0, np.floor(points.min(axis=0) - margin)).astype(int)
+        x1, y1 = np.ceil(points.max(axis=0) + margin).astype(int) + 1
+        crop = gray[y0:y1, x0:x1]
+
+        crop_corners, crop_ids, _ = detectMarkers(crop, dictionary, parameters)
+        if crop_ids is None:
+            continue
+
+        crop_corners = refineCorners(crop, crop_corners)
+        for corner, i in zip(crop_corners, crop_ids.ravel()):
+            corner = corner + np.array([x0, y0], dtype=np.float32)
+            corners.append(corner)
+            ids.append(i)
+            boxes.append((corner[0].min(axis=0), corner[0].max(axis=0)))
+
+    if not ids:
+        return [], None
+    return corners, np.array(ids, dtype=np.int32).reshape((-1, 1))
+
+
+def predictRegions(tracks, shape, margin=1.0):
+    """Regions (x0, y0, x1, y1) of the image where each tracked aruco should be
+        tracks maps the id of each aruco to its corners in the last images where it
+        was detected (the last one, and the one before if it was detected in the
+        previous image). The corners are predicted with a constant velocity, and the
+        region is their bounding box grown by margin times its size on each side.
+    """
+    regions = {}
+    for i, corners in tracks.items():
+        predicted = corners[-1]
+        if len(corners) > 1:
+            predicted = 2 * corners[-1] - corners[-2]
+
+        low, high = predicted.min(axis=0), predicted.max(axis=0)
+        grow = margin * (high - low) + 4
+        x0, y0 = np.maximum(0, np.floor(low - grow)).astype(int)
+        x1, y1 = np.minimum(np.array(shape[1::-1]), np.ceil(high + grow) + 1).astype(int)
+        if x1 > x0 and y1 > y0:
+            regions[i] = (x0, y0, x1, y1)
+    return regions
+
+
+def mergeRegions(regions):
+    """Merges the overlapping regions (x0, y0, x1, y1) until none overlap
+    """
+    merged = []
+    for region in sorted(regions):
+        region = list(region)
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            for other in merged:
+                if region[0] < other[2] and other[0] < region[2] and \
+                        region[1] < other[3] and other[1] < region[3]:
+                    merged.remove(other)
+                    region = [min(region[0], other[0]), min(region[1], other[1]),
+                              max(region[2], other[2]), max(region[3], other[3])]
+                    overlapping = True
+                    break
+        merged.append(region)
+    return merged
+
+
+def detectRegions(gray, dictionary, parameters, regions, scale=1.0):
+    """Detects the tracked arucos in their predicted regions of the gray image
+        Overlapping regions are merged and searched once. Returns corners and ids, as
+        aruco.detectMarkers, and the ids of the tracked arucos that were not found,
+        except those whose region touches the border of the image (they probably left
+        the image). As in detectMultiScale, the corners are refined with cornerSubPix
+        when scale is below 1.
+    """
+    corners, ids = [], []
+    for x0, y0, x1, y1 in mergeRegions(regions.values()):
+        crop = gray[y0:y1, x0:x1]
+        crop_corners, crop_ids, _ = detectMarkers(crop, dictionary, parameters)
+        if crop_ids is None:
+            continue
+
+        if scale < 1:
+            crop_corners = refineCorners(crop, crop_corners)
+        for corner, i in zip(crop_corners, crop_ids.ravel()):
+            corners.append(corner + np.array([x0, y0], dtype=np.float32))
+            ids.append(i)
+
+    height, width = gray.shape[0:2]
+    lost = [i for i, (x0, y0, x1, y1) in regions.items()
+            if i not in ids and x0 > 0 and y0 > 0 and x1 < width and y1 < height]
+    if not ids:
+        return [], None, lost
+    return corners, np.array(ids, dtype=np.int32).reshape((-1, 1)), lost
+
+
+def detectImage(job, regions=None, loaded=None):
+    """Reads one image and detects its arucos (the work of each worker)
+        preview in the job is 0 to drop the image after the detection, 1 to keep it and
+        2, 4 or 8 to keep it decoded at that fraction of its size. With regions (see
+        predictRegions), only the predicted regions are searched, unless a tracked
+        aruco is not found there. Then the whole image is searched and True is
+        returned with the image. loaded is the (image, wall, cpu) already decoded by
+        prefetchImages.
+    """
+    filename, dictionary, parameters, marksize, mtx, dist, preview, grayscale, scale = job
+
+    image = ImageDetections(filename)
+    searched = regions is None
+
+    if loaded is None:
+        wall, cpu = time.time(), processTime()
+        raw = readImage(filename, grayscale)
+        loaded = (raw, time.time() - wall, processTime() - cpu)
+    raw = loaded[0]
+    image.timings.append(('image_load',) + tuple(loaded[1:]))
+    image.shape = raw.shape
+
+    wall, cpu = time.time(), processTime()
+    if grayscale:
+        gray = raw
+    else:
+        gray = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+
+    if regions is not None:
+        image.corners, image.ids, lost = detectRegions(
+            gray, arucoDictionary(dictionary), detectorParameters(parameters), regions,
+            scale)
+        image.timings.append(('aruco_tracking', time.time() - wall, processTime() - cpu))
+        wall, cpu = time.time(), processTime()
+        searched = len(lost) > 0
+
+    # lists of ids and the corners beloning to each id
+    if searched and scale < 1:
+        image.corners, image.ids = detectMultiScale(
+            gray, arucoDictionary(dictionary), detectorParameters(parameters), scale)
+    elif searched:
+        image.corners, image.ids, _ = detectMarkers(
+            gray, arucoDictionary(dictionary), detectorParameters(parameters))
+    if searched:
+        image.timings.append(('aruco_detection', time.time() - wall, processTime() - cpu))
+
+    if image.ids is not None and len(image.ids) > 0:
+        # Estimate pose of each marker
+        wall, cpu = time.time(), processTime()
+        image.rvecs, image.tvecs, _ = aruco.estimatePoseSingleMarkers(
+            image.corners, marksize, mtx, dist)
+        image.timings.append(('pose_estimation', time.time() - wall, processTime() - cpu))
+
+    if preview == 1:
+        image.raw = raw
+    elif preview > 1 and splitFrame(filename)[1] is not None:
+        # frames of videos are already decoded
+        image.raw = cv2.resize(raw, None, fx=1.0 / preview, fy=1.0 / preview,
+                               interpolation=cv2.INTER_AREA)
+    elif preview > 1:
+        image.raw = readImage(filename, grayscale, preview)
+
+    if regions is not None:
+        return image, searched
+    return image
+
+
+def detectSequence(job):
+    """Detects the arucos of a run of consecutive images, tracking them
+        job is the job of detectImage with a list of filenames, followed by the number
+        of images between two searches of the whole image. The whole image is also
+        searched when a tracked aruco is lost or nothing is tracked. Arucos that come
+        into view are only found by the searches of the whole image.
+    """
+    filenames, dictionary, parameters, marksize, mtx, dist, preview, grayscale, scale, \
+        track = job
+    settings = (dictionary, parameters, marksize, mtx, dist, preview, grayscale, scale)
+
+    images = []
+    tracks = {}
+    since_search = 0
+    # enumerate, zip of python 2 would decode all the images before the first detection
+    for k, loaded in enumerate(prefetchImages(filenames, grayscale)):
+        filename = filenames[k]
+        if not tracks or since_search >= track:
+            image = detectImage((filename,) + settings, loaded=loaded)
+            searched = True
+        else:
+            image, searched = detectImage((filename,) + settings,
+                                          predictRegions(tracks, image.shape), loaded)
+        since_search = 1 if searched else since_search + 1
+
+        ids = [] if image.ids is None else image.ids.ravel().tolist()
+        tracks = dict((i, tracks.get(i, [])[-1:] + [corner.reshape((4, 2))])
+                      for i, corner in zip(ids, image.corners))
+        images.append(image)
+
+    return images
+
+
+def detectRun(jobs):
+    """Detects the images of the jobs of detectImage in order, prefetching the next ones
+    """
+    # all the jobs of a run have the same settings
+    filename, dictionary, parameters, marksize, mtx, dist, preview, grayscale, scale = jobs[0]
+    loaded = prefetchImages([job[0] for job in jobs], grayscale)
+    return [detectImage(jobs[k], loaded=image) for k, image in enumerate(loaded)]
+
+
+def sequenceRuns(indices, length):
+    """Splits the sorted indices in runs of consecutive indices of at most length
+    """
+    runs = []
+    for i in indices:
+        if runs and runs[-1][-1] == i - 1 and len(runs[-1]) < length:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+    return runs
+
+
+def initWorker():
+    # Each worker uses a single thread, the parallelism is between the images
+    cv2.setNumThreads(1)
+
+
+def detectArucos(filenames, dictionary, marksize, mtx, dist, parameters=None, workers=None,
+                 keep_images=True, cache=None, grayscale=False, scale=1.0, track=0, preview=1):
+    """Detects the arucos of all the images, with a pool of workers processes
+        dictionary is the id of the aruco dictionary (e.g. aruco.DICT_ARUCO_ORIGINAL),
+        or a pair (id, marker ids) to detect only those arucos, parameters a dictionary of values of the DetectorParameters and workers the
+        number of processes (all the cores by default, 1 for no pool). Returns a list
+        with the ImageDetections of each filename, in the same order. Without
+        keep_images the images are not sent back to the main process. With a
+        DetectionCache, only the images that are not in the cache are detected. With
+        grayscale the images are decoded directly to gray (slightly different from
+        the conversion of the color image), and only their gray version is kept.
+        With scale below 1, the arucos are detected in the image downscaled by scale and
+        their corners refined in the full image. With track above 0, the filenames are
+        a sequence and the arucos are tracked from image to image, the whole image
+        being searched every track images. With preview 2, 4 or 8, the kept images are
+        decoded at that fraction of their size.
+    """
+
+    images = [None] * len(filenames)
+    if cache is not None:
+        keys = cache.keys(filenames, dictionary, parameters, marksize, mtx, dist, grayscale,
+                          scale, track)
+        images = [cache.get(key, filename) for key, filename in zip(keys, filenames)]
+
+    missing = [i for i, image in enumerate(images) if image is None]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(missing)))
+
+    settings = (dictionary, parameters, marksize, np.asarray(mtx), np.asarray(dist),
+                preview if keep_images else 0, grayscale, scale)
+    if track > 0:
+        # Each job is a run of consecutive images, long enough to be tracked
+        length = max(track, int(np.ceil(len(missing) / float(workers))))
+        jobs = [([filenames[i] for i in run],) + settings + (track,)
+                for run in sequenceRuns(missing, length)]
+        work = detectSequence
+    else:
+        # Each job is a run of images, whose next images are prefetched by the worker.
+        # Several runs per worker, so that the workers finish at about the same time
+        length = len(missing) if workers == 1 else int(np.ceil(len(missing) / (4.0 * workers)))
+        jobs = [[(filenames[i],) + settings for i in run]
+                for run in sequenceRuns(missing, max(1, length))]
+        work = detectRun
+
+    if workers == 1:
+        detected = [work(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers, initializer=initWorker)
+        try:
+            # map keeps the order of the jobs
+            detected = pool.map(work, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    detected = [image for run in detected for image in run]
+
+    for i, image in zip(missing, detected):
+        images[i] = image
+        if cache is not None:
+            cache.put(keys[i], image)
+
+    # Cached detections do not have the image
+    if keep_images:
+        reader = ImageReader(grayscale, preview)
+        for image in images:
+            if image.raw is None:
+                image.raw = reader.read(image.filename)
+        reader.close()
+
+    return images
+
+
+def learnMarkerIds(filenames, dictionary, marksize, mtx, dist, n_images, **kwargs):
+    """Ids of the arucos detected in n_images images spread over the filenames
+        The images are detected with the whole dictionary, with the arguments of
+        detectArucos. Returns the pair (dictionary, ids) to detect only those arucos
+        (or the whole dictionary if there are no arucos in the images).
+    """
+    sample = np.unique(np.linspace(0, len(filenames) - 1, n_images).round().astype(int))
+    kwargs['keep_images'] = False
+    images = detectArucos([filenames[i] for i in sample], dictionary, marksize, mtx, dist,
+                          **kwargs)
+    ids = set()
+    for image in images:
+        if image.ids is not None:
+            ids.update(int(i) for i in image.ids.ravel())
+    if not ids:
+        return dictionary
+    return dictionary, tuple(sorted(ids))
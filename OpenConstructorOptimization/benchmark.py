@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Scaling benchmark of the optimization
+
+Generates synthetic scenes of increasing number of images (see syntheticScene.py),
+times each stage of the optimization (initial guess, sparsity, residuals, jacobian
+and the full solve) and saves the results to a JSON file.
+"""
+
+#-------------------------------------------------------------------------------
+#--- IMPORT MODULES
+#-------------------------------------------------------------------------------
+import time  # Estimate time of process
+import sys
+import argparse  # Read command line arguments
+import json
+import platform
+import numpy as np  # Arrays and opencv images
+import networkx as nx
+from scipy.optimize import least_squares  # Lib optimization
+
+#-------------------------------------------------------------------------------
+#--- DEFINITIONS
+#-------------------------------------------------------------------------------
+from myClasses import MyX
+from myClasses import MyCamera
+from myClasses import MyAruco
+from costFunctions import costFunction
+from costFunctions import jacobianFunction
+from costFunctions import sparsityMatrix
+from costFunctions import detectionErrors
+from bundleAdjustment import schurLevenbergMarquardt
+from initialGuess import sceneGraph
+from initialGuess import initialGuess
+from initialGuess import detectionCosts
+from initialGuess import centralNode
+from componentSolve import anchorBounds
+from rigidTransforms import invertTransforms
+from syntheticScene import syntheticScene
+from syntheticScene import arucoCorners
+
+STAGES = ['initial_guess', 'sparsity', 'residuals', 'jacobian', 'solve']
+
+#-------------------------------------------------------------------------------
+#--- MY FUNCTIONS
+#-------------------------------------------------------------------------------
+
+
+def perturbedX(X_true, sigma, seed):
+    """Copy of the ground truth X, with gaussian noise in all the parameters
+    """
+    rng = np.random.RandomState(seed)
+    X = MyX()
+    for camera in X_true.cameras:
+        T = camera.getT()
+        c = MyCamera(T=T, id=camera.id)
+        c.tvec += rng.normal(size=3) * sigma
+        c.rvec += rng.normal(size=3) * sigma
+        X.cameras.append(c)
+    for aruco in X_true.arucos:
+        a = MyAruco(T=aruco.getT(), id=aruco.id)
+        if aruco.id != '0':
+            a.tvec += rng.normal(size=3) * sigma
+            a.rvec += rng.normal(size=3) * sigma
+        X.arucos.append(a)
+    return X
+
+
+def nodeT(X, node):
+    """Transform of a node of the graph (camera 'C<k>' or aruco 'A<id>') in X, or None
+    """
+    objects = X.cameras if node[0] == 'C' else X.arucos
+    for obj in objects:
+        if obj.id == node[1:]:
+            return obj.getT()
+    return None
+
+
+def cameraPositionErrors(X, X_true, map_node):
+    """Distance (m) between the estimated and the true position of each camera of X
+        The cameras of X are moved to the frame of the ground truth first, through
+        aruco 0 or, when it was not detected, through the map node of X.
+    """
+    reference = 'A0' if nodeT(X, 'A0') is not None else map_node
+    T = np.dot(nodeT(X_true, reference), invertTransforms(nodeT(X, reference)))
+    true = dict((camera.id, camera.tvec) for camera in X_true.cameras)
+    return np.array([np.linalg.norm(np.dot(T, camera.getT())[0:3, 3] - true[camera.id].ravel())
+                     for camera in X.cameras])
+
+
+def runBenchmark(n_cameras, args):
+    """Times the stages of the optimization of a synthetic scene with n_cameras images
+    """
+
+    result = {'n_cameras': n_cameras}
+    options = {'option1': 'corners', 'option2': args['option2'], 'option3': 'fromaruco',
+               'residuals': args['residuals'], 'do': False}
+
+    t0 = time.time()
+    scene = syntheticScene(n_cameras, noise=args['noise'], visibility=args['visibility'],
+                           seed=args['seed'])
+    result['scene_seconds'] = time.time() - t0
+
+    detections = scene.detections
+    Pc = arucoCorners(scene.marksize)
+    fun_args = (scene.dist, scene.intrinsics, None, Pc, detections, options, [], None, None)
+
+    result['n_arucos'] = len(scene.X.arucos)
+    result['n_detections'] = len(detections)
+
+    # Initial guess, from the graph of detections or from the perturbed ground truth
+    t0 = time.time()
+    costs = None
+    if args['edgeWeights'] == 'quality':
+        costs = detectionCosts(detections, scene.intrinsics, scene.dist, scene.marksize)
+    GA = sceneGraph(detections, costs=costs)
+    result['connected'] = nx.is_connected(GA)
+    map_node = 'A0'
+    if 'initial_guess' in args['stages'] and result['connected'] and \
+            n_cameras <= args['maxInitialGuess']:
+        # A0 by default, the most central node with auto or when A0 was not detected
+        if args['mapNode'] == 'auto' or (args['mapNode'] is None and 'A0' not in GA.nodes):
+            map_node = centralNode(GA)
+        elif args['mapNode'] is not None:
+            map_node = args['mapNode']
+        X = initialGuess(GA, map_node, detections, MyX(), options, progress=False)
+        result['initial_guess_seconds'] = time.time() - t0
+    else:
+        seen_cameras = set(detections.cameras.tolist())
+        seen_arucos = set(detections.arucos.tolist())
+        X = perturbedX(scene.X, args['perturbation'], args['seed'])
+        X.cameras = [c for c in X.cameras if int(c.id) in seen_cameras]
+        X.arucos = [a for a in X.arucos if int(a.id) in seen_arucos]
+        if 0 not in seen_arucos:
+            # aruco 0 was not detected, the map is another node of the perturbed X
+            map_node = centralNode(GA)
+
+    result['map_node'] = map_node
+
+    X.toVector(options)
+    x0 = np.array(X.v, dtype=np.float64)
+    fun_args = fun_args[0:2] + (X,) + fun_args[3:]
+
+    result['n_parameters'] = len(x0)
+
+    costFunction.counter = 0
+    jacobianFunction.counter = 0
+
+    if 'sparsity' in args['stages']:
+        t0 = time.time()
+        A = sparsityMatrix(X, detections, Pc, options)
+        result['sparsity_seconds'] = time.time() - t0
+        result['n_residuals'] = A.shape[0]
+        result['sparsity_nnz'] = A.nnz
+
+    if 'residuals' in args['stages']:
+        t0 = time.time()
+        initial_residuals = costFunction(x0, *fun_args)
+        result['residuals_seconds'] = time.time() - t0
+        result['initial_error'] = float(np.mean(detectionErrors(initial_residuals, options)))
+
+    if 'jacobian' in args['stages']:
+        t0 = time.time()
+        jacobianFunction(x0, *fun_args)
+        result['jacobian_seconds'] = time.time() - t0
+
+    result['initial_position_error'] = float(np.mean(cameraPositionErrors(X, scene.X, map_node)))
+
+    if 'solve' in args['stages'] and n_cameras <= args['maxSolve']:
+        # The parameters of the map node are fixed
+        nvalues = 6 if options['option2'] == 'all' else 3
+        lb, ub = anchorBounds(X, map_node, x0, options)
+
+        costFunction.counter = 0
+        jacobianFunction.counter = 0
+        t0 = time.time()
+        if args['solver'] == 'schur':
+            res = schurLevenbergMarquardt(costFunction, jacobianFunction, x0, len(X.cameras), 6,
+                                          nvalues, bounds=(lb, ub), ftol=1e-4, xtol=1e-4,
+                                          args=fun_args)
+        else:
+            res = least_squares(costFunction, x0, jac=jacobianFunction,
+                                jac_sparsity=sparsityMatrix(X, detections, Pc, options),
+                                x_scale='jac', ftol=1e-4, xtol=1e-4, bounds=(lb, ub),
+                                method='trf', args=fun_args)
+        result['solve_seconds'] = time.time() - t0
+        result['solve_nfev'] = costFunction.counter
+        result['solve_njev'] = jacobianFunction.counter
+
+        X.fromVector(res.x, options)
+        result['final_error'] = float(np.mean(detectionErrors(res.fun, options)))
+        result['final_position_error'] = float(np.mean(cameraPositionErrors(X, scene.X, map_node)))
+
+    return result
+
+
+#-------------------------------------------------------------------------------
+#--- MAIN
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    #---------------------------------------
+    #--- Argument parser
+    #---------------------------------------
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-sizes", type=int, nargs='+', default=[10, 100, 1000, 10000],
+                    help="Number of images of the synthetic scenes", required=False)
+    ap.add_argument("-stages", choices=STAGES, nargs='+', default=STAGES,
+                    help="Stages to time (without initial_guess, the optimization starts from the perturbed ground truth)", required=False)
+    ap.add_argument("-maxInitialGuess", type=int, default=1000,
+                    help="Largest scene (number of images) for which the initial guess is timed", required=False)
+    ap.add_argument("-edgeWeights", choices=['quality', 'unit'], default='quality',
+                    help="Weights of the edges of the graph used for the initial guess", required=False)
+    ap.add_argument("-mapNode", metavar="NODE",
+                    help="Map node of the initial guess (default: A0), or auto: the most central aruco or camera", required=False)
+    ap.add_argument("-maxSolve", type=int, default=1000,
+                    help="Largest scene (number of images) for which the full solve is timed", required=False)
+    ap.add_argument("-option2", choices=['all', 'translation'], default='all',
+                    help="Optimize the translation and rotation of the arucos or only the translation", required=False)
+    ap.add_argument("-residuals", choices=['distance', 'coordinates'], default='coordinates',
+                    help="Residuals of the optimization", required=False)
+    ap.add_argument("-solver", choices=['trf', 'schur'], default='trf',
+                    help="Solver of the full optimization", required=False)
+    ap.add_argument("-noise", type=float, default=0.5,
+                    help="Standard deviation of the detected corners (pixels)", required=False)
+    ap.add_argument("-visibility", type=float, default=0.9,
+                    help="Probability of detecting an aruco inside the image", required=False)
+    ap.add_argument("-perturbation", type=float, default=0.01,
+                    help="Noise of the ground truth used as initial guess when initial_guess is not timed", required=False)
+    ap.add_argument("-seed", type=int, default=0,
+                    help="Seed of the synthetic scenes", required=False)
+    ap.add_argument("-o", metavar="output", default="benchmark.json",
+                    help="JSON file with the results", required=False)
+
+    args = vars(ap.parse_args())
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__,
+               'arguments': args, 'runs': []}
+
+    for n_cameras in args['sizes']:
+        print("Benchmark of a scene with " + str(n_cameras) + " images...")
+        result = runBenchmark(n_cameras, args)
+        results['runs'].append(result)
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+
+        # Saved after each size, so that slow sizes do not lose the previous results
+        with open(args['o'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    print("Results saved to " + args['o'])
@@ -0,0 +1,227 @@
+# Levenberg-Marquardt solver specialised for the camera/aruco block structure
+#
+# Every residual depends on exactly one camera block and one aruco block of the
+# vector x (cameras first, then arucos). The normal equations
+#
+#   [ U   W ] [dc]     [gc]
+#   [ W.T V ] [da] = - [ga]
+#
+# have a block diagonal V (one block per aruco), so the arucos are eliminated with
+# the Schur complement S = U - W * inv(V) * W.T and only the reduced camera system
+# S * dc = -gc + W * inv(V) * ga is solved, by sparse Cholesky or by conjugate
+# gradients with a block Jacobi preconditioner.
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import cg
+from scipy.sparse.linalg import LinearOperator
+from scipy.optimize import OptimizeResult
+
+try:
+    from sksparse.cholmod import cholesky  # optional, faster sparse Cholesky
+except ImportError:
+    cholesky = None
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def blockDiagonal(blocks):
+    """Sparse block diagonal matrix from a N x b x b array of blocks
+    """
+    n, b, _ = blocks.shape
+    rows = np.repeat(np.arange(n * b), b)
+    cols = (np.arange(n)[:, np.newaxis, np.newaxis] * b +
+            np.zeros((1, b, 1), dtype=int) + np.arange(b)).ravel()
+    return csr_matrix((blocks.ravel(), (rows, cols)), shape=(n * b, n * b))
+
+
+def diagonalBlocks(M, n, b):
+    """N x b x b array with the diagonal blocks of the (block diagonal) sparse matrix M
+    """
+    M = M.tocoo()
+    blocks = np.zeros((n, b, b))
+    inside = M.row // b == M.col // b
+    np.add.at(blocks, (M.row[inside] // b, M.row[inside] % b, M.col[inside] % b),
+              M.data[inside])
+    return blocks
+
+
+def solveReducedSystem(S, rhs, camera_size, linear_solver, cg_tol):
+    """Solves the reduced camera system S * dc = rhs
+    """
+
+    if linear_solver == 'cg':
+        # Block Jacobi preconditioner, the inverse of the 6x6 blocks of each camera
+        n = S.shape[0] // camera_size
+        Pinv = blockDiagonal(np.linalg.inv(diagonalBlocks(S, n, camera_size)))
+        M = LinearOperator(S.shape, matvec=Pinv.dot)
+        try:
+            dc, _ = cg(S, rhs, rtol=cg_tol, M=M)
+        except TypeError:  # older scipy
+            dc, _ = cg(S, rhs, tol=cg_tol, M=M)
+        return dc
+
+    if cholesky is not None:
+        return cholesky(S.tocsc())(rhs)
+
+    return spsolve(S.tocsc(), rhs)
+
+
+def schurLevenbergMarquardt(fun, jac, x0, n_cameras, camera_size=6, aruco_size=6,
+                            bounds=None, ftol=1e-8, xtol=1e-8, gtol=1e-8, max_nfev=None,
+                            linear_solver='cholesky', cg_tol=1e-6, verbose=0, args=()):
+    """Minimizes 0.5 * sum(fun(x)**2) by Levenberg-Marquardt with a Schur complement
+        fun and jac are called as in scipy.optimize.least_squares (jac returns a
+        sparse matrix), x0 has n_cameras blocks of camera_size values followed by the
+        blocks of aruco_size values of the arucos. Parameters with finite bounds are
+        kept fixed at their value in x0 (bounds are used to anchor the map). The
+        reduced camera system is solved by sparse Cholesky (linear_solver='cholesky',
+        with scikit-sparse if available) or by preconditioned CG ('cg'). Returns a
+        scipy.optimize.OptimizeResult, as least_squares does.
+    """
+
+    x = np.array(x0, dtype=np.float64)
+    n = len(x)
+    nc = n_cameras * camera_size
+    n_arucos = (n - nc) // aruco_size
+
+    if max_nfev is None:
+        max_nfev = 100 * n
+
+    # Parameters that do not move
+    free = np.ones(n)
+    if bounds is not None:
+        lb = np.broadcast_to(np.asarray(bounds[0], dtype=np.float64), (n,))
+        ub = np.broadcast_to(np.asarray(bounds[1], dtype=np.float64), (n,))
+        free[np.isfinite(lb) | np.isfinite(ub)] = 0.0
+    Free = csr_matrix((free, (np.arange(n), np.arange(n))), shape=(n, n))
+
+    f = np.asarray(fun(x, *args), dtype=np.float64)
+    cost = 0.5 * np.dot(f, f)
+    initial_cost = cost
+    nfev = 1
+    njev = 0
+
+    mu = 1e-3  # damping, relative to the diagonal of J.T * J
+    nu = 2.0
+    status = None
+    step_norm = None
+    cost_reduction = None
+    iteration = 0
+
+    if verbose == 2:
+        print("{0:^15}{1:^15}{2:^15}{3:^15}{4:^15}{5:^15}".format(
+            "Iteration", "Total nfev", "Cost", "Cost reduction", "Step norm", "Optimality"))
+
+    while True:
+        J = (jac(x, *args) * Free).tocsr()
+        njev += 1
+
+        g = J.T.dot(f)
+        optimality = np.max(np.abs(g)) if n else 0.0
+
+        if verbose == 2:
+            print("{0:^15}{1:^15}{2:^15.4e}{3:^15}{4:^15}{5:^15.2e}".format(
+                iteration, nfev, cost,
+                "" if cost_reduction is None else "{0:.2e}".format(cost_reduction),
+                "" if step_norm is None else "{0:.2e}".format(step_norm), optimality))
+
+        if status is not None:
+            break
+
+        if optimality < gtol:
+            status = 1
+            break
+
+        Jc = J[:, 0:nc]
+        Ja = J[:, nc:]
+
+        U = diagonalBlocks(Jc.T.dot(Jc), n_cameras, camera_size)
+        V = diagonalBlocks(Ja.T.dot(Ja), n_arucos, aruco_size)
+        W = Jc.T.dot(Ja).tocsr()
+        gc = g[0:nc]
+        ga = g[nc:]
+
+        # Fixed (or unobserved) parameters get a unit diagonal, so that their step is 0
+        diag_U = np.diagonal(U, axis1=1, axis2=2).copy()
+        diag_V = np.diagonal(V, axis1=1, axis2=2).copy()
+        diag_U[diag_U <= 0] = 1.0
+        diag_V[diag_V <= 0] = 1.0
+
+        accepted = False
+        while not accepted:
+            # Damped blocks (Marquardt scaling)
+            Ud = U + mu * diag_U[:, :, np.newaxis] * np.eye(camera_size)
+            Vd = V + mu * diag_V[:, :, np.newaxis] * np.eye(aruco_size)
+
+            Vinv = blockDiagonal(np.linalg.inv(Vd))
+            WVinv = W.dot(Vinv)
+
+            S = (blockDiagonal(Ud) - WVinv.dot(W.T)).tocsr()
+            rhs = -gc + WVinv.dot(ga)
+
+            dc = solveReducedSystem(S, rhs, camera_size, linear_solver, cg_tol)
+            da = Vinv.dot(-ga - W.T.dot(dc))
+            dx = np.concatenate((dc, da)) * free
+            step_norm = np.linalg.norm(dx)
+
+            x_new = x + dx
+            f_new = np.asarray(fun(x_new, *args), dtype=np.float64)
+            nfev += 1
+            cost_new = 0.5 * np.dot(f_new, f_new)
+
+            # Gain ratio between the actual and the predicted (linear model) reduction
+            Jdx = J.dot(dx)
+            predicted = -(np.dot(g, dx) + 0.5 * np.dot(Jdx, Jdx))
+            actual = cost - cost_new
+            rho = actual / predicted if predicted > 0 else -1.0
+
+            if rho > 0 and np.isfinite(cost_new):
+                accepted = True
+                mu = mu * max(1 / 3.0, 1 - (2 * rho - 1)**3)
+                nu = 2.0
+            else:
+                mu = mu * nu
+                nu = 2 * nu
+
+            small_step = step_norm < xtol * (xtol + np.linalg.norm(x))
+            if not accepted and (small_step or nfev >= max_nfev):
+                break
+
+        cost_reduction = 0.0
+        if accepted:
+            cost_reduction = actual
+            x = x_new
+            f = f_new
+            cost = cost_new
+
+        iteration += 1
+
+        ftol_satisfied = accepted and cost_reduction < ftol * (cost + cost_reduction)
+        xtol_satisfied = small_step
+
+        if ftol_satisfied and xtol_satisfied:
+            status = 4
+        elif ftol_satisfied:
+            status = 2
+        elif xtol_satisfied:
+            status = 3
+        elif nfev >= max_nfev:
+            status = 0
+
+    messages = {0: "The maximum number of function evaluations is exceeded.",
+                1: "`gtol` termination condition is satisfied.",
+                2: "`ftol` termination condition is satisfied.",
+                3: "`xtol` termination condition is satisfied.",
+                4: "Both `ftol` and `xtol` termination conditions are satisfied."}
+
+    if verbose >= 1:
+        print(messages[status])
+        print("Function evaluations {0}, initial cost {1:.4e}, final cost {2:.4e}, "
+              "first-order optimality {3:.2e}.".format(nfev, initial_cost, cost, optimality))
+
+    return OptimizeResult(x=x, cost=cost, fun=f, jac=J, grad=g, optimality=optimality,
+                          active_mask=np.zeros(n, dtype=int), nfev=nfev, njev=njev,
+                          status=status, message=messages[status], success=status > 0)
@@ -0,0 +1,167 @@
+# Calibration of the connected components of the graph of detections
+#
+# When some images share no aruco with the others, the graph of detections splits in
+# connected components, whose cameras and arucos can not be placed in a common frame.
+# Each component is then a separate problem, with its own anchor (the map node if the
+# component has it, or else its most central aruco or camera), initial guess and
+# solve. The components are independent, so they are solved in parallel by a pool of
+# processes, the largest first.
+import time
+import multiprocessing
+import numpy as np
+import networkx as nx
+from scipy.optimize import least_squares  # Lib optimization
+
+from myClasses import MyX
+from initialGuess import initialGuess
+from initialGuess import centralNode
+from costFunctions import costFunction
+from costFunctions import jacobianFunction
+from costFunctions import sparsityMatrix
+from costFunctions import detectionErrors
+from bundleAdjustment import schurLevenbergMarquardt
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def splitComponents(GA, detections, map_node=None, cameras=True):
+    """Connected components of the graph, largest (in detections) first
+        Returns a list of (graph, detections, anchor) of each component. The anchor is
+        map_node if the component has it, or else its most central aruco (or camera, if
+        cameras, see centralNode). It is None if the component has no aruco.
+    """
+    components = []
+    for nodes in nx.connected_components(GA):
+        camera_ids = [int(node[1:]) for node in nodes if node[0] == 'C']
+        aruco_ids = [int(node[1:]) for node in nodes if node[0] == 'A']
+        rows = np.in1d(detections.cameras, camera_ids) & np.in1d(detections.arucos, aruco_ids)
+        subgraph = GA.subgraph(nodes).copy()
+
+        if map_node in nodes:
+            anchor = map_node
+        elif aruco_ids:
+            anchor = centralNode(subgraph, cameras)
+        else:
+            anchor = None
+
+        components.append((subgraph, detections.subset(rows), anchor))
+
+    components.sort(key=lambda component: len(component[1]), reverse=True)
+    return components
+
+
+def anchorBounds(X, anchor, x0, args, delta=1e-7):
+    """Bounds of the solvers that fix the parameters of the anchor (a camera or aruco)
+    """
+    nvalues = 6 if args['option2'] == 'all' else 3
+    lb = np.full(len(x0), -np.inf)
+    ub = np.full(len(x0), np.inf)
+
+    if anchor[0] == 'C':
+        idx = 6 * [camera.id for camera in X.cameras].index(anchor[1:])
+        size = 6
+    else:
+        idx = 6 * len(X.cameras) + nvalues * [aruco.id for aruco in X.arucos].index(anchor[1:])
+        size = nvalues
+    lb[idx:idx + size] = x0[idx:idx + size] - delta
+    ub[idx:idx + size] = x0[idx:idx + size] + delta
+    return lb, ub
+
+
+def solveComponent(job):
+    """Initial guess and solve of one component
+        job is (index, graph, detections, anchor, dist, intrinsics, Pc, args). Returns a
+        dictionary with the size of the component, its errors before and after the
+        solve, the evaluations of the cost function and the solved transforms (to the
+        frame of the anchor) of its cameras and arucos.
+    """
+    index, GA, detections, anchor, dist, intrinsics, Pc, args = job
+    t0 = time.time()
+
+    X = initialGuess(GA, anchor, detections, MyX(), args, progress=False,
+                     max_paths=args['maxPaths'])
+    X.toVector(args)
+    x0 = np.array(X.v, dtype=np.float64)
+
+    costFunction.counter = 0
+    jacobianFunction.counter = 0
+
+    fun_args = (dist, intrinsics, X, Pc, detections, args, [], None, None)
+    initial_residuals = detectionErrors(costFunction(x0, *fun_args), args)
+
+    lb, ub = anchorBounds(X, anchor, x0, args)
+    nvalues = 6 if args['option2'] == 'all' else 3
+
+    costFunction.counter = 0
+    if args['solver'] == 'schur':
+        res = schurLevenbergMarquardt(costFunction, jacobianFunction, x0, len(X.cameras), 6,
+                                      nvalues, bounds=(lb, ub), ftol=1e-4, xtol=1e-4,
+                                      linear_solver=args['linearSolver'], args=fun_args)
+    else:
+        res = least_squares(costFunction, x0, jac=jacobianFunction,
+                            jac_sparsity=sparsityMatrix(X, detections, Pc, args),
+                            x_scale='jac', ftol=1e-4, xtol=1e-4, bounds=(lb, ub),
+                            method='trf', args=fun_args)
+
+    X.fromVector(res.x, args)
+    solution_residuals = detectionErrors(costFunction(res.x, *fun_args), args)
+
+    return {'component': index,
+            'anchor': anchor,
+            'n_cameras': len(X.cameras),
+            'n_arucos': len(X.arucos),
+            'n_detections': len(detections),
+            'initial_error': float(np.average(initial_residuals)),
+            'solution_error': float(np.average(solution_residuals)),
+            'nfev': costFunction.counter,
+            'njev': jacobianFunction.counter,
+            'seconds': time.time() - t0,
+            'cameras': dict((camera.id, camera.getT()) for camera in X.cameras),
+            'arucos': dict((aruco.id, aruco.getT()) for aruco in X.arucos)}
+
+
+def solveComponents(components, dist, intrinsics, Pc, args, workers=None):
+    """Solves the components with an anchor, with a pool of workers processes
+        Returns the results of solveComponent, in the order of the components.
+    """
+    jobs = [(index, GA, detections, anchor, dist, intrinsics, Pc, args)
+            for index, (GA, detections, anchor) in enumerate(components) if anchor is not None]
+    if not jobs:
+        return []
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1:
+        return [solveComponent(job) for job in jobs]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # map keeps the order of the jobs, the largest components are started first
+        return pool.map(solveComponent, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def printComponents(components, results):
+    """Table with the results of each component
+    """
+    print("\n{0:>9}{1:>8}{2:>9}{3:>8}{4:>12}{5:>14}{6:>14}{7:>8}{8:>10}".format(
+        "Component", "Anchor", "Cameras", "Arucos", "Detections", "Initial error",
+        "Final error", "nfev", "Time (s)"))
+    solved = dict((result['component'], result) for result in results)
+    for index, (GA, detections, anchor) in enumerate(components):
+        if index not in solved:
+            print("{0:>9}{1:>8}{2:>9}{3:>8}{4:>12}   no aruco to anchor it, not solved".format(
+                index, '-', len([n for n in GA.nodes if n[0] == 'C']),
+                len([n for n in GA.nodes if n[0] == 'A']), len(detections)))
+            continue
+        result = solved[index]
+        print("{0:>9}{1:>8}{2:>9}{3:>8}{4:>12}{5:>14.4f}{6:>14.4f}{7:>8}{8:>10.2f}".format(
+            index, result['anchor'], result['n_cameras'], result['n_arucos'],
+            result['n_detections'], result['initial_error'], result['solution_error'],
+            result['nfev'], result['seconds']))
@@ -1,11 +1,11 @@
 import numpy as np
-from numpy.linalg import inv
-import matplotlib.pyplot as plt
-import random
-import cv2
+from scipy.sparse import csr_matrix
 
-from transformations import random_quaternion
-from transformations import quaternion_slerp
+from rigidTransforms import skewMatrices
+from rigidTransforms import rodriguesRightJacobians
+from rigidTransforms import invertTransforms
+from rigidTransforms import composeTransforms
+from rigidTransforms import transformsFromVectors
 
 #-------------------------------------------------------------------------------
 #--- FUNCTION DEFINITION
@@ -13,51 +13,56 @@ from transformations import quaternion_slerp
 
 
 ##
-# @brief Averages a list of transformations
+# @brief Averages stacks of transformations, in closed form
 #
-# @param lT a list of transforms, each defined by a tuple ( (tx, ty, tz), (qw, qx, qy, qz) )
+# The translations are averaged linearly and the rotations with the eigenvector method
+# of Markley: the mean quaternion is the eigenvector of the largest eigenvalue of the
+# weighted sum of q * q.T, which does not depend on the sign of each q nor on the order
+# of the transforms. Each of the leading dimensions ... is averaged independently, so
+# the transforms of many nodes are averaged in a single call.
 #
-# @return the averaged transform, a tuple ( (tx,ty,tz), (qw, qx, qy, qz) )
-def averageTransforms(l_transforms):
-    N = len(l_transforms)
-    print("Computing the average of " + str(N) + " transforms")
-
-    # Get a list of all the translations l_t
-    l_t = [i[0] for i in l_transforms]
-    # print(l_t)
-
-    # compute the average translation
-    tmp1 = sum(v[0] for v in l_t) / N
-    tmp2 = sum(v[1] for v in l_t) / N
-    tmp3 = sum(v[2] for v in l_t) / N
-    avg_t = (tmp1, tmp2, tmp3)
-    # print(avg_t)
-
-    # Get a list of the rotation quaternions
-    l_q = [i[1] for i in l_transforms]
-    #print l_q
-
-    # Average the quaterions using an incremental slerp approach
-    acc = 1.0  # accumulator, counts the number of observations inserted already
-    avg_q = random_quaternion()  # can be random for start, since it will not be used
-    for q in l_q:
-        # How to deduce the ratio on each iteration
-        # w_q = 1 / (acc + 1)
-        # w_qavg = acc  / (acc + 1)
-        # ratio = w_q / w_qavg <=> 1 / acc
-        avg_q = quaternion_slerp(avg_q, q, 1.0/acc)  # run pairwise slerp
-        acc = acc + 1  # increment acc
-
-    avg_q = tuple(avg_q)
-    # print(avg_q)
-
-    return (avg_t, avg_q)
+# @param translations a ... x P x 3 array with the translations of P transforms
+# @param quaternions a ... x P x 4 array with their rotations (qw, qx, qy, qz)
+# @param weights optional ... x P array with the (non negative) weight of each transform
+#
+# @return the averaged transforms, a tuple with the ... x 3 translations and the ... x 4
+#         unit quaternions (with qw >= 0)
+def averageTransforms(translations, quaternions, weights=None):
+    translations = np.asarray(translations, dtype=np.float64)
+    quaternions = np.asarray(quaternions, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(quaternions.shape[:-1])
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights / np.sum(weights, axis=-1)[..., np.newaxis]
+
+    avg_t = np.einsum('...p,...pi->...i', weights, translations)
+
+    M = np.einsum('...p,...pi,...pj->...ij', weights, quaternions, quaternions)
+    _, V = np.linalg.eigh(M)
+    avg_q = V[..., :, -1]
+    avg_q = avg_q * np.where(avg_q[..., 0:1] < 0, -1.0, 1.0)
+
+    return avg_t, avg_q
+
+
+def points2imageFromTs(Ts, K, P, dist):
+    """Projection of points to the image for a stack of transformations
+        Projects the points P (defined in the aruco referential) with each one of the
+        D camera-from-aruco transforms Ts (D x 4 x 4) in a single pass. Returns the
+        D x P x 2 array of pixel coordinates.
+    """
 
+    P = np.asarray(P, dtype=np.float64)[:, 0:3]
 
-def points2imageFromT(T, K, P, dist):
+    # Points in the camera referential (D x P x 3)
+    xyz = np.einsum('dij,pj->dpi', Ts[:, 0:3, 0:3], P) + Ts[:, np.newaxis, 0:3, 3]
 
-    # Calculation of the point in the image in relation to the chess reference
-    xypix = []
+    return pointsInCamera2image(xyz, K, dist)
+
+
+def pointsInCamera2image(xyz, K, dist):
+    """Projection to the image of a ... x 3 array of points in the camera referential
+    """
 
     fx = K[0, 0]
     fy = K[1, 1]
@@ -70,29 +75,94 @@ def points2imageFromT(T, K, P, dist):
     p2 = dist[0, 3]
     k3 = dist[0, 4]
 
-    P = P[:, 0:3]
+    xl = xyz[..., 0] / xyz[..., 2]
+    yl = xyz[..., 1] / xyz[..., 2]
+
+    r_square = xl**2 + yl**2
+    radial = 1 + k1 * r_square + k2 * r_square**2 + k3 * r_square**3
+
+    xll = xl * radial + 2 * p1 * xl * yl + p2 * (r_square + 2 * xl**2)
+    yll = yl * radial + p1 * (r_square + 2 * yl**2) + 2 * p2 * xl * yl
+
+    xypix = np.empty(xyz.shape[:-1] + (2,))
+    xypix[..., 0] = fx * xll + cx
+    xypix[..., 1] = fy * yll + cy
+
+    return xypix
+
+
+def points2imageFromT(T, K, P, dist):
+    """Projection of points to the image for a single transformation
+    """
+    return points2imageFromTs(np.asarray(T)[np.newaxis], K, P, dist)[0]
+
+
+def residualsPerDetection(Pc, args):
+    """Number of residuals of each detection
+        One distance per detection, or the (du, dv) differences of each one of the
+        points Pc in the coordinates mode.
+    """
+    if args['residuals'] == 'coordinates':
+        return 2 * len(Pc)
+    else:
+        return 1
+
+
+def residualsFromProjections(xypix, corners, args):
+    """Residuals between projected and detected points of each detection
+        xypix is the D x P x 2 array of projections and corners the D x 4 x 2 array
+        of detected corners. In the distance mode there is a residual per detection,
+        the distance in pixels; in the coordinates mode there are 2 * P signed
+        residuals per detection, (du, dv) of each point, detection after detection.
+    """
+
+    if args['residuals'] == 'coordinates':
+        if args['option1'] == 'corners':
+            return (xypix - corners).ravel()
+        else:
+            center = np.mean(corners, axis=1, dtype=np.float64)
+            return (xypix[:, 0, :] - center).ravel()
 
-    for p in P:
+    if args['option1'] == 'corners':
+        # Sum of the distances of the four corners
+        return np.sum(np.sqrt(np.sum((corners - xypix)**2, axis=2)), axis=1)
+    else:
+        # Distance of the center of the aruco
+        center = np.mean(corners, axis=1, dtype=np.float64)
+        return np.sqrt(np.sum((center - xypix[:, 0, :])**2, axis=1))
 
-        rot = np.matrix(T[0: 3, 0: 3])
-        xyz = rot.dot(p) + T[0: 3, 3]
 
-        xl = xyz[0, 0] / xyz[0, 2]
-        yl = xyz[0, 1] / xyz[0, 2]
+def detectionErrors(residuals, args):
+    """Distance in pixels of each detection (as in the distance mode) from the residuals
+    """
 
-        r_square = xl**2 + yl**2
+    if args['residuals'] != 'coordinates':
+        return residuals
+
+    if args['option1'] == 'corners':
+        diff = np.reshape(residuals, (-1, 4, 2))
+    else:
+        diff = np.reshape(residuals, (-1, 1, 2))
+    return np.sum(np.sqrt(np.sum(diff**2, axis=2)), axis=1)
+
+
+def projectDetections(X, detections, intrinsics, Pc, dist):
+    """Projection of the points Pc of the aruco of each detection to its camera
+        Uses the current transforms of the cameras and arucos in X, returns the
+        D x P x 2 array of pixel coordinates.
+    """
 
-        xll = xl * (1 + k1 * r_square + k2 * r_square**2 + k3 *
-                    r_square**3) + 2 * p1 * xl * yl + p2 * (r_square + 2 * xl**2)
-        yll = yl * (1 + k1 * r_square + k2 * r_square**2 + k3 *
-                    r_square**3) + p1 * (r_square + 2 * yl**2) + 2 * p2 * xl * yl
+    # Camera and aruco of each detection (indexes in X)
+    idxs_cameras, idxs_arucos = detections.idxsInX(X)
 
-        u = fx * xll + cx
-        v = fy * yll + cy
+    # Each camera and aruco transform (and camera inverse) is computed only once
+    Tcs, Tas = X.getTs()
 
-        xypix.append([u, v])
+    # Transforms from the aruco to the camera of all detections
+    Ts = composeTransforms(invertTransforms(Tcs)[idxs_cameras],
+                           Tas[idxs_arucos])
 
-    return np.array(xypix)
+    return points2imageFromTs(Ts, intrinsics, Pc, dist)
 
 
 def costFunction(x, dist, intrinsics, X, Pc, detections, args, handles, handle_fun, s):
@@ -100,79 +170,296 @@ def costFunction(x, dist, intrinsics, X, Pc, detections, args, handles, handle_f
     """
 
     # Updates the transformations from the cameras and the arucos to the map defined in the X class using the x optimized vector
-    X.fromVector(list(x), args)
-    width, height, _ = s[0].raw.shape
+    X.fromVector(x, args)
 
     # Cost calculation
-    cost = []
     costFunction.counter += 1
     # print costFunction.counter
     multiples = [100*n for n in range(1, 100+1)]
 
-    if not handles:
-        handles = detections
+    xypix = projectDetections(X, detections, intrinsics, Pc, dist)
 
-    for detection, handle in zip(detections, handles):
-        camera = [camera for camera in X.cameras if camera.id ==
-                  detection.camera[1:]][0]
+    cost = residualsFromProjections(xypix, detections.corners, args)
 
-        aruco = [aruco for aruco in X.arucos if aruco.id ==
-                 detection.aruco[1:]][0]
+    if args['do'] and costFunction.counter in multiples:
+        import matplotlib.pyplot as plt  # only when drawing (not in headless runs)
+        if handle_fun:
+            handle_fun.set_ydata(detectionErrors(cost, args))
+        plt.draw()
+        plt.pause(0.01)
 
-        Ta = aruco.getT()
-        Tc = camera.getT()
-        T = np.matmul(inv(Tc), Ta)
+    return cost
 
-        xypix = points2imageFromT(T, intrinsics, Pc, dist)
 
-        distanceFourPoints = 0
+class IncrementalCostFunction:
+    """Cost function that only recomputes the detections affected by a change of x
+        Called as costFunction. The residuals, the camera inverses and the aruco
+        transforms of the last full evaluation are kept as reference. A column group of
+        a finite differences jacobian with jac_sparsity changes at most one parameter
+        of each camera / aruco block, so when only a fraction of x differs from the
+        reference, just the detections of the changed cameras and arucos are projected
+        again. Otherwise (a new step of the optimization) all the detections are
+        evaluated and become the new reference.
+    """
 
-        if args['option1'] == 'corners':
-            for i in range(len(xypix)):
+    def __init__(self, max_fraction=0.5):
+        self.max_fraction = max_fraction  # above this fraction of changed parameters, full evaluation
+        self.counter = 0
+        self.full_evaluations = 0
+        self.recomputed = 0  # detections projected in incremental evaluations
+        self.x = None
+        self.cost = None
+        self.Tcs_inv = None
+        self.Tas = None
+
+    def __call__(self, x, dist, intrinsics, X, Pc, detections, args, handles, handle_fun, s):
+
+        X.fromVector(x, args)
+        self.counter += 1
+
+        idxs_cameras, idxs_arucos = detections.idxsInX(X)
+
+        if self.x is not None and self.x.shape == x.shape:
+            changed = x != self.x
+
+            if not np.any(changed):
+                return self.cost.copy()
+
+            if np.count_nonzero(changed) <= self.max_fraction * len(x):
+                if args['option2'] == 'all':
+                    nvalues = 6
+                else:
+                    nvalues = 3
+                nc = len(X.cameras) * 6
+                cameras = np.any(changed[0:nc].reshape((-1, 6)), axis=1)
+                arucos = np.any(changed[nc:].reshape((-1, nvalues)), axis=1)
+                affected = np.flatnonzero(cameras[idxs_cameras] | arucos[idxs_arucos])
+                self.recomputed += len(affected)
+
+                # Reference transforms, with the changed cameras and arucos updated
+                Tcs_inv = self.Tcs_inv.copy()
+                Tas = self.Tas.copy()
+                Tcs_inv[cameras] = invertTransforms(transformsFromVectors(
+                    X.tvecs_cameras[cameras], X.rvecs_cameras[cameras]))
+                Tas[arucos] = transformsFromVectors(X.tvecs_arucos[arucos],
+                                                    X.rvecs_arucos[arucos])
+
+                Ts = composeTransforms(Tcs_inv[idxs_cameras[affected]],
+                                       Tas[idxs_arucos[affected]])
+                xypix = points2imageFromTs(Ts, intrinsics, Pc, dist)
+
+                n_residuals = residualsPerDetection(Pc, args)
+                cost = self.cost.copy()
+                cost.reshape((len(detections), n_residuals))[affected] = np.reshape(
+                    residualsFromProjections(xypix, detections.corners[affected], args),
+                    (len(affected), n_residuals))
+                return cost
+
+        # Full evaluation, the new reference
+        self.full_evaluations += 1
+        Tcs, Tas = X.getTs()
+        self.x = np.array(x, dtype=np.float64)
+        self.Tcs_inv = invertTransforms(Tcs)
+        self.Tas = Tas
+
+        Ts = composeTransforms(self.Tcs_inv[idxs_cameras], Tas[idxs_arucos])
+        xypix = points2imageFromTs(Ts, intrinsics, Pc, dist)
+        self.cost = residualsFromProjections(xypix, detections.corners, args)
+
+        if args['do'] and self.full_evaluations % 100 == 0:
+            import matplotlib.pyplot as plt  # only when drawing (not in headless runs)
+            if handle_fun:
+                handle_fun.set_ydata(detectionErrors(self.cost, args))
+            plt.draw()
+            plt.pause(0.01)
+
+        return self.cost.copy()
+
+
+def points2imageJacobians(xyz, K, dist):
+    """Derivatives of the pixel coordinates with respect to the points in the camera referential
+        xyz is a ... x 3 array of points, returns the ... x 2 x 3 array of derivatives
+        of (u, v) with respect to (x, y, z), including the distortion model.
+    """
 
-                distance = ((detection.corner[0][i, 0] - xypix[i, 0]
-                             ) ** 2 + (detection.corner[0][i, 1] - xypix[i, 1])**2) ** (1/2.0)
+    fx = K[0, 0]
+    fy = K[1, 1]
 
-                distanceFourPoints = distanceFourPoints + distance
-        else:
-            xcm = (detection.corner[0][0, 0] + detection.corner[0][1, 0] +
-                   detection.corner[0][2, 0] + detection.corner[0][3, 0])/4
-            ycm = (detection.corner[0][0, 1] + detection.corner[0][1, 1] +
-                   detection.corner[0][2, 1] + detection.corner[0][3, 1])/4
+    k1 = dist[0, 0]
+    k2 = dist[0, 1]
+    p1 = dist[0, 2]
+    p2 = dist[0, 3]
+    k3 = dist[0, 4]
 
-            distanceFourPoints = (
-                (xcm - xypix[0, 0]) ** 2 + (ycm - xypix[0, 1]) ** 2) ** (1/2.0)
+    x = xyz[..., 0]
+    y = xyz[..., 1]
+    z = xyz[..., 2]
 
-        cost.append(distanceFourPoints)
+    xl = x / z
+    yl = y / z
 
-        # if np.isnan(distanceFourPoints):
-        #     print "xcm = " + str(xcm)
-        #     print "ycm = " + str(ycm)
+    r_square = xl**2 + yl**2
+    radial = 1 + k1 * r_square + k2 * r_square**2 + k3 * r_square**3
+    dradial = k1 + 2 * k2 * r_square + 3 * k3 * r_square**2
 
-        # if args['do'] and costFunction.counter in multiples:
+    # Derivatives of the distorted coordinates (xll, yll) with respect to (xl, yl)
+    dxll_dxl = radial + 2 * xl**2 * dradial + 2 * p1 * yl + 6 * p2 * xl
+    dxll_dyl = 2 * xl * yl * dradial + 2 * p1 * xl + 2 * p2 * yl
+    dyll_dxl = 2 * xl * yl * dradial + 2 * p1 * xl + 2 * p2 * yl
+    dyll_dyl = radial + 2 * yl**2 * dradial + 6 * p1 * yl + 2 * p2 * xl
 
-        #     # draw
-        #     k = int(camera.id)
-        #     if args['option1'] == 'corners':
-        #         for i in range(4):
-        #             if 0 < xypix[i][0] < height and 0 < xypix[i][1] < width:
-        #                 cv2.circle(s[k].raw, (int(xypix[i][0]), int(xypix[i][1])),
-        #                            5, (230, 250, 100), -1)
-        #     else:
-        #         if 0 < xypix[0][0] < height and 0 < xypix[0][1] < width:
-        #             cv2.circle(s[k].raw, (int(xypix[0][0]), int(xypix[0][1])),
-        #                        5, (230, 250, 100), -1)
-        #     cv2.imshow('camera'+str(k), s[k].raw)
+    # Derivatives of (xl, yl) with respect to (x, y, z)
+    J = np.zeros(xyz.shape[:-1] + (2, 3))
+    J[..., 0, 0] = fx * dxll_dxl / z
+    J[..., 0, 1] = fx * dxll_dyl / z
+    J[..., 0, 2] = -fx * (dxll_dxl * xl + dxll_dyl * yl) / z
+    J[..., 1, 0] = fy * dyll_dxl / z
+    J[..., 1, 1] = fy * dyll_dyl / z
+    J[..., 1, 2] = -fy * (dyll_dxl * xl + dyll_dyl * yl) / z
 
-        #     X.setPlot3D(Pc)
+    return J
 
-    if args['do'] and costFunction.counter in multiples:
-        if handle_fun:
-            handle_fun.set_ydata(cost)
-        plt.draw()
-        plt.pause(0.01)
 
-    return cost
+def jacobianColumns(X, detections, args):
+    """Columns of the vector x (camera parameters followed by aruco parameters) on
+        which the residual of each detection depends, a D x (6 + 6) or D x (6 + 3) array
+    """
+
+    idxs_cameras, idxs_arucos = detections.idxsInX(X)
+    n_cameras = len(X.cameras)
+
+    if args['option2'] == 'all':
+        nvalues = 6
+    else:
+        nvalues = 3
+
+    cols = np.zeros((len(idxs_cameras), 6 + nvalues), dtype=int)
+    cols[:, 0:6] = 6 * idxs_cameras[:, np.newaxis] + np.arange(6)
+    cols[:, 6:] = 6 * n_cameras + nvalues * \
+        idxs_arucos[:, np.newaxis] + np.arange(nvalues)
+
+    return cols
+
+
+def sparsityMatrix(X, detections, Pc, args):
+    """Sparsity structure of the jacobian (residuals x parameters)
+        All the residuals of a detection depend on the same camera and aruco parameters.
+    """
+
+    cols = np.repeat(jacobianColumns(X, detections, args),
+                     residualsPerDetection(Pc, args), axis=0)
+    n_rows, n_cols = cols.shape
+    indptr = np.arange(0, n_rows * n_cols + 1, n_cols)
+
+    return csr_matrix((np.ones(cols.size, dtype=int), cols.ravel(), indptr),
+                      shape=(n_rows, len(X.v)))
+
+
+def jacobianFunction(x, dist, intrinsics, X, Pc, detections, args, handles, handle_fun, s):
+    """Jacobian of the cost function
+        Closed form derivatives of the residuals of each detection with respect to the
+        translation and Rodrigues parameters of its camera and of its aruco. Returns a
+        sparse matrix with the same shape as the sparsity matrix of the problem.
+    """
+
+    X.fromVector(x, args)
+    jacobianFunction.counter += 1
+
+    idxs_cameras, idxs_arucos = detections.idxsInX(X)
+    corners = detections.corners
+    cols = jacobianColumns(X, detections, args)
+    n_detections, n_cols = cols.shape
+
+    Tcs, Tas = X.getTs()
+
+    Rc = Tcs[idxs_cameras, 0:3, 0:3]
+    tc = Tcs[idxs_cameras, 0:3, 3]
+    Ra = Tas[idxs_arucos, 0:3, 0:3]
+    ta = Tas[idxs_arucos, 0:3, 3]
+
+    P = np.asarray(Pc, dtype=np.float64)[:, 0:3]
+
+    # Aruco points in the map (w) and in the camera (xyz) referential, D x P x 3
+    w = np.einsum('dij,pj->dpi', Ra, P) + ta[:, np.newaxis, :]
+    v = w - tc[:, np.newaxis, :]
+    xyz = np.einsum('dji,dpj->dpi', Rc, v)
+
+    xypix = pointsInCamera2image(xyz, intrinsics, dist)
+
+    # Derivatives of the projected points with respect to the points in the camera
+    # referential, D x P x 2 x 3
+    dpix_dxyz = points2imageJacobians(xyz, intrinsics, dist)
+    n_points = xyz.shape[1]
+
+    # Derivatives of the R residuals of each detection with respect to the points in
+    # the camera referential, D x R x P x 3
+    if args['residuals'] == 'coordinates':
+        n_residuals = 2 * n_points
+        dres_dxyz = np.zeros((n_detections, n_points, 2, n_points, 3))
+        for p in range(n_points):
+            dres_dxyz[:, p, :, p, :] = dpix_dxyz[:, p, :, :]
+        dres_dxyz = dres_dxyz.reshape((n_detections, n_residuals, n_points, 3))
+    else:
+        n_residuals = 1
+        if args['option1'] == 'corners':
+            diff = xypix - corners
+        else:
+            diff = xypix[:, 0:1, :] - np.mean(corners, axis=1, dtype=np.float64)[:, np.newaxis, :]
+        norm = np.sqrt(np.sum(diff**2, axis=2))
+        dres_dpix = diff / np.where(norm > 0, norm, np.inf)[:, :, np.newaxis]
+        dres_dxyz = np.einsum('dpk,dpki->dpi', dres_dpix,
+                              dpix_dxyz)[:, np.newaxis, :, :]
+
+    # xyz = Rc.T * (Ra * p + ta - tc)
+    g = np.einsum('drpi,dji->drpj', dres_dxyz, Rc)  # derivative with respect to w
+    dres_dta = np.sum(g, axis=2)
+    dres_dtc = -dres_dta
+
+    Jc = rodriguesRightJacobians(-X.rvecs_cameras)[idxs_cameras]
+    Sv = skewMatrices(v)
+    dres_drc = np.einsum('drpj,dpjk,dkl->drl', g, Sv, Jc)
+
+    data = np.zeros((n_detections, n_residuals, n_cols))
+    data[:, :, 0:3] = dres_dtc
+    data[:, :, 3:6] = dres_drc
+    data[:, :, 6:9] = dres_dta
+
+    if n_cols == 12:
+        Ja = rodriguesRightJacobians(X.rvecs_arucos)[idxs_arucos]
+        Sp = skewMatrices(P)
+        data[:, :, 9:12] = -np.einsum('drpi,dij,pjk,dkl->drl', g, Ra, Sp, Ja)
+
+    cols = np.repeat(cols, n_residuals, axis=0)
+    n_rows = n_detections * n_residuals
+    indptr = np.arange(0, n_rows * n_cols + 1, n_cols)
+
+    return csr_matrix((data.ravel(), cols.ravel(), indptr),
+                      shape=(n_rows, len(x)))
+
+
+def checkJacobian(x, fun_args, epsilon=1e-6):
+    """Compares the analytic jacobian with central finite differences of the cost function
+        Returns the maximum absolute difference and the maximum absolute value of the
+        finite difference jacobian.
+    """
+
+    x = np.array(x, dtype=np.float64)
+    J = jacobianFunction(x, *fun_args).toarray()
+    Jfd = np.zeros(J.shape)
+
+    for i in range(len(x)):
+        xp = x.copy()
+        xm = x.copy()
+        xp[i] = xp[i] + epsilon
+        xm[i] = xm[i] - epsilon
+        Jfd[:, i] = (np.asarray(costFunction(xp, *fun_args)) -
+                     np.asarray(costFunction(xm, *fun_args))) / (2 * epsilon)
+
+    # Leave X as it was
+    X = fun_args[2]
+    X.fromVector(x, fun_args[5])
+
+    return np.max(np.abs(J - Jfd)), np.max(np.abs(Jfd))
 
 
 def computeError(realPts, compPts):
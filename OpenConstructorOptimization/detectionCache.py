@@ -0,0 +1,175 @@
+# Cache of the aruco detections of a dataset, saved next to the images
+#
+# The detections of each image are stored under a key that hashes the content of the
+# image file together with the detection settings (aruco dictionary, values of the
+# DetectorParameters, marker size, intrinsics, distortion, decoding and scale of the
+# images, tracking and OpenCV version). When
+# the image or any of the settings change the key changes too, so the old entry is
+# never used again (and it is dropped the next time the cache is saved).
+import os
+import hashlib
+import numpy as np
+import cv2
+
+from arucoDetection import ImageDetections
+from arucoDetection import detectorParameters
+from imageSources import splitFrame
+from archiveSources import isArchived
+from archiveSources import splitArchive
+from archiveSources import openArchive
+from archiveSources import sidecarFilename
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def detectionCacheFilename(directory):
+    """Cache of the detections of a dataset: in its directory or next to its video or
+        archive
+    """
+    if isArchived(directory):
+        return sidecarFilename(directory, 'detections_cache.npz')
+    if os.path.isfile(directory):
+        return os.path.splitext(directory)[0] + '_detections_cache.npz'
+    return os.path.join(directory, 'detections_cache.npz')
+
+
+def fileHash(filename):
+    """SHA1 of the content of a file, or of a file inside an archive
+    """
+    path, member = splitArchive(filename)
+    if member is not None:
+        return hashlib.sha1(openArchive(path).read(member)).hexdigest()
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def settingsHash(dictionary, parameters, marksize, mtx, dist, grayscale=False, scale=1.0,
+                 track=0):
+    """SHA1 of all the settings that change the result of the detection
+        dictionary is the id of the aruco dictionary or the pair (id, marker ids) of a
+        restricted dictionary. parameters is the dictionary of changed values of the
+        DetectorParameters, all the values (including the defaults) are hashed.
+    """
+    if isinstance(dictionary, tuple):
+        dictionary = (int(dictionary[0]), tuple(int(i) for i in dictionary[1]))
+    else:
+        dictionary = int(dictionary)
+
+    detector = detectorParameters(parameters)
+    values = sorted((name, repr(getattr(detector, name))) for name in dir(detector)
+                    if not name.startswith('_') and not callable(getattr(detector, name)))
+
+    h = hashlib.sha1()
+    h.update(repr((cv2.__version__, dictionary, values, float(marksize),
+                   bool(grayscale), float(scale), int(track))).encode('utf-8'))
+    h.update(np.asarray(mtx, dtype=np.float64).tobytes())
+    h.update(np.asarray(dist, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class DetectionCache:
+    """Detections of the images of a dataset, stored in a compressed .npz file
+        Keys are built with keys(); get() returns the cached ImageDetections (or None)
+        and put() adds a new one. save() writes the entries used in this run.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(filename):
+            try:
+                self.load()
+            except Exception as e:  # corrupted or old cache, it is rebuilt
+                print("Ignoring the detection cache " + filename + ": " + str(e))
+                self.entries = {}
+
+    def keys(self, filenames, dictionary, parameters, marksize, mtx, dist, grayscale=False,
+             scale=1.0, track=0):
+        """Key of each image, from its content and the settings of the detection
+            The content of a frame of a video is the hash of the video and the number of
+            the frame.
+        """
+        settings = settingsHash(dictionary, parameters, marksize, mtx, dist, grayscale, scale,
+                                track)
+        hashes = {}
+        keys = []
+        for filename in filenames:
+            path, frame = splitFrame(filename)
+            if path not in hashes:
+                hashes[path] = fileHash(path)
+            content = hashes[path] if frame is None else hashes[path] + '#' + str(frame)
+            keys.append(hashlib.sha1((settings + content).encode('utf-8')).hexdigest())
+        return keys
+
+    def get(self, key, image_filename):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        image = self.entries[key]
+        image.filename = image_filename
+        self.used[key] = image
+        return image
+
+    def put(self, key, image):
+        self.entries[key] = image
+        self.used[key] = image
+
+    def load(self):
+        data = np.load(self.filename)
+        starts = np.concatenate(([0], np.cumsum(data['counts'])))
+
+        for i, key in enumerate(data['keys']):
+            image = ImageDetections(None)
+            shape = tuple(int(v) for v in data['shapes'][i])
+            image.shape = shape if shape[2] > 0 else shape[0:2]
+
+            a, b = starts[i], starts[i + 1]
+            if b > a:
+                image.ids = data['ids'][a:b].reshape((-1, 1))
+                image.corners = [corner.reshape((1, 4, 2)) for corner in data['corners'][a:b]]
+                image.rvecs = data['rvecs'][a:b].reshape((-1, 1, 3))
+                image.tvecs = data['tvecs'][a:b].reshape((-1, 1, 3))
+
+            self.entries[key.decode('ascii') if isinstance(key, bytes) else str(key)] = image
+
+    def save(self):
+        """Saves the entries used in this run (older entries are dropped)
+        """
+        keys = sorted(self.used.keys())
+        images = [self.used[key] for key in keys]
+
+        counts = np.array([0 if image.ids is None else len(image.ids) for image in images],
+                          dtype=np.int64)
+        shapes = np.array([tuple(image.shape) + (0,) * (3 - len(image.shape))
+                           for image in images], dtype=np.int64).reshape((-1, 3))
+        found = [image for image in images if image.ids is not None]
+
+        def stacked(values, shape, dtype):
+            if not values:
+                return np.zeros((0,) + shape, dtype=dtype)
+            return np.concatenate([np.asarray(v, dtype=dtype).reshape((-1,) + shape)
+                                   for v in values])
+
+        # written to a temporary file first, so that an interrupted save does not
+        # leave a broken cache
+        temporary = self.filename + '.tmp.npz'
+        np.savez_compressed(temporary,
+                            keys=np.array(keys, dtype='S40'),
+                            counts=counts,
+                            shapes=shapes,
+                            ids=stacked([image.ids for image in found], (), np.int32),
+                            corners=stacked([image.corners for image in found], (4, 2), np.float32),
+                            rvecs=stacked([image.rvecs for image in found], (3,), np.float64),
+                            tvecs=stacked([image.tvecs for image in found], (3,), np.float64))
+        os.rename(temporary, self.filename)
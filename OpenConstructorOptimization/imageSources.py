@@ -0,0 +1,137 @@
+# Reading of the images of a dataset, from image files, from the frames of a video or
+# from the images inside an archive
+#
+# The images are named by their filename. The frame k of a video is named
+# <video>#<k>, so that the detection, the cache and the drawing handle the frames
+# as any other image, without extracting them to files. Consecutive frames are read
+# sequentially from an open capture, seeking only when a frame is skipped. Images
+# inside a tar or zip archive (see archiveSources) are decoded from memory.
+import os
+import numpy as np
+import cv2
+
+from archiveSources import splitArchive
+from archiveSources import openArchive
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv', '.mpg', '.mpeg', '.m4v', '.webm')
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def isVideo(filename):
+    return os.path.isfile(filename) and filename.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def splitFrame(name):
+    """(video, frame) of the name of a frame of a video, (name, None) for image files
+    """
+    if '#' in name:
+        video, frame = name.rsplit('#', 1)
+        if frame.isdigit() and video.lower().endswith(VIDEO_EXTENSIONS):
+            return video, int(frame)
+    return name, None
+
+
+def videoFrames(filename, first=0, last=None, stride=1):
+    """Names of the frames first, first + stride, ... (up to last, included) of a video
+    """
+    capture = cv2.VideoCapture(filename)
+    if not capture.isOpened():
+        raise IOError("Can not open the video " + filename)
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # The frame count of some containers is only an estimate, the last frames that can
+    # not be read are dropped
+    while count > 0:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, count - 1)
+        if capture.grab():
+            break
+        count -= 1
+    capture.release()
+
+    if last is None or last >= count:
+        last = count - 1
+    return [filename + '#' + str(k) for k in range(first, last + 1, stride)]
+
+
+def decodeFlags(grayscale=False, reduction=1):
+    """Flags of cv2.imread to decode an image to gray or color, at 1/reduction of its size
+        reduction is 1, 2, 4 or 8 (JPEG images are then decoded at reduced resolution,
+        which is much faster than decoding and resizing).
+    """
+    if reduction == 1:
+        return cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    return getattr(cv2, 'IMREAD_REDUCED_' + ('GRAYSCALE_' if grayscale else 'COLOR_') +
+                   str(reduction))
+
+
+class ImageReader:
+    """Reads images by name, keeping the captures of the videos open
+        Reading the frames of a video in increasing order decodes each frame once.
+        Call close() at the end to release the videos.
+    """
+
+    # Frames skipped by decoding (grab) instead of seeking, which is slow and, for
+    # some codecs, not exact
+    max_grab = 50
+
+    def __init__(self, grayscale=False, reduction=1):
+        self.grayscale = grayscale
+        self.reduction = reduction
+        self.captures = {}  # video -> [capture, index of the next frame]
+
+    def read(self, name):
+        """Image (or frame of a video) name, raises IOError if it can not be read
+        """
+        video, frame = splitFrame(name)
+        if frame is None:
+            path, member = splitArchive(name)
+            if member is not None:
+                data = np.frombuffer(openArchive(path).read(member), np.uint8)
+                raw = cv2.imdecode(data, decodeFlags(self.grayscale, self.reduction))
+            else:
+                raw = cv2.imread(name, decodeFlags(self.grayscale, self.reduction))
+            if raw is None:
+                raise IOError("Can not read the image " + name)
+            return raw
+
+        if video not in self.captures:
+            self.captures[video] = [cv2.VideoCapture(video), 0]
+        capture = self.captures[video]
+
+        skip = frame - capture[1]
+        if skip < 0 or skip > self.max_grab:
+            capture[0].set(cv2.CAP_PROP_POS_FRAMES, frame)
+        else:
+            for _ in range(skip):
+                capture[0].grab()
+        ok, raw = capture[0].read()
+        capture[1] = frame + 1
+        if not ok:
+            # e.g. beyond the last frame, as the frame count of some videos is only
+            # an estimate
+            raise IOError("Can not read the frame " + str(frame) + " of the video " + video)
+
+        if self.grayscale:
+            raw = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+        if self.reduction > 1:
+            raw = cv2.resize(raw, None, fx=1.0 / self.reduction, fy=1.0 / self.reduction,
+                             interpolation=cv2.INTER_AREA)
+        return raw
+
+    def close(self):
+        for capture, _ in self.captures.values():
+            capture.release()
+        self.captures = {}
+
+
+def readImage(name, grayscale=False, reduction=1):
+    """One image (or frame of a video), see ImageReader
+    """
+    reader = ImageReader(grayscale, reduction)
+    try:
+        return reader.read(name)
+    finally:
+        reader.close()
@@ -0,0 +1,233 @@
+# Initial guess of the cameras and arucos from the graph of detections
+#
+# Nodes of the graph are the cameras 'C<k>', the arucos 'A<id>' and the 'Map'; there
+# is an edge between each camera and the arucos it detects. The weight of an edge is
+# the cost of its detection (see detectionCosts), low for reliable single marker
+# poses, or 1. The transform of each node to the map node is the average of the
+# chained detections along the cheapest paths between them. The transforms along all
+# the paths are built in a single traversal from the map node, in order of cost: the
+# paths of a node are the paths of its neighbours closer to the map, extended by one
+# edge. At most max_paths paths are kept for each node, so the cost grows linearly
+# with the number of detections instead of with the (combinatorial) number of paths.
+# The map node is given, or chosen as the aruco or camera with the cheapest paths to
+# all the others (see centralNode).
+import numpy as np
+import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from tqdm import tqdm  # Show a smart progress meter
+
+from rigidTransforms import invertTransforms
+from rigidTransforms import composeTransforms
+from rigidTransforms import transformsFromVectors
+from rigidTransforms import quaternionsFromMatrices
+from rigidTransforms import transformsFromQuaternions
+
+from myClasses import MyCamera
+from myClasses import MyAruco
+from costFunctions import averageTransforms
+from costFunctions import points2imageFromTs
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def detectionQualities(detections, intrinsics, dist, marksize):
+    """Area (pixels), viewing angle (radians) and reprojection error (pixels) of each
+        detection. The viewing angle is between the normal of the aruco and the ray from
+        the camera to its center, the reprojection error is the RMS distance between the
+        detected corners and the corners projected with the single marker pose.
+    """
+    corners = detections.corners.astype(np.float64)
+    x, y = corners[..., 0], corners[..., 1]
+    area = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1))
+
+    Ts = transformsFromVectors(detections.tvecs, detections.rvecs)
+    normals = Ts[:, 0:3, 2]
+    rays = Ts[:, 0:3, 3] / np.linalg.norm(Ts[:, 0:3, 3], axis=1)[:, np.newaxis]
+    angle = np.arccos(np.clip(np.abs(np.sum(normals * rays, axis=1)), 0.0, 1.0))
+
+    l = marksize
+    Pc = np.array([[-l/2, l/2, 0], [l/2, l/2, 0], [l/2, -l/2, 0], [-l/2, -l/2, 0]])
+    projected = points2imageFromTs(Ts, intrinsics, Pc, dist)
+    error = np.sqrt(np.mean(np.sum((projected - corners) ** 2, axis=2), axis=1))
+
+    return area, angle, error
+
+
+def detectionCosts(detections, intrinsics, dist, marksize, sigma=1.0,
+                   max_angle=np.radians(80)):
+    """Cost of each detection as an edge of the graph, low for reliable single marker
+        poses. The error of the pose grows as the aruco gets smaller in the image
+        (relative to the median side of the arucos), as it is seen at a grazing angle
+        (up to max_angle) and with the reprojection error of its corners (relative to a
+        noise of sigma pixels). A median aruco, seen from the front and reprojected
+        exactly, costs 1.
+    """
+    area, angle, error = detectionQualities(detections, intrinsics, dist, marksize)
+    side = np.sqrt(np.maximum(area, 1.0))
+    return (np.median(side) / side) * (1.0 + error / sigma) / \
+        np.cos(np.minimum(angle, max_angle))
+
+
+def sceneGraph(detections, n_map_cameras=1, costs=None):
+    """Graph of the cameras and arucos, with an edge for each detection
+        The first n_map_cameras cameras are also connected to the 'Map' node. The
+        weight of the edge of a detection is its cost (see detectionCosts), or 1.
+    """
+
+    GA = nx.Graph()
+
+    for i in range(0, n_map_cameras):
+        GA.add_edge('Map', 'C' + str(i), weight=1)
+
+    for camera_id, aruco_id in zip(detections.cameras, detections.arucos):
+        weight = 1 if costs is None else float(costs[detections.row(camera_id, aruco_id)])
+        GA.add_edge('A' + str(aruco_id), 'C' + str(camera_id), weight=weight)
+
+    return GA
+
+
+def centralNode(GA, cameras=True):
+    """Aruco (or camera, if cameras) with the cheapest paths to all the other nodes
+        The centrality of a node is the average cost of its cheapest paths to the nodes
+        it reaches. Anchored there, the initial guess chains the fewest (and most
+        reliable) detections. In a graph that is not connected, the nodes of the
+        largest component are preferred; ties go to the first node by name. Returns
+        None if there is no candidate.
+    """
+    nodes = sorted(GA.nodes)
+    candidates = [node for node in nodes if node[0] == 'A' or (cameras and node[0] == 'C')]
+    if not candidates:
+        return None
+
+    index = dict((node, i) for i, node in enumerate(nodes))
+    edges = list(GA.edges(data='weight', default=1))
+    rows = [index[u] for u, v, w in edges]
+    cols = [index[v] for u, v, w in edges]
+    weights = [float(w) for u, v, w in edges]
+    A = csr_matrix((weights, (rows, cols)), shape=(len(nodes), len(nodes)))
+
+    # all the cheapest paths from the candidates, in a single call
+    D = dijkstra(A, directed=False, indices=[index[node] for node in candidates])
+    reached = np.isfinite(D)
+    n_reached = np.sum(reached, axis=1)
+    average = np.sum(np.where(reached, D, 0), axis=1) / np.maximum(n_reached - 1, 1)
+
+    best = min(range(len(candidates)), key=lambda i: (-n_reached[i], average[i], candidates[i]))
+    return candidates[best]
+
+
+def edgeTransform(start, end, detections, Ts, cameras, args):
+    """Transform from the frame of node start to the frame of node end, neighbours in
+        the graph. Ts are the transforms of all the detections and cameras the cameras
+        of X by id.
+    """
+    if start == 'Map':
+        if args['option3'] == 'fromaruco':
+            return np.identity(4)
+        return invertTransforms(cameras[end[1:]].getT())
+
+    if end == 'Map':
+        if args['option3'] == 'fromaruco':
+            return np.identity(4)
+        return cameras[start[1:]].getT()
+
+    if start[0] == 'C':
+        # When going from camera to aruco must invert the transformation given by the
+        # aruco detection
+        return invertTransforms(Ts[detections.row(int(start[1:]), int(end[1:]))])
+    return Ts[detections.row(int(end[1:]), int(start[1:]))]
+
+
+def pathTransforms(GA, map_node, detections, X, args, max_paths=100, slack=0.5):
+    """Transforms from each node of the graph to map_node, along its cheapest paths
+        The cost of a path is the sum of the weights of its edges. The paths of a node
+        move strictly closer to the map at each step (as measured by the cost of the
+        cheapest path) and cost at most (1 + slack) times the cheapest path; with unit
+        weights, these are all the shortest paths. Returns a dictionary from node to the
+        stack (P x 4 x 4) of the transforms of its P <= max_paths cheapest paths, and
+        the list of nodes that had more paths. Nodes not connected to map_node get the
+        identity.
+    """
+    Ts = transformsFromVectors(detections.tvecs, detections.rvecs)
+    cameras = dict((camera.id, camera) for camera in X.cameras)
+
+    distance = nx.single_source_dijkstra_path_length(GA, map_node)
+
+    transforms = {map_node: np.identity(4)[np.newaxis]}
+    costs = {map_node: np.zeros(1)}
+    capped = []
+
+    for v in sorted(distance.keys(), key=lambda node: (distance[node], node)):
+        if v == map_node:
+            continue
+
+        stacks = []
+        stack_costs = []
+        for u in sorted(GA.neighbors(v)):
+            if not distance[u] < distance[v]:
+                continue
+            c = costs[u] + GA[u][v]['weight']
+            valid = c <= (1 + slack) * distance[v] + 1e-9
+            if np.any(valid):
+                stacks.append(composeTransforms(transforms[u][valid],
+                                                edgeTransform(v, u, detections, Ts, cameras, args)))
+                stack_costs.append(c[valid])
+
+        stack_costs = np.concatenate(stack_costs)
+        order = np.argsort(stack_costs, kind='mergesort')[0:max_paths]
+        if len(stack_costs) > max_paths:
+            capped.append(v)
+        transforms[v] = np.concatenate(stacks)[order]
+        costs[v] = stack_costs[order]
+
+    for node in GA.nodes:
+        if node not in transforms:
+            transforms[node] = np.identity(4)[np.newaxis]
+
+    return transforms, capped
+
+
+def initialGuess(GA, map_node, detections, X, args, progress=True, max_paths=100):
+    """Adds to X the cameras and arucos of the graph, with their transforms to map_node
+        With option3 fromfile the cameras are already in X and the edges to the 'Map'
+        use their transforms; with fromaruco they are the identity. The transform of
+        each node is the average of the transforms along (at most max_paths of) its
+        cheapest paths to map_node.
+    """
+
+    transforms, capped = pathTransforms(GA, map_node, detections, X, args, max_paths)
+
+    if capped:
+        print("Averaging the " + str(max_paths) + " cheapest paths of " + str(len(capped)) +
+              " nodes")
+
+    # The nodes with the same number of paths are averaged in a single call
+    averaged = {}
+    groups = {}
+    for node in GA.nodes:
+        groups.setdefault(len(transforms[node]), []).append(node)
+    for nodes in groups.values():
+        Ts = np.array([transforms[node] for node in nodes])
+        avg_t, avg_q = averageTransforms(Ts[..., 0:3, 3], quaternionsFromMatrices(Ts))
+        averaged.update(zip(nodes, transformsFromQuaternions(avg_t, avg_q)))
+
+    # cycle all nodes in graph
+    for node in tqdm(GA.nodes, disable=not progress):
+
+        T = averaged[node]
+
+        if node[0] == 'C' and args['option3'] == 'fromaruco':  # node is a camera
+            camera = MyCamera(T=T, id=node[1:])
+            X.cameras.append(camera)
+        elif node == 'Map':
+            pass
+        else:
+            aruco = MyAruco(T=T, id=node[1:])
+            X.arucos.append(aruco)
+
+    X.arucos.sort(key=lambda x: float(x.id), reverse=False)
+
+    return X
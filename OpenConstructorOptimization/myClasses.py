@@ -1,6 +1,8 @@
 # MyClasses
 import numpy as np
-import cv2
+
+from rigidTransforms import transformsFromVectors
+from rigidTransforms import matrix2rodrigues
 
 
 class stru:
@@ -8,14 +10,14 @@ class stru:
         self.raw = None
 
 
-class MyPoint3D:
+class MyPoint3D(object):
     def __init__(self):
         self.x = None
         self.y = None
         self.z = None
 
 
-class MyRodrigues:
+class MyRodrigues(object):
     def __init__(self):
         self.r1 = None
         self.r2 = None
@@ -49,69 +51,169 @@ class MyHandle3D:
         self.handle_textz = handle_textz
 
 
+def vectorComponent(name, i):
+    """Property that reads and writes the component i of the array attribute name
+    """
+    def getter(self):
+        return getattr(self, name)[i]
+
+    def setter(self, value):
+        getattr(self, name)[i] = value
+
+    return property(getter, setter)
+
+
 class MyTransform(MyRodrigues, MyPoint3D):
+    """Transform defined by a translation (x, y, z) and a Rodrigues vector (r1, r2, r3)
+        The values are kept in the arrays tvec and rvec, which can be views of the
+        vector of parameters of the optimization (see MyX.toVector).
+    """
+
+    x = vectorComponent('tvec', 0)
+    y = vectorComponent('tvec', 1)
+    z = vectorComponent('tvec', 2)
+    r1 = vectorComponent('rvec', 0)
+    r2 = vectorComponent('rvec', 1)
+    r3 = vectorComponent('rvec', 2)
+
     def __init__(self, rvec, tvec):
-        MyPoint3D.__init__(self)
-        self.x = tvec[0]
-        self.y = tvec[1]
-        self.z = tvec[2]
-        MyRodrigues.__init__(self)
-        self.r1 = rvec[0]
-        self.r2 = rvec[1]
-        self.r3 = rvec[2]
+        self.bind(np.array(tvec, dtype=np.float64).ravel(),
+                  np.array(rvec, dtype=np.float64).ravel())
+
+    def bind(self, tvec, rvec):
+        """Uses the arrays tvec and rvec (3 values each) to store the transform
+        """
+        self.tvec = tvec
+        self.rvec = rvec
 
     def getT(self):
         """Transformation matrix
             Gets 4x4 Tranform from internal xyz and Rodriges
         """
-        T = np.eye(4)
-        dxyz = np.array([self.x, self.y,
-                         self.z], dtype=np.float)
-        T[0:3, 3] = dxyz.transpose()
-        rod = np.array([self.r1, self.r2, self.r3], dtype=np.float)
-        DCM = cv2.Rodrigues(rod)
-        T[0:3, 0:3] = DCM[0]
-        return T
+        return transformsFromVectors(self.tvec, self.rvec)
 
     def setPointRod(self, T):
         """Transformation matrix
             Sets point and rod values from 4x4 Tranform
         """
-        dxyz = T[0:3, 3]
-        dxyz = dxyz.transpose()
-        rods, _ = cv2.Rodrigues(T[0:3, 0:3])
-        rods = rods.transpose()
-        rod = rods[0]
-        self.x = dxyz[0]
-        self.y = dxyz[1]
-        self.z = dxyz[2]
-        self.r1 = rod[0]
-        self.r2 = rod[1]
-        self.r3 = rod[2]
+        self.tvec[:] = T[0:3, 3]
+        self.rvec[:] = matrix2rodrigues(T[0:3, 0:3])
 
     def printValues(self):
         return "xyz = " + str(self.x) + ", " + str(self.y) + ", " + str(self.z) + "\n" + "rod = " + str(self.r1) + ", " + str(self.r2) + ", " + str(self.r3)
 
 
-class MyDetection(MyTransform):
-    def __init__(self, rvec, tvec, cam, ar, corner):
-        MyTransform.__init__(self, rvec, tvec)
-        self.camera = cam
-        self.aruco = ar
-        self.corner = corner
+class DetectionTable:
+    """Detections of the arucos in the images, stored as contiguous arrays
+        Row i is the detection of aruco arucos[i] by camera cameras[i] in image
+        images[i], with its four corners (D x 4 x 2, in pixels) and the pose of the
+        aruco in the camera (rvecs, tvecs) given by the single marker estimation.
+        Detections are added image by image and the arrays are built once with build().
+    """
+
+    def __init__(self):
+        self.cameras = np.zeros(0, dtype=np.int32)
+        self.arucos = np.zeros(0, dtype=np.int32)
+        self.images = np.zeros(0, dtype=np.int32)
+        self.corners = np.zeros((0, 4, 2), dtype=np.float32)
+        self.rvecs = np.zeros((0, 3))
+        self.tvecs = np.zeros((0, 3))
+        self.chunks = []
+        self.rows = None
+        self.stacked = None
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def add(self, camera, ids, corners, rvecs, tvecs, image):
+        """Adds the detections of one image, as given by the aruco detection functions
+        """
+        n = len(ids)
+        self.chunks.append((np.full(n, camera, dtype=np.int32),
+                            np.asarray(ids, dtype=np.int32).reshape(n),
+                            np.full(n, image, dtype=np.int32),
+                            np.asarray(corners, dtype=np.float32).reshape((n, 4, 2)),
+                            np.asarray(rvecs, dtype=np.float64).reshape((n, 3)),
+                            np.asarray(tvecs, dtype=np.float64).reshape((n, 3))))
+
+    def build(self):
+        """Concatenates the detections added so far into the arrays of the table
+        """
+        if self.chunks:
+            columns = list(zip(*self.chunks))
+            self.cameras = np.concatenate((self.cameras,) + columns[0])
+            self.arucos = np.concatenate((self.arucos,) + columns[1])
+            self.images = np.concatenate((self.images,) + columns[2])
+            self.corners = np.concatenate((self.corners,) + columns[3])
+            self.rvecs = np.concatenate((self.rvecs,) + columns[4])
+            self.tvecs = np.concatenate((self.tvecs,) + columns[5])
+        self.chunks = []
+        self.rows = None
+        self.stacked = None
+        return self
+
+    def subset(self, rows):
+        """Table with the detections of rows (indices or a boolean mask)
+        """
+        table = DetectionTable()
+        table.cameras = self.cameras[rows]
+        table.arucos = self.arucos[rows]
+        table.images = self.images[rows]
+        table.corners = self.corners[rows]
+        table.rvecs = self.rvecs[rows]
+        table.tvecs = self.tvecs[rows]
+        return table
+
+    def name(self, i):
+        return 'C' + str(self.cameras[i]) + '/A' + str(self.arucos[i])
+
+    def getT(self, i):
+        """Transform from the aruco to the camera of detection i
+        """
+        return transformsFromVectors(self.tvecs[i], self.rvecs[i])
+
+    def row(self, camera, aruco):
+        """Index of the (first) detection of the aruco by the camera
+        """
+        if self.rows is None:
+            self.rows = {}
+            for i, key in enumerate(zip(self.cameras.tolist(), self.arucos.tolist())):
+                self.rows.setdefault(key, i)
+        return self.rows[(camera, aruco)]
+
+    def idxsInX(self, X):
+        """Index in X.cameras and in X.arucos of the camera and aruco of each detection
+            The cameras and arucos of X do not change during the optimization, so this
+            is computed once for each X.
+        """
+        if self.stacked is None or self.stacked[0] is not X:
+            self.stacked = (X, idxsFromIds(X.cameras, self.cameras),
+                            idxsFromIds(X.arucos, self.arucos))
+        return self.stacked[1:]
 
-    def __str__(self):
-        return "\nDetection from camera " + str(self.camera) + " of aruco " + str(self.aruco) + ":"
+
+def idxsFromIds(objects, ids):
+    """Positions in the list objects (cameras or arucos) of the given integer ids
+    """
+    objects_ids = np.array([int(o.id) for o in objects], dtype=np.int64)
+    order = np.argsort(objects_ids)
+    positions = np.searchsorted(objects_ids[order], ids)
+    if np.any(positions >= len(order)) or \
+            np.any(objects_ids[order][np.minimum(positions, len(order) - 1)] != ids):
+        raise ValueError('Detections of cameras or arucos that are not in X')
+    return order[positions]
 
 
 class MyCamera(MyTransform):
     def __init__(self, T, id):
+        MyTransform.__init__(self, np.zeros(3), np.zeros(3))
         MyTransform.setPointRod(self, T)
         self.id = id
 
 
 class MyAruco(MyTransform):
     def __init__(self, T, id):
+        MyTransform.__init__(self, np.zeros(3), np.zeros(3))
         MyTransform.setPointRod(self, T)
         self.id = id
 
@@ -120,7 +222,11 @@ class MyX:
     def __init__(self):
         self.cameras = []
         self.arucos = []
-        self.v = []
+        self.v = np.zeros(0)
+        self.tvecs_cameras = np.zeros((0, 3))
+        self.rvecs_cameras = np.zeros((0, 3))
+        self.tvecs_arucos = np.zeros((0, 3))
+        self.rvecs_arucos = np.zeros((0, 3))
         self.ArucoHandles = []
         self.CameraHandles = []
         self.InitPts = []
@@ -342,65 +448,52 @@ class MyX:
             handle.handle_textz.set_3d_properties(z=Ptransf[3][2], zdir='y')
 
     def toVector(self, args):
-        for i in range(len(self.cameras)):
-            self.v.extend(
-                [self.cameras[i].x, self.cameras[i].y, self.cameras[i].z,
-                 self.cameras[i].r1, self.cameras[i].r2, self.cameras[i].r3])
-
-        for i in range(len(self.arucos)):
-            # print('Aruco ' + str(self.arucos[i].id))
-            if args['option2'] == 'all':
-                self.v.extend(
-                    [self.arucos[i].x, self.arucos[i].y, self.arucos[i].z,
-                     self.arucos[i].r1, self.arucos[i].r2, self.arucos[i].r3])
-            else:
-                self.v.extend(
-                    [self.arucos[i].x, self.arucos[i].y, self.arucos[i].z])
-
-    def fromVector(self, v, args):
+        """Vector of parameters of the optimization
+            Allocates self.v with the translation and Rodrigues of each camera followed
+            by the translation (and Rodrigues, if option2 is all) of each aruco. The
+            cameras and arucos are then bound to views of self.v, so that loading a new
+            vector with fromVector updates all of them at once.
+        """
         n_cameras = len(self.cameras)
+        n_arucos = len(self.arucos)
         if args['option2'] == 'all':
             nvalues = 6
         else:
             nvalues = 3
 
-        for i in range(n_cameras):
-            self.cameras[i].x = v[i*6]
-            self.cameras[i].y = v[i*6+1]
-            self.cameras[i].z = v[i*6+2]
-            self.cameras[i].r1 = v[i*6+3]
-            self.cameras[i].r2 = v[i*6+4]
-            self.cameras[i].r3 = v[i*6+5]
-        for i in range(len(self.arucos)):
-            self.arucos[i].x = v[i*nvalues+n_cameras*6]
-            self.arucos[i].y = v[i*nvalues+1+n_cameras*6]
-            self.arucos[i].z = v[i*nvalues+2+n_cameras*6]
-            if args['option2'] == 'all':
-                self.arucos[i].r1 = v[i*nvalues+3+n_cameras*6]
-                self.arucos[i].r2 = v[i*nvalues+4+n_cameras*6]
-                self.arucos[i].r3 = v[i*nvalues+5+n_cameras*6]
-
-    def idxsFromCamera(self, camera_name, args):
-        nvalues = 6
-        # print(camera_name)
-        # print([x.id for x in self.cameras])
-        idx_in_cameras = [x.id for x in self.cameras].index(camera_name)
-        # print(idx_in_cameras)
-        idxs_in_X = np.array(range(nvalues)) + nvalues * idx_in_cameras
-        # print(idxs_in_X)
-        return idxs_in_X
-
-    def idxsFromAruco(self, aruco_name, args):
-        if args['option2'] == 'all':
-            nvalues = 6
+        self.v = np.zeros(n_cameras * 6 + n_arucos * nvalues)
+
+        params_cameras = self.v[0:n_cameras * 6].reshape((n_cameras, 6))
+        params_arucos = self.v[n_cameras * 6:].reshape((n_arucos, nvalues))
+
+        self.tvecs_cameras = params_cameras[:, 0:3]
+        self.rvecs_cameras = params_cameras[:, 3:6]
+        self.tvecs_arucos = params_arucos[:, 0:3]
+        if nvalues == 6:
+            self.rvecs_arucos = params_arucos[:, 3:6]
         else:
-            nvalues = 3
-        # print(aruco_name)
-        n_cameras = len(self.cameras)
-        # print([x.id for x in self.arucos])
-        idx_in_arucos = [x.id for x in self.arucos].index(aruco_name)
-        # print(idx_in_arucos)
-        idxs_in_X = np.array(range(nvalues)) + nvalues * \
-            idx_in_arucos + n_cameras * nvalues
-        # print(idxs_in_X)
-        return idxs_in_X
+            # Rotations of the arucos are not optimized, so are kept out of the vector
+            self.rvecs_arucos = np.zeros((n_arucos, 3))
+
+        for i, camera in enumerate(self.cameras):
+            self.tvecs_cameras[i] = camera.tvec
+            self.rvecs_cameras[i] = camera.rvec
+            camera.bind(self.tvecs_cameras[i], self.rvecs_cameras[i])
+
+        for i, aruco in enumerate(self.arucos):
+            self.tvecs_arucos[i] = aruco.tvec
+            self.rvecs_arucos[i] = aruco.rvec
+            aruco.bind(self.tvecs_arucos[i], self.rvecs_arucos[i])
+
+    def fromVector(self, v, args):
+        """Loads the vector v of parameters (a single copy to self.v)
+        """
+        self.v[:] = v
+
+    def getTs(self):
+        """Transformation matrices of all cameras and of all arucos
+            Computed from the vector of parameters (see toVector), returns the
+            C x 4 x 4 and M x 4 x 4 arrays.
+        """
+        return (transformsFromVectors(self.tvecs_cameras, self.rvecs_cameras),
+                transformsFromVectors(self.tvecs_arucos, self.rvecs_arucos))
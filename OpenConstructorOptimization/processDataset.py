@@ -7,9 +7,13 @@
 import argparse
 import subprocess
 import numpy as np
-import glob
 import os
 from numpy.linalg import inv
+from archiveSources import isArchived
+from archiveSources import listFiles
+from archiveSources import openText
+from archiveSources import localCopy
+from archiveSources import extractedPath
 
 ##
 # @brief Executes the command in the shell in a blocking manner
@@ -33,7 +37,7 @@ def bash(cmd):
 #---------------------------------------
 ap = argparse.ArgumentParser()
 ap.add_argument('directory', metavar='Directory',
-                type=str, help='Directory of the dataset not optimized')
+                type=str, help='Directory of the dataset not optimized (or a directory inside a tar/zip archive)')
 
 ap.add_argument("-skip", action='store_true',
                 help="Pass the computation of the normals of the dataset not optimized", required=False)
@@ -43,13 +47,13 @@ args = vars(ap.parse_args())
 
 # Work directory
 Directory = args['directory']
-DirectoryOptimized = os.path.dirname(Directory) + "/dataset_optimized"
+DirectoryOptimized = os.path.dirname(extractedPath(Directory)) + "/dataset_optimized"
 
 Transformations = []
 TransformationsOptimized = []
 
 # Read initial data
-textfilenames = sorted(glob.glob((os.path.join(Directory, '00*.txt'))))
+textfilenames = listFiles(os.path.join(Directory, '00*.txt'))
 for w, cltx in enumerate(textfilenames):
     nt = len(cltx)
     if cltx[nt-6] == "-" or cltx[nt-7] == "-" or cltx[nt-8] == "-":
@@ -57,7 +61,7 @@ for w, cltx in enumerate(textfilenames):
 
 for j, namefile in enumerate(textfilenames):
     T = np.zeros((4, 4))
-    txtfile = open(namefile)
+    txtfile = openText(namefile)
     for i, line in enumerate(txtfile):
         if 0 < i < 5:
             paramVect = []
@@ -78,15 +82,23 @@ if not args['skip']:
         print 'The file ' + filename + ' is been processed...'
         print '\n---------------------------------------------\n'
 
-        bash('./compNormalPly.py' + ' ' + filename + ' ' + filename)
+        if isArchived(filename):
+            # The archive is not changed, the point cloud with normals is saved where
+            # the archive would be extracted
+            output = extractedPath(filename)
+            if not os.path.exists(os.path.dirname(output)):
+                os.makedirs(os.path.dirname(output))
+            with localCopy(filename) as source:
+                bash('./compNormalPly.py' + ' ' + source + ' ' + output)
+        else:
+            bash('./compNormalPly.py' + ' ' + filename + ' ' + filename)
 
         print '\n---------------------------------------------\n'
         print '------> The normals of the dataset not optimized were computed'
         print '\n---------------------------------------------\n'
 
 # Read optimized data
-textfilenames = sorted(
-    glob.glob((os.path.join(DirectoryOptimized, '00*.txt'))))
+textfilenames = listFiles(os.path.join(DirectoryOptimized, '00*.txt'))
 for w, cltx in enumerate(textfilenames):
     nt = len(cltx)
     if cltx[nt-6] == "-" or cltx[nt-7] == "-" or cltx[nt-8] == "-":
@@ -94,7 +106,7 @@ for w, cltx in enumerate(textfilenames):
 
 for j, namefile in enumerate(textfilenames):
     T = np.zeros((4, 4))
-    txtfile = open(namefile)
+    txtfile = openText(namefile)
     for i, line in enumerate(txtfile):
         if 0 < i < 5:
             paramVect = []
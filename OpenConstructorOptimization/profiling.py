@@ -0,0 +1,146 @@
+# Stage level profiling of the optimization
+#
+# Each stage (image load, detection, ..., solve) accumulates its wall time, CPU time
+# (including child processes), number of calls and the peak memory of the process.
+# Functions called many times, such as the cost function, are wrapped so that their
+# calls are counted and timed. Optionally, each stage is also run under cProfile and
+# its statistics are dumped to <stage>.prof.
+import os
+import time
+import json
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import resource  # peak memory, not available on windows
+except ImportError:
+    resource = None
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+try:
+    processTime = time.process_time
+except AttributeError:  # python 2, time.clock is the processor time on unix
+    processTime = time.clock
+
+
+def cpuTime():
+    """CPU time (user + system) of the process and of its finished children
+    """
+    t = os.times()
+    return processTime() + t[2] + t[3]
+
+
+def peakMemory():
+    """Peak resident memory of the process, in MB (None if unknown)
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageProfiler:
+    """Wall time, CPU time, calls and peak memory of the stages of a run
+        Stages are timed with the stage context manager and functions with wrap.
+        When disabled, stage and wrap do nothing. With cprofile_dir, a cProfile of
+        each stage is saved to that directory.
+    """
+
+    def __init__(self, enabled=True, cprofile_dir=None):
+        self.enabled = enabled
+        self.cprofile_dir = cprofile_dir
+        self.stages = {}
+        self.order = []
+        self.profiles = {}
+        self.profiling = False
+        self.start = time.time()
+
+    def record(self, name, wall, cpu):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0}
+            self.order.append(name)
+        stage = self.stages[name]
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall
+        stage['cpu_seconds'] += cpu
+        stage['peak_memory_mb'] = peakMemory()
+
+    @contextmanager
+    def stage(self, name):
+        """Accumulates the time of the code inside the with block in the stage name
+        """
+        if not self.enabled:
+            yield
+            return
+
+        # Only one cProfile at a time, the outermost stage
+        profile = None
+        if self.cprofile_dir is not None and not self.profiling:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            self.profiling = True
+            profile.enable()
+
+        wall = time.time()
+        cpu = cpuTime()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - wall, cpuTime() - cpu)
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+
+    def wrap(self, name, fun):
+        """Function that calls fun, counting and timing each call in the stage name
+        """
+        if not self.enabled:
+            return fun
+
+        def wrapper(*args, **kwargs):
+            wall = time.time()
+            cpu = cpuTime()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                self.record(name, time.time() - wall, cpuTime() - cpu)
+
+        return wrapper
+
+    def report(self):
+        """Dictionary with the stages, in the order they were first run
+        """
+        stages = []
+        for name in self.order:
+            stage = dict(self.stages[name])
+            stage['name'] = name
+            stage['wall_seconds_per_call'] = stage['wall_seconds'] / stage['calls']
+            stages.append(stage)
+
+        return {'total_wall_seconds': time.time() - self.start,
+                'total_cpu_seconds': cpuTime(),
+                'peak_memory_mb': peakMemory(),
+                'stages': stages}
+
+    def save(self, filename):
+        """Writes the report to a JSON file, and the cProfile of each stage
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+        if self.cprofile_dir is not None:
+            if not os.path.exists(self.cprofile_dir):
+                os.makedirs(self.cprofile_dir)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(self.cprofile_dir, name + '.prof'))
+
+    def printReport(self):
+        print("\n{0:<22}{1:>8}{2:>12}{3:>12}{4:>14}{5:>12}".format(
+            "Stage", "Calls", "Wall (s)", "CPU (s)", "Wall/call (s)", "Peak (MB)"))
+        for stage in self.report()['stages']:
+            print("{0:<22}{1:>8}{2:>12.3f}{3:>12.3f}{4:>14.2e}{5:>12}".format(
+                stage['name'], stage['calls'], stage['wall_seconds'], stage['cpu_seconds'],
+                stage['wall_seconds_per_call'],
+                "" if stage['peak_memory_mb'] is None else "{0:.1f}".format(stage['peak_memory_mb'])))
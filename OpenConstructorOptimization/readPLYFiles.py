@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 import openmesh as om
 import numpy as np
-import glob
 import os
 from numpy.linalg import inv
 import argparse
+from archiveSources import listFiles
+from archiveSources import openText
+from archiveSources import localCopy
+from archiveSources import extractedPath
 
 ap = argparse.ArgumentParser()
 
 ap.add_argument('directory', metavar='Directory',
-                type=str, help='Put the directory of the dataset not optimized')
+                type=str, help='Put the directory of the dataset not optimized (or a directory inside a tar/zip archive)')
 
 args = vars(ap.parse_args())
 
@@ -20,7 +23,7 @@ Transformations = []
 TransformationsOptimized = []
 
 # Read initial data
-textfilenames = sorted(glob.glob((os.path.join(Directory, '00*.txt'))))
+textfilenames = listFiles(os.path.join(Directory, '00*.txt'))
 for w, cltx in enumerate(textfilenames):
     nt = len(cltx)
     if cltx[nt-6] == "-" or cltx[nt-7] == "-" or cltx[nt-8] == "-":
@@ -28,7 +31,7 @@ for w, cltx in enumerate(textfilenames):
 
 for j, namefile in enumerate(textfilenames):
     T = np.zeros((4, 4))
-    txtfile = open(namefile)
+    txtfile = openText(namefile)
     for i, line in enumerate(txtfile):
         if 0 < i < 5:
             paramVect = []
@@ -41,8 +44,7 @@ for j, namefile in enumerate(textfilenames):
     txtfile.close()
 
 # Read optimized data
-textfilenames = sorted(
-    glob.glob((os.path.join(DirectoryOptimized, '00*.txt'))))
+textfilenames = listFiles(os.path.join(DirectoryOptimized, '00*.txt'))
 for w, cltx in enumerate(textfilenames):
     nt = len(cltx)
     if cltx[nt-6] == "-" or cltx[nt-7] == "-" or cltx[nt-8] == "-":
@@ -50,7 +52,7 @@ for w, cltx in enumerate(textfilenames):
 
 for j, namefile in enumerate(textfilenames):
     T = np.zeros((4, 4))
-    txtfile = open(namefile)
+    txtfile = openText(namefile)
     for i, line in enumerate(txtfile):
         if 0 < i < 5:
             paramVect = []
@@ -66,20 +68,23 @@ for text, Ti, To in zip(textfilenames, Transformations, TransformationsOptimized
 
     filename = text[:len(text)-3] + 'ply'
 
-    mesh = om.read_trimesh(filename=filename,
-                           binary=True,
-                           msb=True,
-                           lsb=True,
-                           swap=True,
-                           vertex_normal=True,
-                           vertex_color=False,
-                           vertex_tex_coord=False,
-                           halfedge_tex_coord=False,
-                           edge_color=False,
-                           face_normal=False,
-                           face_color=False,
-                           color_alpha=True,
-                           color_float=True)
+    # openmesh reads files by name, a point cloud inside an archive is read from a
+    # temporary copy
+    with localCopy(filename) as source:
+        mesh = om.read_trimesh(filename=source,
+                               binary=True,
+                               msb=True,
+                               lsb=True,
+                               swap=True,
+                               vertex_normal=True,
+                               vertex_color=False,
+                               vertex_tex_coord=False,
+                               halfedge_tex_coord=False,
+                               edge_color=False,
+                               face_normal=False,
+                               face_color=False,
+                               color_alpha=True,
+                               color_float=True)
 
     print('mesh has_vertex_normals ' + str(mesh.has_vertex_normals()))
     # exit(0)
@@ -119,7 +124,11 @@ for text, Ti, To in zip(textfilenames, Transformations, TransformationsOptimized
     # mesh.request_vertex_normals()
     # mesh.update_vertex_normals()
     # mesh.update_normals()
-    om.write_mesh(filename=filename,
+    # Saved where the archive would be extracted, for a point cloud inside an archive
+    output = extractedPath(filename)
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    om.write_mesh(filename=output,
                   mesh=mesh,
                   binary=False,
                   msb=False,
@@ -0,0 +1,187 @@
+# Vectorized SO(3) and SE(3) operations
+#
+# All the functions work on stacks of rotations and transforms: Rodrigues vectors
+# are ... x 3 arrays, rotations ... x 3 x 3 and transforms ... x 4 x 4, where ...
+# can be any number of leading dimensions (including none, for a single one).
+import numpy as np
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def skewMatrices(v):
+    """Skew-symmetric (cross product) matrices of a ... x 3 array of vectors
+    """
+    v = np.asarray(v, dtype=np.float64)
+    S = np.zeros(v.shape + (3,))
+    S[..., 0, 1] = -v[..., 2]
+    S[..., 0, 2] = v[..., 1]
+    S[..., 1, 0] = v[..., 2]
+    S[..., 1, 2] = -v[..., 0]
+    S[..., 2, 0] = -v[..., 1]
+    S[..., 2, 1] = v[..., 0]
+    return S
+
+
+def rodrigues2matrix(rods):
+    """Exponential map, from Rodrigues vectors to rotation matrices
+        Same result as cv2.Rodrigues, for a ... x 3 array of vectors.
+    """
+    rods = np.asarray(rods, dtype=np.float64)
+    theta = np.sqrt(np.sum(rods**2, axis=-1))
+    small = theta < 1e-6
+    th = np.where(small, 1.0, theta)
+
+    # R = I + a * skew(r) + b * skew(r)^2 (Taylor expansion for small angles)
+    a = np.where(small, 1 - theta**2 / 6.0, np.sin(th) / th)
+    b = np.where(small, 1/2.0 - theta**2 / 24.0, (1 - np.cos(th)) / th**2)
+
+    S = skewMatrices(rods)
+    return np.eye(3) + a[..., np.newaxis, np.newaxis] * S + \
+        b[..., np.newaxis, np.newaxis] * np.matmul(S, S)
+
+
+def matrix2rodrigues(R):
+    """Logarithmic map, from rotation matrices to Rodrigues vectors
+        Same result as cv2.Rodrigues, for a ... x 3 x 3 array of rotations.
+    """
+    R = np.asarray(R, dtype=np.float64)
+    cos = np.clip((np.trace(R, axis1=-2, axis2=-1) - 1) / 2.0, -1.0, 1.0)
+    theta = np.arccos(cos)
+
+    # Antisymmetric part of R, sin(theta) * axis
+    w = np.stack((R[..., 2, 1] - R[..., 1, 2],
+                  R[..., 0, 2] - R[..., 2, 0],
+                  R[..., 1, 0] - R[..., 0, 1]), axis=-1) / 2.0
+    sin = np.sqrt(np.sum(w**2, axis=-1))
+
+    # Rotations up to 90 degrees: axis from the antisymmetric part
+    ratio = np.where(sin < 1e-12, 1.0, theta / np.where(sin < 1e-12, 1.0, sin))
+    rods = w * ratio[..., np.newaxis]
+
+    # Larger rotations (where sin is not accurate): axis from the symmetric part,
+    # (R + R.T) / 2 - cos * I = (1 - cos) * axis * axis.T
+    large = cos < 0
+    if np.any(large):
+        Rl = R[large]
+        cosl = cos[large]
+        M = ((Rl + np.swapaxes(Rl, -1, -2)) / 2.0 - cosl[:, np.newaxis, np.newaxis] *
+             np.eye(3)) / (1 - cosl)[:, np.newaxis, np.newaxis]
+        k = np.argmax(np.diagonal(M, axis1=-2, axis2=-1), axis=-1)
+        n = np.arange(len(k))
+        axis = M[n, :, k] / np.sqrt(M[n, k, k])[:, np.newaxis]
+
+        # The sign of the axis is given by the antisymmetric part
+        sign = np.where(np.sum(axis * w[large], axis=-1) < 0, -1.0, 1.0)
+        rods[large] = axis * (sign * theta[large])[:, np.newaxis]
+
+    return rods
+
+
+def rodriguesRightJacobians(rods):
+    """Right Jacobians of the rotations given by a ... x 3 array of Rodrigues vectors
+        With R = Rodrigues(r), the derivative of R * p with respect to r is
+        -R * skew(p) * Jr(r), and the derivative of R.T * p is R.T * skew(p) * Jr(-r).
+    """
+    rods = np.asarray(rods, dtype=np.float64)
+    theta = np.sqrt(np.sum(rods**2, axis=-1))
+    small = theta < 1e-6
+    th = np.where(small, 1.0, theta)
+
+    # Coefficients of skew(r) and skew(r)^2 (Taylor expansion for small angles)
+    a = np.where(small, 1/2.0 - theta**2 / 24.0, (1 - np.cos(th)) / th**2)
+    b = np.where(small, 1/6.0 - theta**2 / 120.0, (th - np.sin(th)) / th**3)
+
+    S = skewMatrices(rods)
+    return np.eye(3) - a[..., np.newaxis, np.newaxis] * S + \
+        b[..., np.newaxis, np.newaxis] * np.matmul(S, S)
+
+
+def transformsFromVectors(tvecs, rvecs):
+    """4x4 transforms from ... x 3 arrays of translations and Rodrigues vectors
+    """
+    tvecs = np.asarray(tvecs, dtype=np.float64)
+    T = np.zeros(tvecs.shape[:-1] + (4, 4))
+    T[..., 0:3, 0:3] = rodrigues2matrix(rvecs)
+    T[..., 0:3, 3] = tvecs
+    T[..., 3, 3] = 1.0
+    return T
+
+
+def vectorsFromTransforms(T):
+    """Translations and Rodrigues vectors of a ... x 4 x 4 array of transforms
+    """
+    T = np.asarray(T, dtype=np.float64)
+    return T[..., 0:3, 3].copy(), matrix2rodrigues(T[..., 0:3, 0:3])
+
+
+def invertTransforms(T):
+    """Inverse of rigid transforms in closed form, (R, t) -> (R.T, -R.T * t)
+    """
+    T = np.asarray(T, dtype=np.float64)
+    Rt = np.swapaxes(T[..., 0:3, 0:3], -1, -2)
+    Ti = np.zeros(T.shape)
+    Ti[..., 0:3, 0:3] = Rt
+    Ti[..., 0:3, 3] = -np.einsum('...ij,...j->...i', Rt, T[..., 0:3, 3])
+    Ti[..., 3, 3] = 1.0
+    return Ti
+
+
+def composeTransforms(Ta, Tb):
+    """Composition Ta * Tb of (broadcastable) stacks of rigid transforms
+    """
+    return np.matmul(Ta, Tb)
+
+
+def quaternionsFromMatrices(R):
+    """Unit quaternions (qw, qx, qy, qz), with qw >= 0, of a ... x 3 x 3 array of
+        rotations (or ... x 4 x 4 transforms). As quaternion_from_matrix of
+        transformations.py: the eigenvector of the largest eigenvalue of the symmetric
+        matrix K of Bar-Itzhack, so that the rotations need not be precise.
+    """
+    R = np.asarray(R, dtype=np.float64)[..., 0:3, 0:3]
+    m00, m01, m02 = R[..., 0, 0], R[..., 0, 1], R[..., 0, 2]
+    m10, m11, m12 = R[..., 1, 0], R[..., 1, 1], R[..., 1, 2]
+    m20, m21, m22 = R[..., 2, 0], R[..., 2, 1], R[..., 2, 2]
+
+    # K in the order (qx, qy, qz, qw)
+    K = np.zeros(R.shape[:-2] + (4, 4))
+    K[..., 0, 0] = m00 - m11 - m22
+    K[..., 1, 1] = m11 - m00 - m22
+    K[..., 2, 2] = m22 - m00 - m11
+    K[..., 3, 3] = m00 + m11 + m22
+    K[..., 1, 0] = K[..., 0, 1] = m01 + m10
+    K[..., 2, 0] = K[..., 0, 2] = m02 + m20
+    K[..., 2, 1] = K[..., 1, 2] = m12 + m21
+    K[..., 3, 0] = K[..., 0, 3] = m21 - m12
+    K[..., 3, 1] = K[..., 1, 3] = m02 - m20
+    K[..., 3, 2] = K[..., 2, 3] = m10 - m01
+    K /= 3.0
+
+    _, V = np.linalg.eigh(K)
+    q = V[..., [3, 0, 1, 2], -1]
+    return q * np.where(q[..., 0:1] < 0, -1.0, 1.0)
+
+
+def transformsFromQuaternions(tvecs, quaternions):
+    """4x4 transforms from ... x 3 arrays of translations and ... x 4 arrays of
+        quaternions (qw, qx, qy, qz), which are normalized
+    """
+    q = np.asarray(quaternions, dtype=np.float64)
+    q = q / np.linalg.norm(q, axis=-1)[..., np.newaxis]
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    T = np.zeros(q.shape[:-1] + (4, 4))
+    T[..., 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+    T[..., 0, 1] = 2.0 * (x * y - z * w)
+    T[..., 0, 2] = 2.0 * (x * z + y * w)
+    T[..., 1, 0] = 2.0 * (x * y + z * w)
+    T[..., 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+    T[..., 1, 2] = 2.0 * (y * z - x * w)
+    T[..., 2, 0] = 2.0 * (x * z - y * w)
+    T[..., 2, 1] = 2.0 * (y * z + x * w)
+    T[..., 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+    T[..., 0:3, 3] = tvecs
+    T[..., 3, 3] = 1.0
+    return T
@@ -0,0 +1,131 @@
+# Synthetic scenes with known ground truth
+#
+# Arucos lie on the floor (the plane of aruco 0, which is the map), spaced along a
+# strip, and the cameras look down at them from a trajectory along the strip, so
+# that consecutive images share arucos. The detections are the projections of the
+# corners with gaussian noise, and the pose of each detection is estimated from the
+# noisy corners, as done for the real images.
+import numpy as np
+import cv2
+
+from rigidTransforms import rodrigues2matrix
+from rigidTransforms import transformsFromVectors
+from rigidTransforms import invertTransforms
+from rigidTransforms import composeTransforms
+
+from myClasses import stru
+from myClasses import MyX
+from myClasses import MyCamera
+from myClasses import MyAruco
+from myClasses import DetectionTable
+from costFunctions import points2imageFromTs
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+def arucoCorners(marksize):
+    """Corners of an aruco in its own frame, in the order of the aruco detection
+    """
+    l = marksize
+    return np.array([[-l/2, l/2, 0], [l/2, l/2, 0],
+                     [l/2, -l/2, 0], [-l/2, -l/2, 0]])
+
+
+def syntheticScene(n_cameras, n_arucos=None, marksize=0.082, noise=0.5, visibility=0.9,
+                   spacing=0.25, height=1.0, width=1280, height_image=960, seed=0):
+    """Generates a scene with n_cameras images of n_arucos arucos
+        noise is the standard deviation (pixels) of the detected corners, visibility
+        the probability of detecting an aruco that is inside an image. Returns a stru
+        with the ground truth X (cameras and arucos in the frame of aruco 0), the
+        detections (a DetectionTable), intrinsics, dist, width and height.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    if n_arucos is None:
+        n_arucos = max(2, n_cameras // 2)
+
+    # Intrinsics of a 1280 x 960 camera, with some distortion
+    intrinsics = np.array([[1000.0, 0, width / 2.0, 0],
+                           [0, 1000.0, height_image / 2.0, 0],
+                           [0, 0, 1, 0]])
+    dist = np.array([[0.05, -0.1, 0.001, -0.001, 0.02]])
+
+    # Arucos along the strip, rotated around the normal of the floor
+    xyz_arucos = np.zeros((n_arucos, 3))
+    xyz_arucos[:, 0] = np.arange(n_arucos) * spacing
+    xyz_arucos[1:, 1] = rng.uniform(-0.15, 0.15, n_arucos - 1)
+    rods_arucos = np.zeros((n_arucos, 3))
+    rods_arucos[1:, 2] = rng.uniform(-np.pi, np.pi, n_arucos - 1)
+    Tas = transformsFromVectors(xyz_arucos, rods_arucos)
+
+    # Cameras looking down, with some tilt, along the strip
+    xyz_cameras = np.zeros((n_cameras, 3))
+    xyz_cameras[:, 0] = np.linspace(0, (n_arucos - 1) * spacing, n_cameras)
+    xyz_cameras[:, 1] = rng.uniform(-0.1, 0.1, n_cameras)
+    xyz_cameras[:, 2] = height + rng.uniform(-0.05, 0.05, n_cameras)
+    tilt = rng.normal(size=(n_cameras, 3)) * 0.1
+    tilt[:, 2] = rng.uniform(-np.pi, np.pi, n_cameras)
+    R_down = rodrigues2matrix(np.array([np.pi, 0, 0]))
+    Tcs = transformsFromVectors(xyz_cameras, np.zeros((n_cameras, 3)))
+    Tcs[:, 0:3, 0:3] = np.matmul(R_down, rodrigues2matrix(tilt))
+
+    # Candidate pairs: arucos close enough to the camera (along the strip)
+    reach = 2 * height
+    first = np.searchsorted(xyz_arucos[:, 0], xyz_cameras[:, 0] - reach)
+    last = np.searchsorted(xyz_arucos[:, 0], xyz_cameras[:, 0] + reach)
+    cameras = np.repeat(np.arange(n_cameras), last - first)
+    arucos = np.concatenate([np.arange(a, b) for a, b in zip(first, last)] +
+                            [np.zeros(0, dtype=int)])
+
+    # Visible if all the corners are in front of the camera and inside the image
+    Pc = arucoCorners(marksize)
+    Ts = composeTransforms(invertTransforms(Tcs)[cameras], Tas[arucos])
+    xyz = np.einsum('dij,pj->dpi', Ts[:, 0:3, 0:3], Pc) + Ts[:, np.newaxis, 0:3, 3]
+    xypix = points2imageFromTs(Ts, intrinsics, Pc, dist)
+    visible = np.all(xyz[:, :, 2] > 0.1, axis=1) & \
+        np.all((xypix[:, :, 0] >= 0) & (xypix[:, :, 0] < width) &
+               (xypix[:, :, 1] >= 0) & (xypix[:, :, 1] < height_image), axis=1) & \
+        (rng.uniform(size=len(cameras)) < visibility)
+
+    cameras = cameras[visible]
+    arucos = arucos[visible]
+    corners = xypix[visible] + rng.normal(size=xypix[visible].shape) * noise
+
+    # Pose of each detection from its noisy corners
+    mtx = intrinsics[:, 0:3]
+    flags = getattr(cv2, 'SOLVEPNP_IPPE_SQUARE', cv2.SOLVEPNP_ITERATIVE)
+    rvecs = np.zeros((len(cameras), 3))
+    tvecs = np.zeros((len(cameras), 3))
+    for i in range(len(cameras)):
+        _, rvec, tvec = cv2.solvePnP(Pc, corners[i].reshape((4, 1, 2)), mtx, dist,
+                                     flags=flags)
+        rvecs[i] = rvec.ravel()
+        tvecs[i] = tvec.ravel()
+
+    detections = DetectionTable()
+    starts = np.searchsorted(cameras, np.arange(n_cameras + 1))
+    for k in range(n_cameras):
+        a, b = starts[k], starts[k + 1]
+        if b > a:
+            detections.add(k, arucos[a:b], corners[a:b], rvecs[a:b], tvecs[a:b], k)
+    detections.build()
+
+    # Ground truth
+    X = MyX()
+    for k in range(n_cameras):
+        X.cameras.append(MyCamera(T=Tcs[k], id=str(k)))
+    for j in range(n_arucos):
+        X.arucos.append(MyAruco(T=Tas[j], id=str(j)))
+
+    scene = stru()
+    scene.X = X
+    scene.detections = detections
+    scene.intrinsics = intrinsics
+    scene.dist = dist
+    scene.marksize = marksize
+    scene.width = width
+    scene.height = height_image
+    return scene
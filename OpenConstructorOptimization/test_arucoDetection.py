@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Tests of the reading of the images in the aruco detection
+
+The images are decoded by prefetchImages in a background thread. An error reading an
+image (e.g. a file listed in an archive that is not there) must be raised to the
+caller instead of leaving it waiting for the image. Run with
+python -m unittest test_arucoDetection (or pytest).
+"""
+
+#-------------------------------------------------------------------------------
+#--- IMPORT MODULES
+#-------------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+import numpy as np
+import cv2
+
+from arucoDetection import prefetchImages
+
+#-------------------------------------------------------------------------------
+#--- TESTS
+#-------------------------------------------------------------------------------
+
+
+class TestPrefetchImages(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        ok, data = cv2.imencode('.png', np.zeros((8, 8, 3), dtype=np.uint8))
+        self.archive = os.path.join(self.directory, 'dataset.zip')
+        with zipfile.ZipFile(self.archive, 'w') as f:
+            f.writestr('dataset/00000000.png', data.tobytes())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def consume(self, filenames, timeout=10):
+        """Images read by prefetchImages and the error raised, in a thread that must
+            end before timeout (seconds)
+        """
+        result = {'images': [], 'error': None}
+
+        def run():
+            try:
+                for loaded in prefetchImages(filenames):
+                    result['images'].append(loaded[0])
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "prefetchImages is waiting for an image")
+        return result
+
+    def test_images_are_read(self):
+        result = self.consume([os.path.join(self.archive, 'dataset', '00000000.png')] * 3)
+        self.assertIsNone(result['error'])
+        self.assertEqual([image.shape for image in result['images']], [(8, 8, 3)] * 3)
+
+    def test_error_is_raised(self):
+        filenames = [os.path.join(self.archive, 'dataset', '00000000.png'),
+                     os.path.join(self.archive, 'dataset', '00000001.png')]
+        result = self.consume(filenames)
+        self.assertIsInstance(result['error'], IOError)
+        self.assertEqual(len(result['images']), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Tests of the reading of the images of a dataset
+
+A frame or image that can not be read raises IOError, instead of giving None to the
+detection. The frames listed for a video are those that can be read. Run with
+python -m unittest test_imageSources (or pytest).
+"""
+
+#-------------------------------------------------------------------------------
+#--- IMPORT MODULES
+#-------------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import cv2
+
+from imageSources import ImageReader
+from imageSources import videoFrames
+
+#-------------------------------------------------------------------------------
+#--- TESTS
+#-------------------------------------------------------------------------------
+
+
+class TestImageReader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.video = os.path.join(self.directory, 'video.avi')
+        writer = cv2.VideoWriter(self.video, cv2.VideoWriter_fourcc(*'MJPG'), 10, (16, 16))
+        for i in range(5):
+            writer.write(np.full((16, 16, 3), 40 * i, dtype=np.uint8))
+        writer.release()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_frames_of_video(self):
+        frames = videoFrames(self.video)
+        self.assertEqual(frames, [self.video + '#' + str(k) for k in range(5)])
+
+        reader = ImageReader(grayscale=True)
+        try:
+            for name in frames:
+                self.assertEqual(reader.read(name).shape, (16, 16))
+        finally:
+            reader.close()
+
+    def test_missing_frame_raises(self):
+        reader = ImageReader()
+        try:
+            self.assertRaises(IOError, reader.read, self.video + '#7')
+        finally:
+            reader.close()
+
+    def test_missing_image_raises(self):
+        reader = ImageReader()
+        self.assertRaises(IOError, reader.read, os.path.join(self.directory, '00000000.jpg'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Tests of the analytic jacobian of the cost function
+
+The closed form jacobian (jacobianFunction) is compared with the finite difference
+jacobian of the cost function, on a small synthetic scene, for all the modes of the
+optimization (center or corners, all or translation, distance or coordinates) and
+with and without lens distortion. Run with python -m unittest test_jacobian (or
+pytest).
+"""
+
+#-------------------------------------------------------------------------------
+#--- IMPORT MODULES
+#-------------------------------------------------------------------------------
+import itertools
+import unittest
+import numpy as np
+from scipy.optimize._numdiff import approx_derivative
+
+from myClasses import MyX
+from myClasses import MyCamera
+from myClasses import MyAruco
+from costFunctions import costFunction
+from costFunctions import jacobianFunction
+from syntheticScene import syntheticScene
+from syntheticScene import arucoCorners
+
+#-------------------------------------------------------------------------------
+#--- MY FUNCTIONS
+#-------------------------------------------------------------------------------
+
+# Distortions (k1, k2, p1, p2, k3) of the tests: none, and all the coefficients
+DISTORTIONS = [np.zeros((1, 5)),
+               np.array([[0.1, -0.2, 0.003, -0.002, 0.05]])]
+
+# Largest error relative to the largest derivative. The differences of the distances
+# (square roots) have a larger truncation error than those of the coordinates.
+TOLERANCES = {'coordinates': 1e-8, 'distance': 1e-5}
+
+
+def perturbed(X_true, sigma, seed):
+    """Copy of X_true with gaussian noise in all the parameters, so that no residual
+        is zero (the distances are not differentiable there)
+    """
+    rng = np.random.RandomState(seed)
+    X = MyX()
+    for camera in X_true.cameras:
+        c = MyCamera(T=camera.getT(), id=camera.id)
+        c.tvec += rng.normal(size=c.tvec.shape) * sigma
+        c.rvec += rng.normal(size=c.rvec.shape) * sigma
+        X.cameras.append(c)
+    for aruco in X_true.arucos:
+        a = MyAruco(T=aruco.getT(), id=aruco.id)
+        a.tvec += rng.normal(size=a.tvec.shape) * sigma
+        a.rvec += rng.normal(size=a.rvec.shape) * sigma
+        X.arucos.append(a)
+    return X
+
+
+def jacobians(option1, option2, residuals, dist):
+    """Analytic and finite difference jacobians of the cost function of a synthetic scene
+    """
+    args = {'option1': option1, 'option2': option2, 'option3': 'fromaruco',
+            'residuals': residuals, 'do': False}
+
+    scene = syntheticScene(6, seed=1)
+    seen_cameras = set(scene.detections.cameras.tolist())
+    seen_arucos = set(scene.detections.arucos.tolist())
+    X = perturbed(scene.X, 0.01, 2)
+    X.cameras = [c for c in X.cameras if int(c.id) in seen_cameras]
+    X.arucos = [a for a in X.arucos if int(a.id) in seen_arucos]
+
+    if option1 == 'corners':
+        Pc = arucoCorners(scene.marksize)
+    else:
+        Pc = np.array([[0, 0, 0]])
+
+    X.toVector(args)
+    x0 = np.array(X.v, dtype=np.float64)
+    fun_args = (dist, scene.intrinsics, X, Pc, scene.detections, args, [], None, None)
+
+    costFunction.counter = 0
+    jacobianFunction.counter = 0
+
+    J = jacobianFunction(x0, *fun_args).toarray()
+    Jfd = approx_derivative(lambda x: costFunction(x, *fun_args), x0, method='3-point')
+    return J, Jfd
+
+#-------------------------------------------------------------------------------
+#--- TESTS
+#-------------------------------------------------------------------------------
+
+
+class TestJacobian(unittest.TestCase):
+
+    def test_jacobian_matches_finite_differences(self):
+        for option1, option2, residuals in itertools.product(
+                ['center', 'corners'], ['all', 'translation'], ['distance', 'coordinates']):
+            for dist in DISTORTIONS:
+                J, Jfd = jacobians(option1, option2, residuals, dist)
+                mode = ' '.join([option1, option2, residuals, 'dist=' + str(dist.ravel())])
+
+                self.assertEqual(J.shape, Jfd.shape, mode)
+                self.assertTrue(np.max(np.abs(Jfd)) > 0, mode)
+                error = np.max(np.abs(J - Jfd)) / np.max(np.abs(Jfd))
+                self.assertLess(error, TOLERANCES[residuals], mode + ': relative error ' + str(error))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Tuning of the aruco detector for a dataset
+
+Detects the arucos of a sample of the images of a dataset with the default
+DetectorParameters and searches for the fastest parameters that detect the same ids
+with the same corners (within a tolerance). The parameters are saved to
+detector_parameters.json in the directory of the dataset, and Optimization.py uses
+them for that dataset.
+"""
+
+#-------------------------------------------------------------------------------
+#--- IMPORT MODULES
+#-------------------------------------------------------------------------------
+import time  # Estimate time of process
+import os
+import json
+import argparse  # Read command line arguments
+import numpy as np  # Arrays and opencv images
+import cv2  # OpenCV library
+import cv2.aruco as aruco  # Aruco Markers
+
+#-------------------------------------------------------------------------------
+#--- DEFINITIONS
+#-------------------------------------------------------------------------------
+from arucoDetection import detectorProfileFilename
+from arucoDetection import arucoDictionary
+from arucoDetection import detectorParameters
+from arucoDetection import detectMarkers
+from imageSources import isVideo
+from imageSources import videoFrames
+from imageSources import ImageReader
+from archiveSources import listFiles
+
+# Values tried for each group of parameters, the first are the defaults. The
+# adaptive threshold is computed for each window size from min to max (by step), the
+# contour filters drop candidates before their bits are read.
+SEARCH = [
+    [{'adaptiveThreshWinSizeMin': 3, 'adaptiveThreshWinSizeMax': 23, 'adaptiveThreshWinSizeStep': 10},
+     {'adaptiveThreshWinSizeMin': 3, 'adaptiveThreshWinSizeMax': 23, 'adaptiveThreshWinSizeStep': 20},
+     {'adaptiveThreshWinSizeMin': 5, 'adaptiveThreshWinSizeMax': 15, 'adaptiveThreshWinSizeStep': 10},
+     {'adaptiveThreshWinSizeMin': 7, 'adaptiveThreshWinSizeMax': 7, 'adaptiveThreshWinSizeStep': 10},
+     {'adaptiveThreshWinSizeMin': 13, 'adaptiveThreshWinSizeMax': 13, 'adaptiveThreshWinSizeStep': 10},
+     {'adaptiveThreshWinSizeMin': 23, 'adaptiveThreshWinSizeMax': 23, 'adaptiveThreshWinSizeStep': 10}],
+    [{'minMarkerPerimeterRate': 0.03},
+     {'minMarkerPerimeterRate': 0.05},
+     {'minMarkerPerimeterRate': 0.08},
+     {'minMarkerPerimeterRate': 0.12}],
+    [{'maxMarkerPerimeterRate': 4.0},
+     {'maxMarkerPerimeterRate': 2.0},
+     {'maxMarkerPerimeterRate': 1.0}],
+    [{'polygonalApproxAccuracyRate': 0.03},
+     {'polygonalApproxAccuracyRate': 0.05}],
+    [{'perspectiveRemovePixelPerCell': 4},
+     {'perspectiveRemovePixelPerCell': 2}],
+]
+
+#-------------------------------------------------------------------------------
+#--- MY FUNCTIONS
+#-------------------------------------------------------------------------------
+
+
+def detectSample(grays, dictionary, values, repeats):
+    """Detections of the gray images with the DetectorParameters values
+        Returns the detections (a dictionary from id to corners, for each image) and
+        the best of repeats times of the detection of all the images.
+    """
+    parameters = detectorParameters(values)
+    best = np.inf
+    for _ in range(repeats):
+        wall = time.time()
+        detections = [detectMarkers(gray, dictionary, parameters)[0:2] for gray in grays]
+        best = min(best, time.time() - wall)
+
+    found = []
+    for corners, ids in detections:
+        ids = [] if ids is None else ids.ravel().tolist()
+        found.append(dict((i, corner.reshape((4, 2))) for i, corner in zip(ids, corners)))
+    return found, best
+
+
+def sameDetections(reference, found, tolerance):
+    """True if found has the ids of the reference in each image, and their corners are
+        within tolerance pixels
+    """
+    for expected, image in zip(reference, found):
+        if sorted(expected.keys()) != sorted(image.keys()):
+            return False
+        for i, corners in expected.items():
+            if np.max(np.abs(image[i] - corners)) > tolerance:
+                return False
+    return True
+
+
+def perimeterRates(grays, reference):
+    """Smallest and largest perimeter of the arucos of the reference, relative to the
+        largest dimension of their image (as minMarkerPerimeterRate)
+    """
+    rates = [np.sum(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1)) /
+             max(gray.shape) for gray, image in zip(grays, reference)
+             for corners in image.values()]
+    return min(rates), max(rates)
+
+
+def tuneParameters(grays, dictionary, tolerance=0.5, repeats=3, gain=0.05, verbose=True):
+    """Fastest DetectorParameters values that detect the same as the defaults
+        Each group of SEARCH is tuned in turn, keeping the fastest of its values that
+        gives the same detections and is at least gain (fraction) faster. The limits
+        of the perimeter of the arucos keep a factor of 2 to the arucos of the sample,
+        so that smaller or larger arucos in the other images are still detected.
+        Returns the values, the time of the defaults and the time of the tuned values.
+    """
+    values = {}
+    reference, default_time = detectSample(grays, dictionary, values, repeats)
+    best_time = default_time
+    if verbose:
+        print("Defaults: " + str(sum(len(image) for image in reference)) +
+              " arucos in " + "{0:.3f}".format(default_time) + " s")
+    if not any(reference):
+        return values, default_time, best_time
+
+    smallest, largest = perimeterRates(grays, reference)
+
+    for group in SEARCH:
+        best = {}
+        for option in group[1:]:
+            if option.get('minMarkerPerimeterRate', 0) > smallest / 2 or \
+                    option.get('maxMarkerPerimeterRate', np.inf) < largest * 2:
+                continue
+
+            candidate = dict(values)
+            candidate.update(option)
+            found, wall = detectSample(grays, dictionary, candidate, repeats)
+            same = sameDetections(reference, found, tolerance)
+            if verbose:
+                print("  " + str(option) + ": " + "{0:.3f}".format(wall) + " s" +
+                      ("" if same else " (different detections)"))
+            if same and wall < best_time * (1 - gain):
+                best, best_time = option, wall
+        values.update(best)
+
+    return values, default_time, best_time
+
+
+#-------------------------------------------------------------------------------
+#--- MAIN
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    #---------------------------------------
+    #--- Argument parser
+    #---------------------------------------
+    ap = argparse.ArgumentParser()
+    ap.add_argument('dir', metavar='Directory',
+                    type=str, help='Directory of the dataset (or video, or directory inside a tar/zip archive)')
+    ap.add_argument("-images", type=int, default=8,
+                    help="Number of images of the sample, spread over the dataset", required=False)
+    ap.add_argument("-tolerance", type=float, default=0.5,
+                    help="Largest difference (pixels) to the corners found with the default parameters", required=False)
+    ap.add_argument("-repeats", type=int, default=3,
+                    help="Each setting is timed this number of times (the best is kept)", required=False)
+    ap.add_argument("-n", action='store_true',
+                    help="Do not save the profile, only show the results", required=False)
+
+    args = vars(ap.parse_args())
+
+    if isVideo(args['dir']):
+        filenames = videoFrames(args['dir'])
+    else:
+        filenames = sorted(listFiles(os.path.join(args['dir'], '*.jpg')) +
+                           listFiles(os.path.join(args['dir'], '*.png')))
+    if not filenames:
+        ap.error("no images (jpg or png) in " + args['dir'])
+
+    sample = np.unique(np.linspace(0, len(filenames) - 1, args['images']).round().astype(int))
+    reader = ImageReader(grayscale=True)
+    grays = [reader.read(filenames[i]) for i in sample]
+    reader.close()
+
+    # Same dictionary as Optimization.py
+    dictionary = arucoDictionary(aruco.DICT_ARUCO_ORIGINAL)
+
+    cv2.setNumThreads(1)  # as in the workers of the detection
+    values, default_time, best_time = tuneParameters(grays, dictionary, args['tolerance'],
+                                                     args['repeats'])
+
+    print("\nParameters: " + str(values))
+    print("Detection of the sample: " + "{0:.3f}".format(default_time) + " s with the defaults, " +
+          "{0:.3f}".format(best_time) + " s tuned")
+
+    if not args['n']:
+        profile = {'parameters': values,
+                   'images': [os.path.basename(filenames[i]) for i in sample],
+                   'tolerance': args['tolerance'],
+                   'default_seconds': default_time,
+                   'tuned_seconds': best_time,
+                   'opencv': cv2.__version__}
+        filename = detectorProfileFilename(args['dir'])
+        with open(filename, 'w') as f:
+            json.dump(profile, f, indent=2, sort_keys=True)
+        print("Profile saved to " + filename)
@@ -32,6 +32,7 @@ from itertools import combinations
 #-------------------------------------------------------------------------------
 from myClasses import *
 from costFunctions import *
+from arucoDetection import detectArucos
 
 #-------------------------------------------------------------------------------
 #--- HEADER
@@ -68,6 +69,10 @@ if __name__ == "__main__":
                     help="do not optimize", required=False)
     ap.add_argument("-do", action='store_true',
                     help="to draw during optimization", required=False)
+    ap.add_argument("-workers", type=int,
+                    help="Number of processes of the aruco detection (default: all the cores)", required=False)
+    ap.add_argument("-mapNode", metavar="NODE", default='Map',
+                    help="Node of the graph that is the frame of the map (default: Map, the frame of the robot), e.g. A0 or C3, or auto: the aruco or camera with the cheapest paths to all the others", required=False)
 
     args = vars(ap.parse_args())
 
@@ -83,8 +88,7 @@ if __name__ == "__main__":
     d = np.load("CameraParameters/cameraParameters.npy")
 
     # Define aruco dictionary
-    aruco_dict = aruco.Dictionary_get(aruco.DICT_ARUCO_ORIGINAL)
-    parameters = aruco.DetectorParameters_create()
+    aruco_dict = aruco.DICT_ARUCO_ORIGINAL
     marksize = 0.082
 
     # Intrinsic matrix and distortion vector
@@ -98,20 +102,18 @@ if __name__ == "__main__":
         plt.ion()
         fig1 = plt.figure()
 
-    # Detect Aruco Markers
+    # Detect Aruco Markers, each image in a worker of a pool of processes
+    images = detectArucos(filenames, aruco_dict, marksize, mtx, dist,
+                          workers=args['workers'], keep_images=args['d'] or args['do'])
+
     detections = []
 
     K = len(filenames)  # number of cameras
-    k = 0
-    for filename in filenames:
-
-        # load image
-        raw = cv2.imread(filename)
-        gray = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+    for k, image in enumerate(images):
 
-        # lists of ids and the corners beloning to each id
-        corners, ids, _ = aruco.detectMarkers(
-            gray, aruco_dict, parameters=parameters)
+        raw = image.raw
+        corners = image.corners
+        ids = image.ids
 
         font = cv2.FONT_HERSHEY_SIMPLEX  # font for displaying text
 
@@ -119,9 +121,7 @@ if __name__ == "__main__":
             print "----------------------------"
             print("> Camera " + str(k))
 
-            # Estimate pose of each marker
-            rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(
-                corners, marksize, mtx, dist)
+            rvecs, tvecs = image.rvecs, image.tvecs
 
             for rvec, tvec, idd, corner in zip(rvecs, tvecs, ids, corners):
 
@@ -138,7 +138,8 @@ if __name__ == "__main__":
                     # cv2.putText(raw, "Id:" + str(idd[0]), (corner[0][0, 0],
                     #    corner[0][0, 1]), font, 5, (0, 255, 0), 5, cv2.LINE_AA)
 
-            raw = aruco.drawDetectedMarkers(raw, corners)
+            if args['d'] or args['do']:
+                raw = aruco.drawDetectedMarkers(raw, corners)
 
         if args['d'] or args['do']:
             # drawing sttuff
@@ -158,7 +159,6 @@ if __name__ == "__main__":
                            corner[0][2, 1] + corner[0][3, 1])/4
                     ax.scatter(xcm, ycm, marker='s',
                                facecolors='none', edgecolors='r', s=50)
-        k = k+1
 
     #---------------------------------------
     #--- Initial guess for parameters (create x0).
@@ -198,15 +198,24 @@ if __name__ == "__main__":
     if not nx.is_connected(GA):
         exit()
 
-    map_node = 'Map'  # to be defined by hand
+    if args['mapNode'] == 'auto':
+        # Same rule as centralNode of OpenConstructorOptimization/initialGuess.py: the
+        # aruco or camera with the smallest average cost of its cheapest paths to the
+        # other nodes (ties go to the first one by name). The results are then in its
+        # frame instead of the frame of the robot.
+        def averageCost(node):
+            costs = nx.single_source_dijkstra_path_length(GA, node, weight='weight')
+            return sum(costs.values()) / float(max(len(costs) - 1, 1))
+
+        map_node = min(sorted(node for node in GA.nodes if node[0] in ('A', 'C')),
+                       key=averageCost)
+    else:
+        map_node = args['mapNode']
 
-    while not map_node in GA.nodes:
-        # raise ValueError('Must define a map that exists in the graph. Should be one of ' + str(GA.nodes))
+    if not map_node in GA.nodes:
         print 'Must define a map that exists in the graph. \nShould be one of ' + \
             str(GA.nodes)
-        name = raw_input("Insert a valid map node: ")
-        map_node = str(name)
-        print "\n"
+        exit()
 
     print "-> Map node is " + map_node
     print "-----------------------\n"
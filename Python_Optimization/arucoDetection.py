@@ -0,0 +1,117 @@
+# Detection of the arucos in the images, in parallel
+#
+# Each image is read, converted to gray, its arucos detected and their poses
+# estimated by a worker of a process pool. The results come back in the order of the
+# filenames, so the camera k is always the image k, as in the serial detection.
+import time
+import multiprocessing
+import numpy as np
+import cv2
+import cv2.aruco as aruco  # Aruco Markers
+
+try:
+    processTime = time.process_time
+except AttributeError:  # python 2, time.clock is the processor time on unix
+    processTime = time.clock
+
+#-------------------------------------------------------------------------------
+#--- FUNCTION DEFINITION
+#-------------------------------------------------------------------------------
+
+
+class ImageDetections:
+    """Arucos detected in one image
+        corners, ids, rvecs and tvecs as given by aruco.detectMarkers and
+        aruco.estimatePoseSingleMarkers (ids is None if there are no arucos), shape of
+        the image, the image itself (raw, if kept) and the wall / cpu time of each step.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.corners = []
+        self.ids = None
+        self.rvecs = None
+        self.tvecs = None
+        self.raw = None
+        self.shape = None
+        self.timings = []
+
+
+def detectorParameters(values=None):
+    """aruco.DetectorParameters with the given values (a dictionary) changed
+        DetectorParameters can not be pickled, so the workers get the dictionary.
+    """
+    parameters = aruco.DetectorParameters_create()
+    if values:
+        for name, value in values.items():
+            setattr(parameters, name, value)
+    return parameters
+
+
+def detectImage(job):
+    """Reads one image and detects its arucos (the work of each worker)
+    """
+    filename, dictionary, parameters, marksize, mtx, dist, keep_image = job
+
+    image = ImageDetections(filename)
+
+    wall, cpu = time.time(), processTime()
+    raw = cv2.imread(filename)
+    image.timings.append(('image_load', time.time() - wall, processTime() - cpu))
+    image.shape = raw.shape
+
+    wall, cpu = time.time(), processTime()
+    gray = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+
+    # lists of ids and the corners beloning to each id
+    image.corners, image.ids, _ = aruco.detectMarkers(
+        gray, aruco.Dictionary_get(dictionary), parameters=detectorParameters(parameters))
+    image.timings.append(('aruco_detection', time.time() - wall, processTime() - cpu))
+
+    if image.ids is not None and len(image.ids) > 0:
+        # Estimate pose of each marker
+        wall, cpu = time.time(), processTime()
+        image.rvecs, image.tvecs, _ = aruco.estimatePoseSingleMarkers(
+            image.corners, marksize, mtx, dist)
+        image.timings.append(('pose_estimation', time.time() - wall, processTime() - cpu))
+
+    if keep_image:
+        image.raw = raw
+
+    return image
+
+
+def initWorker():
+    # Each worker uses a single thread, the parallelism is between the images
+    cv2.setNumThreads(1)
+
+
+def detectArucos(filenames, dictionary, marksize, mtx, dist, parameters=None, workers=None,
+                 keep_images=True):
+    """Detects the arucos of all the images, with a pool of workers processes
+        dictionary is the id of the aruco dictionary (e.g. aruco.DICT_ARUCO_ORIGINAL),
+        parameters a dictionary of values of the DetectorParameters and workers the
+        number of processes (all the cores by default, 1 for no pool). Returns a list
+        with the ImageDetections of each filename, in the same order. Without
+        keep_images the images are not sent back to the main process.
+    """
+
+    jobs = [(filename, dictionary, parameters, marksize, np.asarray(mtx), np.asarray(dist),
+             keep_images) for filename in filenames]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(jobs)))
+
+    if workers == 1:
+        return [detectImage(job) for job in jobs]
+
+    pool = multiprocessing.Pool(workers, initializer=initWorker)
+    try:
+        # map keeps the order of the jobs
+        images = pool.map(detectImage, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return images
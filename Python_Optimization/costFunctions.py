@@ -8,10 +8,12 @@ import random
 #-------------------------------------------------------------------------------
 
 
-def points2imageFromT(T, K, P, dist):
-
-    # Calculation of the point in the image in relation to the chess reference
-    xypix = []
+def points2imageFromTs(Ts, K, P, dist):
+    """Projection of points to the image for a stack of transformations
+        Projects the points P (defined in the aruco referential) with each one of the
+        D camera-from-aruco transforms Ts (D x 4 x 4) in a single pass. Returns the
+        D x P x 2 array of pixel coordinates.
+    """
 
     fx = K[0, 0]
     fy = K[1, 1]
@@ -24,29 +26,46 @@ def points2imageFromT(T, K, P, dist):
     p2 = dist[0, 3]
     k3 = dist[0, 4]
 
-    P = P[:, 0:3]
+    P = np.asarray(P, dtype=np.float64)[:, 0:3]
 
-    for p in P:
+    # Points in the camera referential (D x P x 3)
+    xyz = np.einsum('dij,pj->dpi', Ts[:, 0:3, 0:3], P) + Ts[:, np.newaxis, 0:3, 3]
 
-        rot = np.matrix(T[0: 3, 0: 3])
-        xyz = rot.dot(p) + T[0: 3, 3]
+    xl = xyz[:, :, 0] / xyz[:, :, 2]
+    yl = xyz[:, :, 1] / xyz[:, :, 2]
 
-        xl = xyz[0, 0] / xyz[0, 2]
-        yl = xyz[0, 1] / xyz[0, 2]
+    r_square = xl**2 + yl**2
+    radial = 1 + k1 * r_square + k2 * r_square**2 + k3 * r_square**3
 
-        r_square = xl**2 + yl**2
+    xll = xl * radial + 2 * p1 * xl * yl + p2 * (r_square + 2 * xl**2)
+    yll = yl * radial + p1 * (r_square + 2 * yl**2) + 2 * p2 * xl * yl
 
-        xll = xl * (1 + k1 * r_square + k2 * r_square**2 + k3 *
-                    r_square**3) + 2 * p1 * xl * yl + p2 * (r_square + 2 * xl**2)
-        yll = yl * (1 + k1 * r_square + k2 * r_square**2 + k3 *
-                    r_square**3) + p1 * (r_square + 2 * yl**2) + 2 * p2 * xl * yl
+    xypix = np.empty(xyz.shape[0:2] + (2,))
+    xypix[:, :, 0] = fx * xll + cx
+    xypix[:, :, 1] = fy * yll + cy
 
-        u = fx * xll + cx
-        v = fy * yll + cy
+    return xypix
 
-        xypix.append([u, v])
 
-    return np.array(xypix)
+def points2imageFromT(T, K, P, dist):
+    """Projection of points to the image for a single transformation
+    """
+    return points2imageFromTs(np.asarray(T)[np.newaxis], K, P, dist)[0]
+
+
+def residualsFromProjections(xypix, corners, args):
+    """Distance in pixels between projected and detected points of each detection
+        xypix is the D x P x 2 array of projections and corners the D x 4 x 2 array
+        of detected corners.
+    """
+
+    if args['option1'] == 'corners':
+        # Sum of the distances of the four corners
+        return np.sum(np.sqrt(np.sum((corners - xypix)**2, axis=2)), axis=1)
+    else:
+        # Distance of the center of the aruco
+        center = np.mean(corners, axis=1)
+        return np.sqrt(np.sum((center - xypix[:, 0, :])**2, axis=1))
 
 
 def costFunction(x, dist, intrinsics, X, Pc, detections, args, handles, handle_fun):
@@ -57,59 +76,36 @@ def costFunction(x, dist, intrinsics, X, Pc, detections, args, handles, handle_f
     X.fromVector(list(x), args)
 
     # Cost calculation
-    cost = []
     costFunction.counter += 1
     # print costFunction.counter
     multiples = [100*n for n in range(1, 100+1)]
 
-    if not handles:
-        handles = detections
+    # Camera and aruco of each detection (indexes in X) and the detected corners
+    idxs_cameras, idxs_arucos, corners = X.stackDetections(detections)
 
-    for detection, handle in zip(detections, handles):
-        camera = [camera for camera in X.cameras if camera.id ==
-                  detection.camera[1:]][0]
+    # Each camera and aruco transform is computed only once
+    Tcs = np.array([camera.getT() for camera in X.cameras])
+    Tas = np.array([aruco.getT() for aruco in X.arucos])
 
-        aruco = [aruco for aruco in X.arucos if aruco.id ==
-                 detection.aruco[1:]][0]
+    # Transforms from the aruco to the camera of all detections
+    Ts = np.matmul(inv(Tcs)[idxs_cameras], Tas[idxs_arucos])
 
-        Ta = aruco.getT()
-        Tc = camera.getT()
-        T = np.matmul(inv(Tc), Ta)
+    xypix = points2imageFromTs(Ts, intrinsics, Pc, dist)
 
-        xypix = points2imageFromT(T, intrinsics, Pc, dist)
+    cost = residualsFromProjections(xypix, corners, args)
 
-        distanceFourPoints = 0
-
-        if args['option1'] == 'corners':
-            for i in range(len(xypix)):
-
-                distance = ((detection.corner[0][i, 0] - xypix[i, 0]
-                             ) ** 2 + (detection.corner[0][i, 1] - xypix[i, 1])**2) ** (1/2.0)
-
-                distanceFourPoints = distanceFourPoints + distance
-        else:
-            xcm = (detection.corner[0][0, 0] + detection.corner[0][1, 0] +
-                   detection.corner[0][2, 0] + detection.corner[0][3, 0])/4
-            ycm = (detection.corner[0][0, 1] + detection.corner[0][1, 1] +
-                   detection.corner[0][2, 1] + detection.corner[0][3, 1])/4
-
-            distanceFourPoints = (
-                (xcm - xypix[0, 0]) ** 2 + (ycm - xypix[0, 1]) ** 2) ** (1/2.0)
-
-        cost.append(distanceFourPoints)
-
-        if args['do'] and costFunction.counter in multiples:
+    if args['do'] and costFunction.counter in multiples:
 
-            # draw
+        # draw
+        for handle, xy in zip(handles, xypix):
             # redraw plot 2D
-            handle.handle_scatter.set_offsets(xypix[:, :])
+            handle.handle_scatter.set_offsets(xy[:, :])
 
             # redraw text 2D
-            handle.handle_text.set_position((xypix[0, 0], xypix[0, 1]))
+            handle.handle_text.set_position((xy[0, 0], xy[0, 1]))
 
-            X.setPlot3D(Pc)
+        X.setPlot3D(Pc)
 
-    if args['do'] and costFunction.counter in multiples:
         if handle_fun:
             handle_fun.set_ydata(cost)
         plt.draw()
@@ -109,6 +109,7 @@ class MyX:
         self.v = []
         self.ArucoHandles = []
         self.CameraHandles = []
+        self.stacked = None
 
     def plot3D(self, ax3D, symbol, Pc):
 
@@ -346,6 +347,30 @@ class MyX:
                 self.arucos[i].r2 = v[i*nvalues+4+n_cameras*6]
                 self.arucos[i].r3 = v[i*nvalues+5+n_cameras*6]
 
+    def stackDetections(self, detections):
+        """Arrays of the detections
+            Gets the index in self.cameras and in self.arucos of the camera and aruco of
+            each detection and the D x 4 x 2 array of detected corners. The cameras and
+            arucos do not change during the optimization, so this is only computed once
+            for each list of detections.
+        """
+        if self.stacked is None or self.stacked[0] is not detections:
+            idx_cameras = dict((camera.id, i)
+                               for i, camera in enumerate(self.cameras))
+            idx_arucos = dict((aruco.id, i)
+                              for i, aruco in enumerate(self.arucos))
+
+            idxs_cameras = np.array([idx_cameras[detection.camera[1:]]
+                                     for detection in detections], dtype=int)
+            idxs_arucos = np.array([idx_arucos[detection.aruco[1:]]
+                                    for detection in detections], dtype=int)
+            corners = np.array([detection.corner[0][0:4, 0:2]
+                                for detection in detections], dtype=np.float64)
+
+            self.stacked = (detections, idxs_cameras, idxs_arucos, corners)
+
+        return self.stacked[1:]
+
     def idxsFromCamera(self, camera_name, args):
         nvalues = 6
         # print(camera_name)